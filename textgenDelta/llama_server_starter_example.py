@@ -1,5 +1,4 @@
 from llama_cpp import Llama
-from llama_cpp.server import __main__
 from flask import Flask, request, jsonify
 
 app = Flask(__name__)
@@ -14,23 +13,18 @@ llama = Llama(
     seed=1337,
     n_ctx=4096,
 )
-__main__.main()
-
-def generate_with_template(prompt: str) -> str:
-    template = f"Q: {prompt}. A: "
-    return template
-
+# For an OpenAI-compatible server, use the Django app's /v1/ endpoints instead of
+# llama_cpp.server: they share the already loaded model rather than loading a second copy.
 
 @app.route('/generate', methods=['POST'])
 def generate():
     data = request.json
     prompt = data.get('prompt', '')
 
-    prompt_with_template = generate_with_template(prompt)
-
-    response = llama(prompt=prompt_with_template, max_tokens=2048)
+    # The chat format wraps the prompt and supplies the model's own stop tokens
+    response = llama.create_chat_completion(messages=[{'role': 'user', 'content': prompt}], max_tokens=2048)
 
-    return jsonify({'text': response['choices'][0]['text']})
+    return jsonify({'text': response['choices'][0]['message']['content']})
 
 
 if __name__ == '__main__':
@@ -1,8 +1,30 @@
 from django.contrib import admin
-from .models import TextGenerationSettings
+from .models import Conversation, Message, ModelProfile, TextGenerationSettings
 
 @admin.register(TextGenerationSettings)
 class TextGenerationSettingsAdmin(admin.ModelAdmin):
-    list_display = ('role', 'model_path', 'temperature', 'max_tokens', 'top_p', 'top_k')
+    list_display = ('role', 'model_path', 'temperature', 'max_tokens', 'top_p', 'top_k', 'n_ctx', 'n_threads', 'auto_tune',
+                    'speculative')
     search_fields = ('role',)
 
+
+class MessageInline(admin.TabularInline):
+    model = Message
+    fields = ('position', 'role', 'content', 'token_count')
+    readonly_fields = ('token_count',)
+    extra = 0
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'title', 'created_at', 'updated_at')
+    search_fields = ('title',)
+    inlines = [MessageInline]
+
+
+@admin.register(ModelProfile)
+class ModelProfileAdmin(admin.ModelAdmin):
+    list_display = ('model_path', 'quantization', 'n_threads', 'n_threads_batch', 'n_batch', 'n_ctx', 'n_gpu_layers',
+                    'calibrated_tokens_per_second', 'updated_at')
+    readonly_fields = ('file_size', 'file_mtime', 'cpu_count', 'memory_bytes', 'architecture', 'quantization',
+                       'n_layers', 'trained_n_ctx', 'calibrated_tokens_per_second', 'updated_at')
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class TextgenConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'textgen'
+
+    def ready(self):
+        from . import signals  # noqa: F401  (connects the settings cache invalidation)
+        from .startup import timeline
+        # Model preloading is started by the WSGI/ASGI entry points (see startup.py), not here,
+        # so management commands like migrate stay fast
+        timeline.mark('django ready')
@@ -0,0 +1,231 @@
+import dataclasses
+import glob
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+from django.conf import settings
+from . import gguf
+from .models import ModelProfile
+from .settings_cache import ResolvedSettings
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Auto-tune Defaults (overridable in settings.py) ---
+DEFAULT_AUTOTUNE_MAX_CTX = 8192
+DEFAULT_AUTOTUNE_RESERVED_MB = 512  # left free for Android, the browser and Django itself
+MIN_CTX = 512
+# Used when the GGUF metadata lacks shape information; matches a 7B llama
+FALLBACK_LAYERS = 32
+FALLBACK_EMBEDDING = 4096
+FALLBACK_VOCAB = 32000
+CALIBRATION_PROMPT = "Write a short paragraph about the sea."
+CALIBRATION_TOKENS = 32
+
+
+@dataclass(frozen=True)
+class CpuTopology:
+    cpu_count: int
+    # Cores outside the slowest cluster on big.LITTLE chips; every core otherwise
+    performance_cores: int
+    clusters: tuple[tuple[int, int], ...]  # (max frequency in kHz, core count), fastest first
+
+
+def detect_cpu() -> CpuTopology:
+    cpu_count = os.cpu_count() or 1
+    frequencies: dict[int, int] = {}
+    for path in glob.glob('/sys/devices/system/cpu/cpu[0-9]*/cpufreq/cpuinfo_max_freq'):
+        try:
+            with open(path) as freq_file:
+                frequency = int(freq_file.read().strip())
+        except (OSError, ValueError):
+            continue
+        frequencies[frequency] = frequencies.get(frequency, 0) + 1
+
+    clusters = tuple(sorted(frequencies.items(), reverse=True))
+    if len(clusters) > 1:
+        # Decoding is memory-bound and waits for the slowest thread, so LITTLE cores only slow it down
+        performance_cores = sum(count for _, count in clusters[:-1])
+    else:
+        performance_cores = min(cpu_count, 8)
+    return CpuTopology(cpu_count, max(1, performance_cores), clusters)
+
+
+def available_memory_bytes() -> int:
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def _supports_gpu_offload() -> bool:
+    try:
+        import llama_cpp
+        return bool(llama_cpp.llama_supports_gpu_offload())
+    except Exception:
+        return False
+
+
+def kv_cache_bytes_per_token(metadata: dict) -> int:
+    layers = gguf.architecture_value(metadata, 'block_count') or FALLBACK_LAYERS
+    embedding = gguf.architecture_value(metadata, 'embedding_length') or FALLBACK_EMBEDDING
+    heads = gguf.architecture_value(metadata, 'attention.head_count') or 1
+    kv_heads = gguf.architecture_value(metadata, 'attention.head_count_kv') or heads
+    # K and V, one f16 value per KV head dimension per layer
+    return 2 * layers * (embedding // heads) * kv_heads * 2
+
+
+def choose_parameters(model_size: int, metadata: dict, cpu: CpuTopology, memory_bytes: int) -> dict:
+    """Picks loader parameters for a model of ``model_size`` bytes on this hardware."""
+    reserved = getattr(settings, 'TEXTGEN_AUTOTUNE_RESERVED_MB', DEFAULT_AUTOTUNE_RESERVED_MB) * 1024 * 1024
+    budget = memory_bytes - reserved - model_size
+
+    if budget >= 1536 * 1024 * 1024:
+        n_batch = 512
+    elif budget >= 768 * 1024 * 1024:
+        n_batch = 256
+    else:
+        n_batch = 128
+    vocab = metadata.get('tokenizer.ggml.tokens') or FALLBACK_VOCAB
+    logits_bytes = vocab * n_batch * 4
+
+    trained_ctx = gguf.architecture_value(metadata, 'context_length') or 4096
+    max_ctx = min(trained_ctx, getattr(settings, 'TEXTGEN_AUTOTUNE_MAX_CTX', DEFAULT_AUTOTUNE_MAX_CTX))
+    per_token = kv_cache_bytes_per_token(metadata)
+    n_ctx = max_ctx
+    while n_ctx > MIN_CTX and per_token * n_ctx + logits_bytes > budget:
+        n_ctx //= 2
+    n_ctx = max(n_ctx, MIN_CTX)
+
+    return {
+        'n_threads': cpu.performance_cores,
+        # Prompt processing is compute-bound and does benefit from every core
+        'n_threads_batch': cpu.cpu_count,
+        'n_batch': min(n_batch, n_ctx),
+        'n_ctx': n_ctx,
+        'n_gpu_layers': -1 if _supports_gpu_offload() else 0,
+    }
+
+
+def calibrate(model_path: str, params: dict, thread_counts: list[int], loader=None) -> tuple[int, float]:
+    """Measures generation speed for each thread count and returns the fastest with its tokens/s."""
+    if loader is None:
+        from .model_registry import registry
+        loader = registry.loader
+    results = {}
+    for n_threads in thread_counts:
+        model = loader(model_path=model_path, n_ctx=MIN_CTX, n_threads=n_threads,
+                       n_threads_batch=params['n_threads_batch'], n_batch=min(params['n_batch'], MIN_CTX),
+                       n_gpu_layers=params['n_gpu_layers'], verbose=False)
+        first_token_at, tokens = None, 0
+        for chunk in model(prompt=CALIBRATION_PROMPT, max_tokens=CALIBRATION_TOKENS, temperature=0, stream=True):
+            if chunk["choices"][0]["text"]:
+                first_token_at = first_token_at or time.perf_counter()
+                tokens += 1
+        elapsed = time.perf_counter() - first_token_at if first_token_at else 0
+        results[n_threads] = (tokens - 1) / elapsed if tokens > 1 and elapsed > 0 else 0.0
+        logger.info(f"Calibration: n_threads={n_threads} -> {results[n_threads]:.2f} tokens/s")
+        del model
+    best = max(results, key=results.get)
+    return best, results[best]
+
+
+def _calibration_candidates(cpu: CpuTopology) -> list[int]:
+    candidates = {cpu.performance_cores, cpu.performance_cores - 1, cpu.performance_cores + 1,
+                  cpu.cpu_count // 2, cpu.cpu_count}
+    return sorted(n for n in candidates if 1 <= n <= cpu.cpu_count)
+
+
+def build_profile(model_path: str, run_calibration: bool = False) -> ModelProfile:
+    """Measures this device and the model file and stores the resulting profile."""
+    stat = os.stat(model_path)
+    try:
+        metadata = gguf.read_metadata(model_path)
+    except (OSError, gguf.GGUFError) as e:
+        logger.warning(f"Could not read GGUF metadata from {model_path}, using fallbacks: {e}")
+        metadata = {}
+    cpu = detect_cpu()
+    memory_bytes = available_memory_bytes()
+    params = choose_parameters(stat.st_size, metadata, cpu, memory_bytes)
+
+    tokens_per_second = None
+    if run_calibration:
+        params['n_threads'], tokens_per_second = calibrate(model_path, params, _calibration_candidates(cpu))
+
+    profile, _ = ModelProfile.objects.update_or_create(
+        model_path=model_path,
+        defaults={
+            'file_size': stat.st_size,
+            'file_mtime': stat.st_mtime,
+            'cpu_count': cpu.cpu_count,
+            'memory_bytes': memory_bytes,
+            'architecture': metadata.get('general.architecture', ''),
+            'quantization': gguf.quantization(metadata) or '',
+            'n_layers': gguf.architecture_value(metadata, 'block_count') or 0,
+            'trained_n_ctx': gguf.architecture_value(metadata, 'context_length') or 0,
+            'calibrated_tokens_per_second': tokens_per_second,
+            **params,
+        },
+    )
+    logger.info(f"Auto-tuned {model_path}: {params}")
+    return profile
+
+
+def _is_current(profile: ModelProfile, stat: os.stat_result) -> bool:
+    return profile.file_size == stat.st_size and profile.file_mtime == stat.st_mtime \
+        and profile.cpu_count == (os.cpu_count() or 1)
+
+
+_lock = threading.Lock()
+_profiles: dict[str, ModelProfile] = {}
+
+
+def get_profile(model_path: str) -> Optional[ModelProfile]:
+    """Returns the stored profile for ``model_path``, building it on first use or when it is stale."""
+    with _lock:
+        profile = _profiles.get(model_path)
+    if profile is not None:
+        return profile
+    try:
+        stat = os.stat(model_path)
+    except OSError:
+        return None
+
+    profile = ModelProfile.objects.filter(model_path=model_path).first()
+    if profile is None or not _is_current(profile, stat):
+        profile = build_profile(model_path)
+    with _lock:
+        _profiles[model_path] = profile
+    return profile
+
+
+def apply_profile(params: ResolvedSettings) -> ResolvedSettings:
+    """Replaces the loader parameters in ``params`` with the model's hardware profile."""
+    try:
+        profile = get_profile(params.model_path)
+    except Exception as e:
+        logger.error(f"Auto-tuning {params.model_path} failed, using configured parameters: {e}")
+        return params
+    if profile is None:
+        return params
+    return dataclasses.replace(
+        params,
+        n_threads=profile.n_threads,
+        n_threads_batch=profile.n_threads_batch,
+        n_batch=profile.n_batch,
+        n_ctx=profile.n_ctx,
+        n_gpu_layers=profile.n_gpu_layers,
+    )
+
+
+def invalidate() -> None:
+    with _lock:
+        _profiles.clear()
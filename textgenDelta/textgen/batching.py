@@ -0,0 +1,320 @@
+import codecs
+import logging
+import queue
+import threading
+import weakref
+from collections import deque
+from typing import TYPE_CHECKING, Iterator, Optional
+from django.conf import settings
+from . import metrics
+from .prompt_templates import PreparedPrompt
+
+if TYPE_CHECKING:
+    import llama_cpp
+    from llama_cpp import _internals
+    from .deadlines import Deadline
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Continuous Batching Defaults (overridable in settings.py) ---
+DEFAULT_PARALLEL_SEQUENCES = 1  # 1 keeps the serial path: one completion per model at a time
+DEFAULT_MIN_P = 0.05  # llama_cpp's create_completion default, so both paths sample alike
+DEFAULT_DEFRAG_THRESHOLD = 0.1  # finished sequences leave holes in the shared KV cache
+
+_DONE = object()
+
+
+def parallel_sequences() -> int:
+    return max(1, getattr(settings, 'TEXTGEN_PARALLEL_SEQUENCES', DEFAULT_PARALLEL_SEQUENCES))
+
+
+def enabled() -> bool:
+    return parallel_sequences() > 1
+
+
+def supports(model) -> bool:
+    # Stand-in backends (see stub_backend.py) have no llama.cpp context to share
+    return hasattr(model, '_model') and hasattr(model, 'context_params')
+
+
+class _Sequence:
+    """One completion inside the batch, with its own sampler, stop sequences and KV cache cells."""
+
+    def __init__(self, prompt_tokens: list[int], stop: tuple[str, ...], params,
+                 deadline: Optional["Deadline"] = None):
+        self.prompt_tokens = prompt_tokens
+        self.params = params
+        self.stop = tuple(s for s in stop if s)
+        self.max_tokens = params.max_tokens
+        self.seq_id = -1
+        self.sampler: Optional["_internals.LlamaSampler"] = None
+        self.n_past = 0  # tokens of this sequence already in the KV cache
+        self.pending: list[int] = list(prompt_tokens)  # tokens to decode in the next steps
+        self.completion_tokens = 0
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        # Decoded text not yet emitted, held back while it could still turn into a stop sequence
+        self.text = ''
+        self.events: "queue.Queue" = queue.Queue()
+        self.cancelled = threading.Event()
+        self.deadline = deadline
+
+    def stopped(self) -> bool:
+        return self.cancelled.is_set() or (self.deadline is not None and self.deadline.expired())
+
+    def reserved_tokens(self) -> int:
+        return len(self.prompt_tokens) + self.max_tokens
+
+
+def _build_sampler(params) -> "_internals.LlamaSampler":
+    import llama_cpp
+    from llama_cpp import _internals
+    # Same chain as Llama._init_sampler for the parameters this app sets
+    sampler = _internals.LlamaSampler()
+    if params.temperature <= 0:
+        sampler.add_greedy()
+        return sampler
+    sampler.add_top_k(params.top_k)
+    sampler.add_top_p(params.top_p, 1)
+    sampler.add_min_p(DEFAULT_MIN_P, 1)
+    sampler.add_temp(params.temperature)
+    sampler.add_dist(params.seed if params.seed != -1 else llama_cpp.LLAMA_DEFAULT_SEED)
+    return sampler
+
+
+class BatchEngine:
+    """Decodes several completions at once on one loaded model.
+
+    The engine owns a second llama.cpp context on the model's weights with
+    ``n_parallel`` sequence ids sharing one KV cache. A single thread builds
+    each ``llama_decode`` batch from one pending token per generating
+    sequence plus prompt chunks of newly admitted ones, samples every
+    sequence with its own sampler, and admits waiting requests as soon as a
+    sequence id and enough KV cells are free. The model's own context (and
+    so its prompt-prefix cache and speculative draft) is not used here.
+    """
+
+    def __init__(self, model: "llama_cpp.Llama", n_parallel: int):
+        import llama_cpp
+        from llama_cpp import _internals
+        self._model = model
+        # End-of-generation is a property of the vocabulary, not the model, since llama.cpp split the two;
+        # releases before the split (llama_cpp_python < 0.3.6) only have the model-pointer function
+        vocab = getattr(model._model, 'vocab', None)
+        if vocab is not None and hasattr(llama_cpp, 'llama_vocab_is_eog'):
+            self._is_eog, self._eog_source = llama_cpp.llama_vocab_is_eog, vocab
+        else:
+            self._is_eog, self._eog_source = llama_cpp.llama_token_is_eog, model._model.model
+        self.n_parallel = n_parallel
+        params = llama_cpp.llama_context_params.from_buffer_copy(model.context_params)
+        params.n_seq_max = n_parallel
+        params.logits_all = False
+        params.defrag_thold = DEFAULT_DEFRAG_THRESHOLD
+        self._ctx = _internals.LlamaContext(model=model._model, params=params, verbose=model.verbose)
+        self.n_ctx = self._ctx.n_ctx()
+        self.n_batch = params.n_batch
+        self._batch = _internals.LlamaBatch(n_tokens=self.n_batch, embd=0, n_seq_max=n_parallel,
+                                            verbose=model.verbose)
+
+        self._cond = threading.Condition()
+        self._waiting: deque[_Sequence] = deque()
+        self._active: list[_Sequence] = []
+        self._free_ids = list(range(n_parallel))
+        self._reserved = 0  # KV cells promised to active sequences
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='textgen-batch-engine', daemon=True)
+        self._thread.start()
+        _engines.add(self)
+        logger.info(f"Started batch engine with {n_parallel} sequences over {self.n_ctx} context tokens")
+
+    def active_count(self) -> int:
+        return len(self._active)
+
+    def waiting_count(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def model(self) -> "llama_cpp.Llama":
+        return self._model
+
+    def stream(self, prompt: PreparedPrompt, params, timer: metrics.GenerationTimer,
+               deadline: Optional["Deadline"] = None) -> Iterator[str]:
+        """Yields the completion's text as it is decoded; closing the iterator frees its sequence.
+
+        A ``deadline`` is checked after every sampled token, like llama_cpp's
+        stopping criteria; once it expires the sequence is freed and its
+        exception raised here.
+        """
+        prompt_tokens = prompt.tokens or [self._model.token_bos()]
+        if len(prompt_tokens) >= self.n_ctx:
+            raise ValueError(f"Requested tokens ({len(prompt_tokens)}) exceed context window of {self.n_ctx}")
+        sequence = _Sequence(prompt_tokens, prompt.stop, params, deadline)
+        if sequence.max_tokens <= 0 or sequence.reserved_tokens() > self.n_ctx:
+            sequence.max_tokens = self.n_ctx - len(prompt_tokens)
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Batch engine is closed")
+            self._waiting.append(sequence)
+            self._cond.notify()
+        try:
+            while True:
+                event = sequence.events.get()
+                if event is _DONE:
+                    break
+                if isinstance(event, Exception):
+                    raise event
+                timer.token()
+                yield event
+        finally:
+            sequence.cancelled.set()
+            with self._cond:
+                self._cond.notify()
+        if deadline is not None:
+            deadline.raise_if_stopped()
+        timer.finish(len(prompt_tokens), sequence.completion_tokens)
+
+    def close(self) -> None:
+        """Stops the engine once the sequences already submitted have finished."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    # --- Engine Thread ---
+
+    def _run(self) -> None:
+        try:
+            while True:
+                with self._cond:
+                    while not self._closed and not self._active and not self._waiting:
+                        self._cond.wait()
+                    if self._closed and not self._active and not self._waiting:
+                        break
+                    self._admit()
+                for sequence in [s for s in self._active if s.stopped()]:
+                    self._finish(sequence)
+                if self._active:
+                    self._step()
+        except Exception as e:
+            logger.error(f"Batch engine stopped: {e}")
+            for sequence in list(self._active) + list(self._waiting):
+                sequence.events.put(e)
+        finally:
+            self._batch.close()
+            self._ctx.close()
+            logger.info("Batch engine stopped")
+
+    def _admit(self) -> None:
+        # Caller must hold self._cond
+        while self._waiting and self._free_ids:
+            sequence = self._waiting[0]
+            if sequence.stopped():
+                self._waiting.popleft()
+                # Its consumer may still be waiting (a deadline rather than a closed iterator)
+                sequence.events.put(_DONE)
+                continue
+            if self._reserved + sequence.reserved_tokens() > self.n_ctx:
+                break  # FIFO: wait for running sequences to free KV cells
+            self._waiting.popleft()
+            sequence.seq_id = self._free_ids.pop()
+            sequence.sampler = _build_sampler(sequence.params)
+            self._reserved += sequence.reserved_tokens()
+            self._active.append(sequence)
+
+    def _step(self) -> None:
+        self._batch.reset()
+        budget = self.n_batch
+        planned: list[tuple[_Sequence, int, int]] = []  # (sequence, tokens taken, logits row or -1)
+        # Generating sequences go first so a long new prompt cannot stall their next token
+        for sequence in sorted(self._active, key=lambda s: len(s.pending)):
+            if budget <= 0:
+                break
+            take = sequence.pending[:budget]
+            last = len(take) == len(sequence.pending)
+            for i, token in enumerate(take):
+                self._add(token, sequence.n_past + i, sequence.seq_id, last and i == len(take) - 1)
+            planned.append((sequence, len(take), self._batch.n_tokens() - 1 if last else -1))
+            budget -= len(take)
+
+        try:
+            self._ctx.decode(self._batch)
+        except RuntimeError as e:
+            logger.error(f"Batched decode of {self._batch.n_tokens()} tokens failed: {e}")
+            for sequence, _, _ in planned:
+                sequence.events.put(e)
+                self._finish(sequence)
+            return
+        batch_sequences.observe(len(planned))
+
+        for sequence, taken, row in planned:
+            sequence.n_past += taken
+            sequence.pending = sequence.pending[taken:]
+            if row >= 0:
+                self._accept(sequence, sequence.sampler.sample(self._ctx, row))
+
+    def _add(self, token: int, pos: int, seq_id: int, logits: bool) -> None:
+        batch = self._batch.batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.seq_id[i][0] = seq_id
+        batch.n_seq_id[i] = 1
+        batch.logits[i] = logits
+        batch.n_tokens += 1
+
+    def _accept(self, sequence: _Sequence, token: int) -> None:
+        if self._is_eog(self._eog_source, token):
+            self._finish(sequence, flush=True)
+            return
+        sequence.completion_tokens += 1
+        sequence.text += sequence.decoder.decode(self._model.detokenize([token]))
+        if sequence.deadline is not None and sequence.deadline():
+            self._finish(sequence)
+            return
+        if self._emit(sequence) or sequence.completion_tokens >= sequence.max_tokens:
+            self._finish(sequence, flush=True)
+            return
+        sequence.pending = [token]
+
+    def _emit(self, sequence: _Sequence) -> bool:
+        """Sends the text that can no longer start a stop sequence; True once a stop sequence matched."""
+        text = sequence.text
+        matches = [index for index in (text.find(stop) for stop in sequence.stop) if index >= 0]
+        if matches:
+            sequence.text = text[:min(matches)]
+            return True
+        hold = 0
+        for stop in sequence.stop:
+            for length in range(min(len(stop) - 1, len(text)), hold, -1):
+                if text.endswith(stop[:length]):
+                    hold = length
+                    break
+        ready = text[:len(text) - hold]
+        if ready:
+            sequence.events.put(ready)
+        sequence.text = text[len(ready):]
+        return False
+
+    def _finish(self, sequence: _Sequence, flush: bool = False) -> None:
+        if flush and sequence.text:
+            sequence.events.put(sequence.text)
+        sequence.text = ''
+        sequence.events.put(_DONE)
+        self._ctx.kv_cache_seq_rm(sequence.seq_id, -1, -1)
+        sequence.sampler.close()
+        with self._cond:
+            self._active.remove(sequence)
+            self._free_ids.append(sequence.seq_id)
+            self._reserved -= sequence.reserved_tokens()
+
+
+_engines: "weakref.WeakSet[BatchEngine]" = weakref.WeakSet()
+
+batch_sequences = metrics.registry.histogram(
+    'textgen_batch_sequences', 'Sequences decoded together per llama_decode call.',
+    (1, 2, 3, 4, 6, 8, 12, 16))
+metrics.registry.gauge('textgen_batch_active_sequences', 'Sequences being decoded by batch engines.',
+                       lambda: sum(engine.active_count() for engine in _engines))
+metrics.registry.gauge('textgen_batch_waiting_sequences', 'Requests waiting for a free batch sequence.',
+                       lambda: sum(engine.waiting_count() for engine in _engines))
@@ -0,0 +1,204 @@
+import logging
+from typing import Iterator, Optional
+from django.db import transaction
+from . import deadlines, metrics
+from .generation import DEFAULT_ROLE, resolve_generation_params
+from .governor import InsufficientMemory
+from .model_registry import registry
+from .models import Conversation, Message
+from .scheduler import GenerationCancelled, GenerationTimeout
+from .settings_cache import ResolvedSettings
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Context Window Defaults ---
+# Chat templates wrap every message in role markers; this is a safe upper bound per message
+MESSAGE_OVERHEAD_TOKENS = 8
+# Headroom for the assistant prefix the chat template appends after the last message
+WINDOW_SAFETY_TOKENS = 16
+
+
+def count_tokens(model, text: str) -> int:
+    return len(model.tokenize(text.encode('utf-8'), add_bos=False)) + MESSAGE_OVERHEAD_TOKENS
+
+
+def create_conversation(system_prompt: str = '', title: str = '') -> Conversation:
+    return Conversation.objects.create(system_prompt=system_prompt, title=title)
+
+
+def _save_turn(conversation: Conversation, user_message: Message, answer: str, token_count: int) -> Message:
+    """Stores the user's message and the assistant's answer together, after the answer was generated.
+
+    Nothing is stored for a turn that failed, so a client retrying it does not repeat the question.
+    """
+    # window_messages may have opened the window at the unsaved message; keep it there if its position moves
+    starts_here = conversation.window_start >= user_message.position
+    with transaction.atomic():
+        last = conversation.messages.order_by('-position').values_list('position', flat=True).first()
+        user_message.position = 0 if last is None else last + 1
+        if starts_here:
+            conversation.window_start = user_message.position
+        user_message.save(force_insert=True)
+        message = Message.objects.create(
+            conversation=conversation,
+            position=user_message.position + 1,
+            role='assistant',
+            content=answer,
+            token_count=token_count,
+        )
+        # Bumps updated_at so recently used conversations sort first
+        conversation.save(update_fields=['updated_at', 'window_start', 'system_token_count'])
+    return message
+
+
+def window_messages(conversation: Conversation, budget: int, pending: Optional[Message] = None) -> list[dict]:
+    """Returns the newest messages that fit in ``budget`` tokens, oldest first.
+
+    Token counts are stored per message, so this only sums integers. The
+    window start only ever moves forward and is persisted, so messages that
+    already fell out of the window are not even loaded on later turns.
+    ``pending`` is the unsaved message of the turn being generated.
+    """
+    messages = list(conversation.messages.filter(position__gte=conversation.window_start))
+    if pending is not None:
+        messages.append(pending)
+    total = conversation.system_token_count + sum(message.token_count for message in messages)
+
+    start = 0
+    # Always keep the newest message, even if it alone exceeds the budget
+    while total > budget and start < len(messages) - 1:
+        total -= messages[start].token_count
+        start += 1
+    # Never open the window with an assistant reply whose question was dropped
+    while start < len(messages) - 1 and messages[start].role == 'assistant':
+        start += 1
+
+    if start:
+        conversation.window_start = messages[start].position
+        logger.debug(f"Conversation {conversation.id}: dropped {start} old messages from the context window")
+
+    history = [{'role': 'system', 'content': conversation.system_prompt}] if conversation.system_prompt else []
+    history.extend({'role': message.role, 'content': message.content} for message in messages[start:])
+    return history
+
+
+def _prepare_turn(conversation: Conversation, model, content: str,
+                  max_tokens: int) -> tuple[Message, list[dict]]:
+    # Caller must hold the model's inference lock
+    if conversation.system_prompt and not conversation.system_token_count:
+        conversation.system_token_count = count_tokens(model, conversation.system_prompt)
+    last = conversation.messages.order_by('-position').values_list('position', flat=True).first()
+    # Saved by _save_turn once the answer is complete
+    pending = Message(conversation=conversation, position=0 if last is None else last + 1, role='user',
+                      content=content, token_count=count_tokens(model, content))
+    budget = model.n_ctx() - max_tokens - WINDOW_SAFETY_TOKENS
+    return pending, window_messages(conversation, budget, pending)
+
+
+def _completion_kwargs(params: ResolvedSettings, stop_sequences: Optional[list[str]],
+                       deadline: deadlines.Deadline) -> dict:
+    kwargs = dict(params.sampling_kwargs(), stopping_criteria=deadline)
+    # The chat format already knows where a turn ends; only pass explicit stops
+    if stop_sequences:
+        kwargs['stop'] = stop_sequences
+    return kwargs
+
+
+def reply(
+    conversation: Conversation,
+    content: str,
+    role: str = DEFAULT_ROLE,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    top_p: Optional[float] = None,
+    top_k: Optional[int] = None,
+    model_path: Optional[str] = None,
+    stop_sequences: Optional[list[str]] = None,
+) -> Message:
+    """Adds a user message and generates the assistant's answer with ``create_chat_completion``."""
+    params = resolve_generation_params(role, temperature, max_tokens, top_p, top_k, model_path, stop_sequences)
+
+    timer = metrics.GenerationTimer()
+    deadline = deadlines.for_current_request()
+    try:
+        with registry.use(params.model_key(), **params.load_kwargs()) as model:
+            pending, history = _prepare_turn(conversation, model, content, params.max_tokens)
+            logger.debug(f"Conversation {conversation.id}: sending {len(history)} messages to the model")
+            result = model.create_chat_completion(messages=history,
+                                                  **_completion_kwargs(params, stop_sequences, deadline))
+        # Neither the user's message nor the cut-short answer is kept
+        deadline.raise_if_stopped()
+    except Exception:
+        timer.fail()
+        raise
+
+    answer = result["choices"][0]["message"]["content"] or ""
+    usage = result.get("usage", {})
+    completion_tokens = usage.get("completion_tokens", 0)
+    timer.finish(usage.get("prompt_tokens", 0), completion_tokens)
+    return _save_turn(conversation, pending, answer, completion_tokens + MESSAGE_OVERHEAD_TOKENS)
+
+
+def stream_reply(
+    conversation: Conversation,
+    content: str,
+    role: str = DEFAULT_ROLE,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    top_p: Optional[float] = None,
+    top_k: Optional[int] = None,
+    model_path: Optional[str] = None,
+    stop_sequences: Optional[list[str]] = None,
+) -> Iterator[dict]:
+    """Streaming variant of ``reply`` yielding the same events as ``generation.stream_text``."""
+    try:
+        params = resolve_generation_params(role, temperature, max_tokens, top_p, top_k, model_path, stop_sequences)
+    except InsufficientMemory as e:
+        yield {'event': 'error', 'error': str(e)}
+        return
+
+    chunks = []
+    timer = metrics.GenerationTimer()
+    deadline = deadlines.for_current_request()
+    try:
+        with registry.use(params.model_key(), **params.load_kwargs()) as model:
+            pending, history = _prepare_turn(conversation, model, content, params.max_tokens)
+            stream = model.create_chat_completion(
+                messages=history, stream=True, **_completion_kwargs(params, stop_sequences, deadline),
+            )
+            try:
+                for chunk in stream:
+                    text = chunk["choices"][0]["delta"].get("content")
+                    if text:
+                        timer.token()
+                        chunks.append(text)
+                        yield {'event': 'token', 'text': text}
+            finally:
+                stream.close()
+            deadline.raise_if_stopped()
+            answer = "".join(chunks)
+            token_count = count_tokens(model, answer)
+        # Prompt size is not known here (the chat template adds to it), so only timings are recorded
+        timer.finish(0)
+    except (GeneratorExit, GenerationCancelled):
+        logger.info(f"Conversation {conversation.id}: streaming cancelled after {len(chunks)} chunks")
+        raise
+    except GenerationTimeout as e:
+        timer.fail()
+        yield {'event': 'error', 'error': str(e)}
+        return
+    except Exception as e:
+        timer.fail()
+        logger.error(f"An unexpected error occurred during conversation streaming: {e}")
+        yield {'event': 'error', 'error': 'An error occurred during generation.'}
+        return
+
+    message = _save_turn(conversation, pending, answer, token_count)
+    yield {
+        'event': 'done',
+        'message_id': message.id,
+        'response': answer,
+        'timestamp': message.timestamp.isoformat(),
+    }
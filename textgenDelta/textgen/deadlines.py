@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from typing import Optional
+from django.conf import settings
+from . import metrics
+from .scheduler import GenerationCancelled, GenerationTimeout, current_job
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Deadline Defaults (overridable in settings.py) ---
+DEFAULT_MAX_GENERATION_SECONDS = 180  # wall time of one completion, prompt evaluation included; None disables
+DEFAULT_MIN_TOKENS_PER_SECOND = 0.5  # 0 disables the floor
+# The rate is only judged once this many tokens were generated, so a slow first token is not held against it
+RATE_GRACE_TOKENS = 16
+
+CANCELLED = 'cancelled'
+TIMED_OUT = 'timeout'
+TOO_SLOW = 'too_slow'
+
+
+class Deadline:
+    """Decides when a completion must stop early, checked once per generated token.
+
+    Instances are callable with llama_cpp's ``stopping_criteria`` signature,
+    so the check runs inside the decode loop: a cancelled or overdue request
+    stops after its current token and frees the inference worker at once.
+    ``reason`` says why it stopped; ``raise_if_stopped`` turns that into the
+    exception the scheduler reports to the client.
+    """
+
+    def __init__(self, cancelled: Optional[threading.Event] = None, expires_at: Optional[float] = None,
+                 min_tokens_per_second: float = 0.0):
+        self.cancelled = cancelled
+        self.expires_at = expires_at  # time.monotonic() value
+        self.min_tokens_per_second = min_tokens_per_second
+        self.reason: Optional[str] = None
+        self.tokens = 0
+        self._first_token_at: Optional[float] = None
+
+    def __call__(self, input_ids=None, logits=None) -> bool:
+        """Counts one generated token and returns True once the completion must stop."""
+        if self._first_token_at is None:
+            self._first_token_at = time.monotonic()
+        self.tokens += 1
+        return self.expired()
+
+    def expired(self) -> bool:
+        if self.reason is None:
+            self.reason = self._check()
+            if self.reason is not None:
+                if self.reason != CANCELLED:
+                    # Cancellations are counted by the scheduler
+                    metrics.deadline_stops.inc()
+                logger.info(f"Stopping generation after {self.tokens} tokens: {self.describe()}")
+        return self.reason is not None
+
+    def _check(self) -> Optional[str]:
+        if self.cancelled is not None and self.cancelled.is_set():
+            return CANCELLED
+        now = time.monotonic()
+        if self.expires_at is not None and now >= self.expires_at:
+            return TIMED_OUT
+        if self.min_tokens_per_second and self.tokens > RATE_GRACE_TOKENS:
+            if self.rate(now) < self.min_tokens_per_second:
+                return TOO_SLOW
+        return None
+
+    def rate(self, now: Optional[float] = None) -> float:
+        """Tokens per second after the first one."""
+        if self._first_token_at is None:
+            return 0.0
+        elapsed = (now or time.monotonic()) - self._first_token_at
+        return (self.tokens - 1) / elapsed if elapsed > 0 else float('inf')
+
+    def describe(self) -> str:
+        if self.reason == CANCELLED:
+            return "Generation was cancelled"
+        if self.reason == TOO_SLOW:
+            return (f"Generation slowed to {self.rate():.2f} tokens/s, "
+                    f"below the floor of {self.min_tokens_per_second} tokens/s")
+        return "Generation ran past its deadline"
+
+    def raise_if_stopped(self) -> None:
+        """Raises ``GenerationCancelled`` or ``GenerationTimeout`` if the completion was stopped early."""
+        if self.reason == CANCELLED:
+            raise GenerationCancelled(self.describe())
+        if self.reason is not None:
+            raise GenerationTimeout(self.describe())
+
+
+def for_current_request() -> Deadline:
+    """A deadline for one completion of the scheduler job running on this thread.
+
+    It stops when the job is cancelled, or at the job's own deadline or
+    ``TEXTGEN_MAX_GENERATION_SECONDS`` from now, whichever comes first.
+    """
+    max_seconds = getattr(settings, 'TEXTGEN_MAX_GENERATION_SECONDS', DEFAULT_MAX_GENERATION_SECONDS)
+    expires_at = time.monotonic() + max_seconds if max_seconds else None
+    job = current_job()
+    if job is not None:
+        expires_at = job.deadline if expires_at is None else min(expires_at, job.deadline)
+    return Deadline(
+        cancelled=job.cancelled if job is not None else None,
+        expires_at=expires_at,
+        min_tokens_per_second=getattr(settings, 'TEXTGEN_MIN_TOKENS_PER_SECOND', DEFAULT_MIN_TOKENS_PER_SECOND),
+    )
@@ -0,0 +1,30 @@
+# Fallback values used when no TextGenerationSettings row overrides them.
+# Keep them in sync with the field defaults of TextGenerationSettings.
+
+# /sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf /sdcard/fuji/qwen2.5-1.5b-instruct-q4_k_m.gguf
+# --- Default Configuration ---
+# DEFAULT_MODEL_PATH = "/sdcard/fuji/qwen2.5-1.5b-instruct-q4_k_m.gguf"
+# DEFAULT_CHAT_FORMAT = "qwen"
+DEFAULT_MODEL_PATH = "/sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf"
+DEFAULT_CHAT_FORMAT = "saiga"
+DEFAULT_GPU_LAYERS = -1
+DEFAULT_BATCH_SIZE = 512
+DEFAULT_THREADS = 4
+DEFAULT_THREADS_BATCH = 0  # 0 lets llama_cpp use every core for prompt processing
+DEFAULT_SEED = -1
+DEFAULT_CONTEXT_LENGTH = 4096
+DEFAULT_VERBOSE = True
+DEFAULT_SPECULATIVE = ''  # '', 'prompt_lookup' or 'draft_model'
+DEFAULT_DRAFT_TOKENS = 10
+
+# --- Generation Parameter Defaults ---
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_MAX_TOKENS = 200
+DEFAULT_TOP_P = 1.0
+DEFAULT_TOP_K = 50
+
+# --- Generation Defaults ---
+DEFAULT_ROLE = 'user'
+# Extra stop sequences; each model's end-of-turn markers come from its chat template (see prompt_templates.py)
+DEFAULT_STOP_TOKENS = []
+DEFAULT_SYSTEM_PROMPT = ''
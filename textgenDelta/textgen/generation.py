@@ -1,37 +1,138 @@
 import logging
-from typing import Optional
-import llama_cpp
-from .models import TextGenerationSettings, Chat # Import the Chat model
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional, Union
+from django.utils import timezone
+from .models import Chat # Import the Chat model
+# Defaults live in defaults.py (re-exported here); per-role values come from settings_cache
+from .defaults import (
+    DEFAULT_BATCH_SIZE, DEFAULT_CHAT_FORMAT, DEFAULT_CONTEXT_LENGTH, DEFAULT_GPU_LAYERS, DEFAULT_MAX_TOKENS,
+    DEFAULT_MODEL_PATH, DEFAULT_ROLE, DEFAULT_SEED, DEFAULT_STOP_TOKENS, DEFAULT_TEMPERATURE, DEFAULT_THREADS,
+    DEFAULT_TOP_K, DEFAULT_TOP_P, DEFAULT_VERBOSE,
+)
+from . import (
+    autotune, batching, deadlines, governor, metrics, prompt_templates, response_cache, retrieval, speculative,
+)
+from .governor import InsufficientMemory
+from .model_registry import registry
+from .scheduler import GenerationCancelled, GenerationTimeout
+from .persistence import chat_writer
+from .settings_cache import InvalidOverride, ResolvedSettings, get_settings
 
 # Configure logging for this module
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
-
-
-# /sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf /sdcard/fuji/qwen2.5-1.5b-instruct-q4_k_m.gguf
-# --- Default Configuration ---
-# DEFAULT_MODEL_PATH = "/sdcard/fuji/qwen2.5-1.5b-instruct-q4_k_m.gguf"
-# DEFAULT_CHAT_FORMAT = "qwen"
-DEFAULT_MODEL_PATH = "/sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf"
-DEFAULT_CHAT_FORMAT = "saiga"
-DEFAULT_GPU_LAYERS = -1
-DEFAULT_BATCH_SIZE = 512
-DEFAULT_THREADS = 4
-DEFAULT_SEED = -1
-DEFAULT_CONTEXT_LENGTH = 4096
-DEFAULT_VERBOSE = True
-
-# --- Generation Parameter Defaults ---
-DEFAULT_TEMPERATURE = 0.7
-DEFAULT_MAX_TOKENS = 200
-DEFAULT_TOP_P = 1.0
-DEFAULT_TOP_K = 50
-
-# --- Generation Defaults ---
-DEFAULT_ROLE = 'user'
-DEFAULT_STOP_TOKENS = ["Q:", "\n\n"]
 
-def generate_text(
+
+def preload_default_model() -> None:
+    """Loads the default model into the registry so the first request does not pay for it (see startup.py)."""
+    # Resolved like a request so the preloaded instance is the one requests will use
+    resolved = resolve_generation_params(DEFAULT_ROLE)
+    registry.get(resolved.model_key(), **resolved.load_kwargs())
+    logger.info(f"Preloaded default model: {resolved.model_path}")
+
+
+def resolve_generation_params(
+    role: str = DEFAULT_ROLE,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    top_p: Optional[float] = None,
+    top_k: Optional[int] = None,
+    model_path: Optional[str] = None,
+    stop_sequences: Optional[list[str]] = None,
+) -> ResolvedSettings:
+    """Merges explicit arguments over the role's cached settings.
+
+    Raises ``InvalidOverride`` for unusable arguments and ``InsufficientMemory``.
+    """
+    params = get_settings(role).with_overrides(
+        temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=top_p,
+        top_k=top_k,
+        model_path=model_path,
+        stop=stop_sequences,
+    )
+    # Applied after the overrides so the profile matches the model actually used
+    if params.auto_tune:
+        params = autotune.apply_profile(params)
+    return governor.govern(params)
+
+
+def _stream_completion(model, prompt: prompt_templates.PreparedPrompt, params: ResolvedSettings,
+                       timer: metrics.GenerationTimer, deadline: deadlines.Deadline) -> Iterator[str]:
+    """Yields the text of each decoded chunk and records timings once the completion ends."""
+    # Caller must hold the model's inference lock, which this request may have waited for
+    if deadline.expired():
+        deadline.raise_if_stopped()
+    draft = speculative.counting_draft(model)
+    if draft is not None:
+        draft.begin()
+    stream = model(
+        prompt=prompt.tokens,
+        stop=list(prompt.stop),
+        echo=False,
+        stream=True,
+        # Checked by llama_cpp after every token, so a cancelled request stops inside the decode loop
+        stopping_criteria=deadline,
+        **params.sampling_kwargs(),
+    )
+    try:
+        for chunk in stream:
+            text = chunk["choices"][0]["text"]
+            if text:
+                timer.token()
+                yield text
+    finally:
+        # Stops llama_cpp from decoding further if the consumer went away
+        stream.close()
+    # A completion cut short is an error, so its partial text is neither cached nor saved
+    deadline.raise_if_stopped()
+    # Each streamed chunk is one sampled token (multi-byte characters aside)
+    timer.finish(len(prompt.tokens))
+    if draft is not None:
+        rate = draft.finish()
+        if rate is not None:
+            logger.info(f"Speculative decoding accepted {draft.accepted}/{draft.proposed} draft tokens ({rate:.0%})")
+
+
+def _prepare(model, params: ResolvedSettings, prompt: Union[str, list[dict]],
+             raw: bool) -> prompt_templates.PreparedPrompt:
+    if raw:
+        return prompt_templates.prepare_raw(model, prompt, params.stop)
+    if isinstance(prompt, list):
+        return prompt_templates.prepare_messages(model, params, prompt)
+    return prompt_templates.prepare(model, params, prompt)
+
+
+@contextmanager
+def completion(prompt: Union[str, list[dict]], params: ResolvedSettings, timer: metrics.GenerationTimer,
+               raw: bool = False) -> Iterator[Iterator[str]]:
+    """Yields the completion's text chunks, decoded alongside other requests when batching is enabled.
+
+    ``prompt`` is a user message for the model's chat template, a list of
+    chat messages, or (with ``raw``) text sent to the model as is. Raises
+    ``GenerationCancelled`` or ``GenerationTimeout`` when the request is
+    cancelled or runs past its deadline (see deadlines.py).
+    """
+    key = params.model_key()
+    deadline = deadlines.for_current_request()
+    engine = registry.engine(key, **params.load_kwargs()) if batching.enabled() else None
+    if engine is not None:
+        chunks = engine.stream(_prepare(engine.model, params, prompt, raw), params, timer, deadline)
+        try:
+            yield chunks
+        finally:
+            # Frees the batch sequence right away if the consumer stopped early
+            chunks.close()
+        return
+    with registry.use(key, **params.load_kwargs()) as model:
+        chunks = _stream_completion(model, _prepare(model, params, prompt, raw), params, timer, deadline)
+        try:
+            yield chunks
+        finally:
+            chunks.close()
+
+
+def replay_cached(
     prompt: str,
     role: str = DEFAULT_ROLE,
     temperature: Optional[float] = None,
@@ -40,75 +141,268 @@ def generate_text(
     top_k: Optional[int] = None,
     model_path: Optional[str] = None,
     stop_sequences: Optional[list[str]] = None,
-) -> str:
-    # Determine the final values for generation parameters
+) -> tuple[str, Optional[Chat]]:
+    """Answers a deterministic request from the response cache without touching the model.
+
+    Returns the X-Cache status and, on a hit, the Chat recorded for it. Views
+    call this before queueing so repeated prompts skip the scheduler entirely.
+    """
+    params = resolve_generation_params(role, temperature, max_tokens, top_p, top_k, model_path, stop_sequences)
+    if not response_cache.applies(params):
+        return response_cache.BYPASS, None
+    # Keyed like the generation would store it, so a hit never skips context retrieval would add now
+    status, cached = response_cache.lookup(params, retrieval.augment(prompt))
+    if cached is None:
+        return status, None
+    logger.info(f"Response cache hit for prompt: '{prompt[:50]}...'")
+    return status, _save_chat(prompt, cached)
+
+
+def _save_chat(prompt: str, response: str) -> Chat:
+    # The row is written in the background; the returned chat already has its id and timestamp
     try:
-        settings = TextGenerationSettings.objects.filter(role=role).first()
-        logger.debug(f"Fetched settings for role '{role}': {settings}")
+        chat = chat_writer.save(prompt, response)
+        logger.debug(f"Queued chat for saving: Prompt ID {chat.id}")
+        retrieval.indexer.notify()
+        return chat
     except Exception as e:
-        logger.error(f"Error fetching settings for role '{role}' from database: {e}")
-        settings = None
-
-    final_temperature = temperature if temperature is not None else \
-                       (settings.temperature if settings and settings.temperature is not None else DEFAULT_TEMPERATURE)
-    final_max_tokens = max_tokens if max_tokens is not None else \
-                      (settings.max_tokens if settings and settings.max_tokens is not None else DEFAULT_MAX_TOKENS)
-    final_top_p = top_p if top_p is not None else \
-                 (settings.top_p if settings and settings.top_p is not None else DEFAULT_TOP_P)
-    final_top_k = top_k if top_k is not None else \
-                 (settings.top_k if settings and settings.top_k is not None else DEFAULT_TOP_K)
-
-    final_model_path = model_path or DEFAULT_MODEL_PATH
-    # proc = processor or DEFAULT_PROCESSOR
-    final_stop_sequences = stop_sequences or DEFAULT_STOP_TOKENS
+        logger.error(f"Error saving chat to database: {e}")
+        return Chat(prompt=prompt, response=response, timestamp=timezone.now())
+
+
+def generate_chat(
+    prompt: str,
+    role: str = DEFAULT_ROLE,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    top_p: Optional[float] = None,
+    top_k: Optional[int] = None,
+    model_path: Optional[str] = None,
+    stop_sequences: Optional[list[str]] = None,
+) -> Optional[Chat]:
+    """Generates a completion for ``prompt`` and returns its Chat, or None if generation failed."""
+    # Determine the final values for generation parameters
+    params = resolve_generation_params(role, temperature, max_tokens, top_p, top_k, model_path, stop_sequences)
+    final_model_path = params.model_path
 
     logger.info(f"Generating text with model: {final_model_path}, role: {role}")
 
     # Attempt to load the model and generate text
+    timer = metrics.GenerationTimer()
     try:
-        logger.debug(f"Initializing Llama model with path: {final_model_path}")
-        model = llama_cpp.Llama(
-            model_path=final_model_path,
-            chat_format=DEFAULT_CHAT_FORMAT,
-            n_gpu_layers=DEFAULT_GPU_LAYERS,
-            n_batch=DEFAULT_BATCH_SIZE,
-            n_threads=DEFAULT_THREADS,
-            seed=DEFAULT_SEED,
-            n_ctx=DEFAULT_CONTEXT_LENGTH,
-            verbose=DEFAULT_VERBOSE,
-        )
-
-        logger.debug(f"Calling model with prompt: '{prompt[:50]}...', params: temp={final_temperature}, max_tokens={final_max_tokens}, top_p={final_top_p}, top_k={final_top_k}")
-        result = model(
-            prompt=str(prompt),
-            temperature=float(final_temperature),
-            max_tokens=int(final_max_tokens),
-            top_p=float(final_top_p),
-            top_k=int(final_top_k),
-            stop=final_stop_sequences,
-            echo=False,
-        )
-
-        logger.debug(f"Raw model result: {result}")
-        generated_text = result["choices"][0]["text"]
+        # Related earlier turns are added for the model and the cache key only; the chat keeps the prompt as typed
+        model_prompt = retrieval.augment(prompt)
+        with completion(model_prompt, params, timer) as chunks:
+            logger.debug(f"Calling model with prompt: '{prompt[:50]}...', params: temp={params.temperature}, max_tokens={params.max_tokens}, top_p={params.top_p}, top_k={params.top_k}")
+            # Streamed internally only so time-to-first-token can be measured
+            generated_text = "".join(chunks)
+
         logger.info(f"Successfully generated text of length: {len(generated_text)}")
+        response_cache.store(params, model_prompt, generated_text)
 
         # --- Save Chat to Database ---
-        try:
-            Chat.objects.create(prompt=prompt, response=generated_text)
-            logger.debug(f"Saved chat to database: Prompt ID {Chat.objects.latest('id').id}")
-        except Exception as e:
-            logger.error(f"Error saving chat to database: {e}")
-        # ---
-
-        return generated_text
+        return _save_chat(prompt, generated_text)
 
     except FileNotFoundError:
+        timer.fail()
         logger.error(f"Model file not found at path: {final_model_path}")
-        return ""
+        return None
+    except GenerationCancelled:
+        raise
+    except (InsufficientMemory, GenerationTimeout):
+        # Surfaced to the client as a clear 503 or 504 instead of a generic failure
+        timer.fail()
+        raise
     except Exception as e:
+        timer.fail()
         logger.error(f"An unexpected error occurred during text generation: {e}")
-        return ""
+        return None
+
+
+def generate_text(
+    prompt: str,
+    role: str = DEFAULT_ROLE,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    top_p: Optional[float] = None,
+    top_k: Optional[int] = None,
+    model_path: Optional[str] = None,
+    stop_sequences: Optional[list[str]] = None,
+) -> str:
+    chat = generate_chat(prompt, role, temperature, max_tokens, top_p, top_k, model_path, stop_sequences)
+    return chat.response if chat else ""
+
+
+def stream_text(
+    prompt: str,
+    role: str = DEFAULT_ROLE,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    top_p: Optional[float] = None,
+    top_k: Optional[int] = None,
+    model_path: Optional[str] = None,
+    stop_sequences: Optional[list[str]] = None,
+) -> Iterator[dict]:
+    """Streaming variant of ``generate_text``.
+
+    Yields ``{'event': 'token', 'text': ...}`` for every decoded chunk and a
+    final ``{'event': 'done', ...}`` (or ``{'event': 'error', ...}``). Closing
+    the generator early stops the llama_cpp decode loop and skips saving the
+    partial chat.
+    """
+    try:
+        params = resolve_generation_params(role, temperature, max_tokens, top_p, top_k, model_path, stop_sequences)
+    except InsufficientMemory as e:
+        yield {'event': 'error', 'error': str(e)}
+        return
+    final_model_path = params.model_path
+
+    logger.info(f"Streaming text with model: {final_model_path}, role: {role}")
+
+    chunks = []
+    timer = metrics.GenerationTimer()
+    model_prompt = retrieval.augment(prompt)
+    try:
+        with completion(model_prompt, params, timer) as stream:
+            for text in stream:
+                chunks.append(text)
+                yield {'event': 'token', 'text': text}
+    except (GeneratorExit, GenerationCancelled):
+        logger.info(f"Streaming cancelled by the client after {len(chunks)} chunks")
+        raise
+    except GenerationTimeout as e:
+        timer.fail()
+        yield {'event': 'error', 'error': str(e)}
+        return
+    except Exception as e:
+        timer.fail()
+        logger.error(f"An unexpected error occurred during streaming generation: {e}")
+        yield {'event': 'error', 'error': 'An error occurred during generation.'}
+        return
+
+    generated_text = "".join(chunks)
+    logger.info(f"Successfully streamed text of length: {len(generated_text)}")
+    response_cache.store(params, model_prompt, generated_text)
+
+    chat = _save_chat(prompt, generated_text)
+    yield {
+        'event': 'done',
+        'chat_id': chat.id,
+        'response': generated_text,
+        'timestamp': chat.timestamp.isoformat(),
+    }
+
+# --- Batch Generation ---
+# Per-item keys a batch entry may set; anything missing falls back to the shared values
+BATCH_ITEM_FIELDS = ('role', 'temperature', 'max_tokens', 'top_p', 'top_k', 'model_path', 'stop_sequences')
+
+
+def _batch_items(items: Iterable[Union[str, dict]],
+                 shared: dict) -> Iterator[tuple[str, Union[ResolvedSettings, Exception]]]:
+    for item in items:
+        if isinstance(item, str):
+            item = {'prompt': item}
+        overrides = {**shared, **{name: item[name] for name in BATCH_ITEM_FIELDS if item.get(name) is not None}}
+        overrides.setdefault('role', DEFAULT_ROLE)
+        try:
+            yield str(item.get('prompt') or ''), resolve_generation_params(**overrides)
+        except (InsufficientMemory, InvalidOverride) as e:
+            # Reported on the item so the rest of the batch can still run
+            yield str(item.get('prompt') or ''), e
+
+
+def _generate_batch_items(items: Iterable[Union[str, dict]], shared: dict) -> Iterator[dict]:
+    for index, (prompt, params) in enumerate(_batch_items(items, shared)):
+        deadline = deadlines.for_current_request()
+        if deadline.expired():
+            # Cancelled, or out of time for the whole batch: the remaining items are not started
+            deadline.raise_if_stopped()
+        result = {'index': index, 'prompt': prompt}
+        if not prompt:
+            yield dict(result, error='Prompt is required')
+            continue
+        if isinstance(params, (InsufficientMemory, InvalidOverride)):
+            yield dict(result, error=str(params))
+            continue
+
+        _, cached = response_cache.lookup(params, prompt)
+        if cached is not None:
+            yield dict(result, response=cached, cached=True)
+            continue
+
+        timer = metrics.GenerationTimer()
+        try:
+            # The model stays loaded across items; its lock is released between them so
+            # interactive requests on other workers are not shut out for the whole batch
+            with registry.use(params.model_key(), **params.load_kwargs()) as model:
+                prepared = prompt_templates.prepare(model, params, prompt)
+                output = model(prompt=prepared.tokens, stop=list(prepared.stop), echo=False,
+                               stopping_criteria=deadline, **params.sampling_kwargs())
+            deadline.raise_if_stopped()
+        except GenerationCancelled:
+            raise
+        except GenerationTimeout as e:
+            timer.fail()
+            yield dict(result, error=str(e))
+            continue
+        except Exception as e:
+            timer.fail()
+            logger.error(f"Batch item {index} failed: {e}")
+            yield dict(result, error='An error occurred during generation.')
+            continue
+
+        usage = output.get("usage", {})
+        timer.finish(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+        text = output["choices"][0]["text"]
+        response_cache.store(params, prompt, text)
+        yield dict(result, response=text, cached=False)
+
+
+def _save_batch_chats(results: list[dict]) -> list[Chat]:
+    rows = [(r['prompt'], r['response']) for r in results if 'response' in r]
+    try:
+        # Queued together, so the background writer stores them with a few multi-row INSERTs
+        chats = chat_writer.save_many(rows)
+        logger.info(f"Saved {len(chats)} batch chats")
+    except Exception as e:
+        logger.error(f"Error saving batch chats to database: {e}")
+        return []
+    return chats
+
+
+def generate_batch(items: Iterable[Union[str, dict]], **shared) -> list[dict]:
+    """Generates many prompts in one call and returns their results in input order.
+
+    ``items`` are prompt strings or dicts with a ``prompt`` and any of
+    ``BATCH_ITEM_FIELDS``; keyword arguments are shared by every item. Each
+    result has ``index`` and ``prompt`` plus either ``response``, ``cached``
+    and ``chat_id``, or ``error``. All chats are queued for the
+    background writer together.
+    """
+    results = list(_generate_batch_items(items, shared))
+    chats = iter(_save_batch_chats(results))
+    for result in results:
+        if 'response' in result:
+            chat = next(chats, None)
+            result['chat_id'] = chat.id if chat else None
+    return results
+
+
+def stream_batch(items: Iterable[Union[str, dict]], **shared) -> Iterator[dict]:
+    """Streaming variant of ``generate_batch`` yielding each result as soon as it is ready.
+
+    Chats are bulk-saved once the batch ends (or is cancelled), so streamed
+    results carry no ``chat_id``; the final ``{'done': True, ...}`` record
+    reports how many were saved.
+    """
+    results = []
+    try:
+        for result in _generate_batch_items(items, shared):
+            results.append(result)
+            yield result
+    finally:
+        saved = _save_batch_chats(results)
+    yield {'done': True, 'count': len(results), 'saved': len(saved)}
 
 # Example usage (uncomment if running this file directly for testing)
 # if __name__ == "__main__":
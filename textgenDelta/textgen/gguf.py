@@ -0,0 +1,92 @@
+import struct
+from typing import BinaryIO, Optional
+
+# Reads GGUF header metadata without loading the model (see the GGUF spec in ggml's docs/gguf.md)
+
+GGUF_MAGIC = b'GGUF'
+
+_SCALARS = {
+    0: '<B', 1: '<b', 2: '<H', 3: '<h', 4: '<I', 5: '<i', 6: '<f', 7: '<?', 10: '<Q', 11: '<q', 12: '<d',
+}
+_STRING = 8
+_ARRAY = 9
+
+# llama_ftype values stored in general.file_type
+FILE_TYPES = {
+    0: 'F32', 1: 'F16', 2: 'Q4_0', 3: 'Q4_1', 7: 'Q8_0', 8: 'Q5_0', 9: 'Q5_1', 10: 'Q2_K', 11: 'Q3_K_S',
+    12: 'Q3_K_M', 13: 'Q3_K_L', 14: 'Q4_K_S', 15: 'Q4_K_M', 16: 'Q5_K_S', 17: 'Q5_K_M', 18: 'Q6_K',
+    19: 'IQ2_XXS', 20: 'IQ2_XS', 21: 'Q2_K_S', 22: 'IQ3_XS', 23: 'IQ3_XXS', 24: 'IQ1_S', 25: 'IQ4_NL',
+    26: 'IQ3_S', 27: 'IQ3_M', 28: 'IQ2_S', 29: 'IQ2_M', 30: 'IQ4_XS', 31: 'IQ1_M', 32: 'BF16',
+}
+
+
+class GGUFError(ValueError):
+    pass
+
+
+def _read(f: BinaryIO, fmt: str):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size:
+        raise GGUFError("Unexpected end of GGUF header")
+    return struct.unpack(fmt, data)[0]
+
+
+def _read_string(f: BinaryIO) -> str:
+    length = _read(f, '<Q')
+    return f.read(length).decode('utf-8', errors='replace')
+
+
+def _skip_array(f: BinaryIO, item_type: int, count: int) -> None:
+    if item_type in _SCALARS:
+        f.seek(struct.calcsize(_SCALARS[item_type]) * count, 1)
+    elif item_type == _STRING:
+        for _ in range(count):
+            f.seek(_read(f, '<Q'), 1)
+    elif item_type == _ARRAY:
+        for _ in range(count):
+            _skip_array(f, _read(f, '<I'), _read(f, '<Q'))
+    else:
+        raise GGUFError(f"Unknown GGUF value type {item_type}")
+
+
+def _read_value(f: BinaryIO, value_type: int, keep_arrays: bool):
+    if value_type in _SCALARS:
+        return _read(f, _SCALARS[value_type])
+    if value_type == _STRING:
+        return _read_string(f)
+    if value_type == _ARRAY:
+        item_type, count = _read(f, '<I'), _read(f, '<Q')
+        if not keep_arrays:
+            # Tokenizer vocabularies run to hundreds of thousands of entries; only their length is kept
+            _skip_array(f, item_type, count)
+            return count
+        return [_read_value(f, item_type, keep_arrays) for _ in range(count)]
+    raise GGUFError(f"Unknown GGUF value type {value_type}")
+
+
+def read_metadata(path: str, keep_arrays: bool = False) -> dict:
+    """Returns the key/value metadata of a GGUF file; arrays are replaced by their length unless kept."""
+    with open(path, 'rb') as f:
+        if f.read(4) != GGUF_MAGIC:
+            raise GGUFError(f"{path} is not a GGUF file")
+        version = _read(f, '<I')
+        if version < 2:
+            raise GGUFError(f"GGUF version {version} is not supported")
+        _read(f, '<Q')  # tensor count
+        kv_count = _read(f, '<Q')
+        metadata = {'gguf.version': version}
+        for _ in range(kv_count):
+            key = _read_string(f)
+            metadata[key] = _read_value(f, _read(f, '<I'), keep_arrays)
+        return metadata
+
+
+def architecture_value(metadata: dict, name: str) -> Optional[int]:
+    """Looks up an ``<architecture>.<name>`` key such as ``llama.context_length``."""
+    return metadata.get(f"{metadata.get('general.architecture', 'llama')}.{name}")
+
+
+def quantization(metadata: dict) -> Optional[str]:
+    file_type = metadata.get('general.file_type')
+    return FILE_TYPES.get(file_type, str(file_type)) if file_type is not None else None
@@ -0,0 +1,240 @@
+import dataclasses
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from django.conf import settings
+from . import autotune, batching, gguf, metrics
+from .model_registry import ModelKey, registry
+from .settings_cache import ResolvedSettings
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Memory Governor Defaults (overridable in settings.py) ---
+DEFAULT_MEMORY_GUARD = True
+DEFAULT_MEMORY_RESERVED_MB = 384  # kept free for Android, the browser and Django itself
+DEFAULT_LARGE_MAX_TOKENS = 1024  # requests above this are refused while memory is critical
+MIN_CTX = 512
+COMPUTE_OVERHEAD_BYTES = 64 * 1024 * 1024  # graph and scratch buffers besides weights, KV cache and logits
+# ggml tensor types (llama_cpp.GGML_TYPE_*) for the KV cache; q8_0 stores 32 values in 34 bytes
+GGML_TYPE_F16 = 1
+GGML_TYPE_Q8_0 = 8
+_KV_TYPE_BYTES = {None: 2.0, GGML_TYPE_F16: 2.0, GGML_TYPE_Q8_0: 34 / 32}
+_KV_TYPE_NAMES = {None: 'f16', GGML_TYPE_F16: 'f16', GGML_TYPE_Q8_0: 'q8_0'}
+# Tried in order before the context is shrunk; a quantized V cache needs flash attention in llama.cpp
+_KV_LAYOUTS = ((None, None, False), (GGML_TYPE_Q8_0, None, False), (GGML_TYPE_Q8_0, GGML_TYPE_Q8_0, True))
+
+
+class InsufficientMemory(Exception):
+    """Raised when a model or request cannot be served without risking the OOM killer."""
+
+
+@dataclass(frozen=True)
+class MemoryPlan:
+    """Loader settings chosen for one requested model, and why they differ from the request."""
+    overrides: dict
+    required_bytes: int
+    headroom_bytes: int
+    degradations: tuple[str, ...]
+
+    def describe(self) -> dict:
+        return {
+            'model_path': self.overrides['model_path'],
+            'n_ctx': self.overrides['n_ctx'],
+            'type_k': _KV_TYPE_NAMES[self.overrides['type_k']],
+            'type_v': _KV_TYPE_NAMES[self.overrides['type_v']],
+            'use_mmap': self.overrides['use_mmap'],
+            'use_mlock': self.overrides['use_mlock'],
+            'required_mb': self.required_bytes // (1024 * 1024),
+            'degradations': list(self.degradations),
+        }
+
+
+def enabled() -> bool:
+    return getattr(settings, 'TEXTGEN_MEMORY_GUARD', DEFAULT_MEMORY_GUARD)
+
+
+def reserved_bytes() -> int:
+    return getattr(settings, 'TEXTGEN_MEMORY_RESERVED_MB', DEFAULT_MEMORY_RESERVED_MB) * 1024 * 1024
+
+
+def _mlock_allowed(size_bytes: int) -> bool:
+    try:
+        import resource
+        soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+    except (ImportError, OSError, ValueError):
+        return False
+    # Android's default limit is a few MB, in which case llama.cpp would only warn and not lock anything
+    return soft == resource.RLIM_INFINITY or soft >= size_bytes
+
+
+_metadata_cache: dict[tuple[str, float], dict] = {}
+
+
+def _metadata(model_path: str) -> dict:
+    key = (model_path, os.path.getmtime(model_path))
+    if key not in _metadata_cache:
+        try:
+            _metadata_cache[key] = gguf.read_metadata(model_path)
+        except (OSError, gguf.GGUFError) as e:
+            logger.warning(f"Could not read GGUF metadata from {model_path}, using fallbacks: {e}")
+            _metadata_cache[key] = {}
+    return _metadata_cache[key]
+
+
+def _fit(params: ResolvedSettings, headroom: int, degradations: list[str]) -> Optional[MemoryPlan]:
+    """Finds the largest context and least lossy KV cache layout of ``params`` that fits in ``headroom``."""
+    metadata = _metadata(params.model_path)
+    weights = os.path.getsize(params.model_path)
+    if params.draft_model_path and os.path.exists(params.draft_model_path):
+        weights += os.path.getsize(params.draft_model_path)
+    kv_f16_per_token = autotune.kv_cache_bytes_per_token(metadata)
+    # The batch engine keeps a second KV cache next to the model's own
+    kv_copies = 2 if batching.enabled() else 1
+    vocab = metadata.get('tokenizer.ggml.tokens') or autotune.FALLBACK_VOCAB
+    compute = vocab * params.n_batch * 4 + COMPUTE_OVERHEAD_BYTES
+
+    n_ctx = params.n_ctx
+    while True:
+        for type_k, type_v, flash_attn in _KV_LAYOUTS:
+            per_token = kv_f16_per_token / 4 * (_KV_TYPE_BYTES[type_k] + _KV_TYPE_BYTES[type_v])
+            required = int(weights + per_token * n_ctx * kv_copies + compute)
+            if required <= headroom:
+                break
+        else:
+            if n_ctx <= MIN_CTX:
+                return None
+            n_ctx = max(MIN_CTX, n_ctx // 2)
+            continue
+        break
+
+    notes = list(degradations)
+    if n_ctx < params.n_ctx:
+        notes.append(f"Context shrunk from {params.n_ctx} to {n_ctx} tokens")
+    if type_k is not None:
+        notes.append(f"KV cache quantized to {_KV_TYPE_NAMES[type_k]}/{_KV_TYPE_NAMES[type_v]}")
+
+    # With plenty of room the weights are locked so decoding never waits on page faults from storage.
+    # Otherwise, or when mlock is not permitted, they stay on plain mmap: reading them into anonymous memory
+    # instead would double peak usage while loading and leave pages the kernel cannot drop under pressure.
+    use_mmap = True
+    use_mlock = required * 2 <= headroom and _mlock_allowed(weights)
+
+    overrides = {
+        'model_path': params.model_path, 'chat_format': params.chat_format, 'n_ctx': n_ctx,
+        'speculative': params.speculative, 'draft_model_path': params.draft_model_path,
+        'type_k': type_k, 'type_v': type_v, 'flash_attn': flash_attn,
+        'use_mmap': use_mmap, 'use_mlock': use_mlock,
+    }
+    return MemoryPlan(overrides, required, headroom, tuple(notes))
+
+
+def _plan(params: ResolvedSettings) -> MemoryPlan:
+    headroom = autotune.available_memory_bytes() + registry.reclaimable_bytes() - reserved_bytes()
+    plan = _fit(params, headroom, [])
+    if plan is not None:
+        return plan
+
+    fallback_path = getattr(settings, 'TEXTGEN_FALLBACK_MODEL_PATH', None)
+    if fallback_path and fallback_path != params.model_path and os.path.exists(fallback_path):
+        fallback = dataclasses.replace(
+            params,
+            model_path=fallback_path,
+            chat_format=getattr(settings, 'TEXTGEN_FALLBACK_CHAT_FORMAT', None) or params.chat_format,
+            speculative='', draft_model_path='',
+        )
+        plan = _fit(fallback, headroom, [f"Fell back from {os.path.basename(params.model_path)} "
+                                         f"to {os.path.basename(fallback_path)}"])
+        if plan is not None:
+            return plan
+
+    raise InsufficientMemory(
+        f"Not enough memory to load {os.path.basename(params.model_path)}: "
+        f"{max(0, headroom) // (1024 * 1024)} MB available after the "
+        f"{reserved_bytes() // (1024 * 1024)} MB reserve, even at {MIN_CTX} context tokens"
+    )
+
+
+_lock = threading.Lock()
+_plans: dict[ModelKey, MemoryPlan] = {}
+_last_rejection: Optional[str] = None
+
+
+def govern(params: ResolvedSettings) -> ResolvedSettings:
+    """Returns ``params`` with loader settings that fit in the memory currently available.
+
+    A plan is made once per requested model and kept while the model it
+    chose stays loaded, so requests do not flip between configurations as
+    free memory fluctuates. Raises ``InsufficientMemory`` when nothing fits
+    or when a large ``max_tokens`` arrives while memory is critical.
+    """
+    global _last_rejection
+    if not enabled() or not os.path.exists(params.model_path):
+        return params
+    requested = params.model_key()
+    with _lock:
+        plan = _plans.get(requested)
+    try:
+        if plan is None or not registry.has(dataclasses.replace(params, **plan.overrides).model_key()):
+            plan = _plan(params)
+            with _lock:
+                _plans[requested] = plan
+            for note in plan.degradations:
+                degradations.inc()
+                logger.warning(f"Memory governor: {note}")
+        _check_request(params)
+    except InsufficientMemory as e:
+        rejections.inc()
+        _last_rejection = str(e)
+        logger.error(f"Memory governor: {e}")
+        raise
+    return dataclasses.replace(params, **plan.overrides)
+
+
+def _check_request(params: ResolvedSettings) -> None:
+    large = getattr(settings, 'TEXTGEN_LARGE_MAX_TOKENS', DEFAULT_LARGE_MAX_TOKENS)
+    if params.max_tokens > large and autotune.available_memory_bytes() < reserved_bytes():
+        raise InsufficientMemory(
+            f"Memory is nearly exhausted; requests for more than {large} tokens are refused until it frees up"
+        )
+
+
+def level(available: Optional[int] = None) -> str:
+    available = autotune.available_memory_bytes() if available is None else available
+    if available >= 2 * reserved_bytes():
+        return 'ok'
+    return 'tight' if available >= reserved_bytes() else 'critical'
+
+
+def status() -> dict:
+    """Current memory state and the plans in use, for the stats page and ``/stats/memory/``."""
+    available = autotune.available_memory_bytes()
+    with _lock:
+        plans = [plan.describe() for plan in _plans.values()]
+    return {
+        'enabled': enabled(),
+        'level': level(available),
+        'available_mb': available // (1024 * 1024),
+        'reserved_mb': reserved_bytes() // (1024 * 1024),
+        'resident_mb': (metrics.resident_memory_bytes() or 0) // (1024 * 1024),
+        'plans': plans,
+        'degraded': any(plan['degradations'] for plan in plans),
+        'last_rejection': _last_rejection,
+    }
+
+
+def invalidate() -> None:
+    with _lock:
+        _plans.clear()
+
+
+rejections = metrics.registry.counter(
+    'textgen_memory_rejections_total', 'Requests refused because memory was too low.')
+degradations = metrics.registry.counter(
+    'textgen_memory_degradations_total', 'Times a model was loaded with a smaller context, quantized KV cache '
+                                         'or the fallback model.')
+metrics.registry.gauge('textgen_memory_available_bytes', 'Memory available to the process (MemAvailable).',
+                       autotune.available_memory_bytes)
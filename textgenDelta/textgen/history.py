@@ -0,0 +1,75 @@
+import base64
+import binascii
+from datetime import datetime
+from typing import Optional
+from django.db.models.functions import Substr
+from .models import Chat
+
+
+# --- History Pagination Defaults ---
+DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+PREVIEW_CHARS = 30
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp: datetime, chat_id: int) -> str:
+    raw = f"{timestamp.isoformat()}|{chat_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, chat_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(chat_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor(f"Malformed history cursor: {cursor!r}") from e
+
+
+def _preview(text: str) -> str:
+    # Mirrors the |truncatechars:30 filter the sidebar template used to apply
+    return text if len(text) <= PREVIEW_CHARS else text[:PREVIEW_CHARS - 1] + '…'
+
+
+def _page_queryset(cursor: Optional[str], limit: int):
+    chats = Chat.objects.order_by('-timestamp', '-id')
+    if cursor:
+        timestamp, chat_id = decode_cursor(cursor)
+        # Written as a range on timestamp (not an OR) so SQLite can seek into the index
+        chats = chats.filter(timestamp__lte=timestamp).exclude(timestamp=timestamp, id__gte=chat_id)
+    # Fetch one extra row to learn whether another page exists
+    return chats.annotate(prompt_start=Substr('prompt', 1, PREVIEW_CHARS + 1)) \
+        .values('id', 'timestamp', 'prompt_start')[:limit + 1]
+
+
+def _build_page(rows: list[dict], limit: int) -> tuple[list[dict], Optional[str]]:
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = [
+        {'id': row['id'], 'preview': _preview(row['prompt_start']), 'timestamp': row['timestamp']}
+        for row in rows
+    ]
+    next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id']) if has_more else None
+    return items, next_cursor
+
+
+def chat_page(cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> tuple[list[dict], Optional[str]]:
+    """Returns one page of chat previews, newest first, and the cursor for the next page.
+
+    Pages are addressed by the (timestamp, id) of the last row seen rather than
+    an OFFSET, so every page is a single range scan of chat_timestamp_id_idx
+    no matter how deep into the history it is. Only the first characters of
+    the prompt are read from the database.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return _build_page(list(_page_queryset(cursor, limit)), limit)
+
+
+async def achat_page(cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> tuple[list[dict], Optional[str]]:
+    """Async ORM variant of ``chat_page`` for ASGI views."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return _build_page([row async for row in _page_queryset(cursor, limit)], limit)
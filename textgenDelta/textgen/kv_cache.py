@@ -0,0 +1,114 @@
+import logging
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional, Sequence
+from django.conf import settings
+from . import metrics
+
+if TYPE_CHECKING:
+    import llama_cpp
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Prefix Cache Defaults (overridable in settings.py) ---
+DEFAULT_KV_CACHE = 'ram'  # 'ram', 'disk' or None to disable
+DEFAULT_KV_CACHE_MB = 512
+DEFAULT_KV_CACHE_DIR = '.kv_cache'
+
+
+class PrefixCacheStats:
+    """Process-wide hit/miss counters for the prompt-prefix state cache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.lookup_tokens = 0
+
+    def record(self, prompt_tokens: int, reused_tokens: int) -> None:
+        with self._lock:
+            if reused_tokens:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.reused_tokens += reused_tokens
+            self.lookup_tokens += prompt_tokens
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                # Tokens whose prompt evaluation was skipped thanks to a restored state
+                'reused_tokens': self.reused_tokens,
+                'lookup_tokens': self.lookup_tokens,
+            }
+
+
+stats = PrefixCacheStats()
+metrics.registry.gauge('textgen_prefix_cache_hit_ratio', 'Share of prompts that reused a cached KV prefix.',
+                       lambda: stats.snapshot()['hit_rate'])
+metrics.registry.gauge('textgen_prefix_cache_reused_tokens', 'Prompt tokens restored from the KV prefix cache.',
+                       lambda: stats.snapshot()['reused_tokens'])
+
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class _CountingCacheMixin:
+    # llama_cpp looks the prompt tokens up before evaluating them and stores
+    # prompt + completion afterwards, so every lookup is one hit or one miss
+    def __getitem__(self, key: Sequence[int]) -> "llama_cpp.LlamaState":
+        try:
+            state = super().__getitem__(key)
+        except KeyError:
+            stats.record(len(key), 0)
+            raise
+        reused = _common_prefix_length(state.input_ids.tolist(), key)
+        stats.record(len(key), reused)
+        logger.debug(f"Prefix cache hit: reusing {reused}/{len(key)} prompt tokens")
+        return state
+
+
+@lru_cache(maxsize=None)
+def _counting_cache_class(kind: str) -> type:
+    # Built on first use so importing this module does not load the llama.cpp library
+    import llama_cpp
+    base = llama_cpp.LlamaDiskCache if kind == 'disk' else llama_cpp.LlamaRAMCache
+    return type(f"Counting{base.__name__.removeprefix('Llama')}", (_CountingCacheMixin, base), {})
+
+
+def build_prefix_cache() -> Optional["llama_cpp.BaseLlamaCache"]:
+    """Creates the state cache configured in settings, or None when disabled."""
+    kind = getattr(settings, 'TEXTGEN_KV_CACHE', DEFAULT_KV_CACHE)
+    if not kind:
+        return None
+    capacity_bytes = int(getattr(settings, 'TEXTGEN_KV_CACHE_MB', DEFAULT_KV_CACHE_MB) * 1024 * 1024)
+    if kind == 'disk':
+        # LlamaDiskCache needs the optional ``diskcache`` package
+        cache_dir = str(getattr(settings, 'TEXTGEN_KV_CACHE_DIR', DEFAULT_KV_CACHE_DIR))
+        return _counting_cache_class('disk')(cache_dir=cache_dir, capacity_bytes=capacity_bytes)
+    if kind == 'ram':
+        return _counting_cache_class('ram')(capacity_bytes=capacity_bytes)
+    raise ValueError(f"Unknown TEXTGEN_KV_CACHE backend: {kind!r}")
+
+
+def attach_prefix_cache(model: "llama_cpp.Llama") -> None:
+    try:
+        cache = build_prefix_cache()
+    except Exception as e:
+        logger.error(f"Could not create the prompt prefix cache, continuing without it: {e}")
+        return
+    if cache is not None:
+        model.set_cache(cache)
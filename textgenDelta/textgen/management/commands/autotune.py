@@ -0,0 +1,44 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from textgen import autotune, settings_cache
+from textgen.models import TextGenerationSettings
+
+
+class Command(BaseCommand):
+    help = "Measures this device and a model file and stores the loader parameters to use for it."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model-path', help="Model to tune (default: the default settings' model).")
+        parser.add_argument('--calibrate', action='store_true',
+                            help="Load the model with several thread counts and keep the fastest.")
+        parser.add_argument('--enable', action='store_true',
+                            help="Turn on auto_tune for the settings rows that use this model.")
+
+    def handle(self, *args, **options):
+        model_path = options['model_path'] or settings_cache.ensure_default_settings().model_path
+        if not os.path.exists(model_path):
+            raise CommandError(f"Model file not found: {model_path}")
+
+        cpu = autotune.detect_cpu()
+        clusters = ", ".join(f"{count}x{freq // 1000}MHz" for freq, count in cpu.clusters) or "unknown"
+        self.stdout.write(f"CPU: {cpu.cpu_count} cores ({clusters}), {cpu.performance_cores} performance cores")
+        self.stdout.write(f"Available memory: {autotune.available_memory_bytes() / 2**20:.0f} MB")
+        if options['calibrate']:
+            self.stdout.write("Running calibration sweep, this loads the model several times...")
+
+        profile = autotune.build_profile(model_path, run_calibration=options['calibrate'])
+        self.stdout.write(f"Model: {profile.architecture or 'unknown'} {profile.quantization}, "
+                          f"{profile.n_layers} layers, trained context {profile.trained_n_ctx}")
+        self.stdout.write(self.style.SUCCESS(
+            f"n_threads={profile.n_threads} n_threads_batch={profile.n_threads_batch} n_batch={profile.n_batch} "
+            f"n_ctx={profile.n_ctx} n_gpu_layers={profile.n_gpu_layers}"
+        ))
+        if profile.calibrated_tokens_per_second is not None:
+            self.stdout.write(f"Calibrated speed: {profile.calibrated_tokens_per_second:.2f} tokens/s")
+
+        if options['enable']:
+            # Saving each row (not update()) fires the signal that clears the settings cache
+            for row in TextGenerationSettings.objects.filter(model_path=model_path):
+                row.auto_tune = True
+                row.save(update_fields=['auto_tune'])
+                self.stdout.write(f"Enabled auto_tune for settings '{row.identifier}'")
@@ -0,0 +1,217 @@
+import json
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from textgen import response_cache
+from textgen.generation import DEFAULT_ROLE, resolve_generation_params, stream_text
+from textgen.model_registry import registry
+from textgen.models import Chat
+from textgen.persistence import chat_writer
+from textgen.stub_backend import StubLlama
+
+# Fixed corpus so runs are comparable; mixes short questions with longer instructions
+DEFAULT_CORPUS = (
+    "What is the capital of France?",
+    "Explain the concept of gravity in simple terms.",
+    "Write a haiku about a phone running a language model.",
+    "List three ways to save battery on an Android phone.",
+    "Summarize the plot of Romeo and Juliet in two sentences.",
+    "Translate 'good morning, how are you?' into Russian.",
+    "What is the difference between RAM and storage?",
+    "Give me a short recipe for pancakes.",
+    "Why is the sky blue? Answer for a ten year old.",
+    "Write a Python function that reverses a string.",
+    "Describe the water cycle step by step, mentioning evaporation, condensation and precipitation.",
+    "Suggest a name for a cat that likes to sleep on keyboards.",
+)
+
+
+def _percentile(values: list[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+
+def _summarize(samples: list[dict], wall_seconds: float) -> dict:
+    ok = [s for s in samples if not s['error']]
+    latencies = [s['latency'] for s in ok]
+    ttfts = [s['ttft'] for s in ok if s['ttft'] is not None]
+    rates = [s['tokens_per_second'] for s in ok if s['tokens_per_second'] is not None]
+    tokens = sum(s['tokens'] for s in ok)
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'latency': {'p50': _percentile(latencies, 0.5), 'p95': _percentile(latencies, 0.95),
+                    'p99': _percentile(latencies, 0.99), 'max': max(latencies, default=None)},
+        'ttft': {'p50': _percentile(ttfts, 0.5), 'p95': _percentile(ttfts, 0.95), 'p99': _percentile(ttfts, 0.99)},
+        'tokens_per_second': {'p50': _percentile(rates, 0.5), 'mean': sum(rates) / len(rates) if rates else None},
+        'throughput': {'requests_per_second': len(ok) / wall_seconds if wall_seconds else None,
+                       'tokens_per_second': tokens / wall_seconds if wall_seconds else None},
+        'wall_seconds': wall_seconds,
+    }
+
+
+def _sample(started: float, first_token_at: Optional[float], tokens: int, error: Optional[str]) -> dict:
+    finished = time.perf_counter()
+    generating = finished - first_token_at if first_token_at is not None else 0
+    return {
+        'latency': finished - started,
+        'ttft': first_token_at - started if first_token_at is not None else None,
+        'tokens': tokens,
+        'tokens_per_second': (tokens - 1) / generating if tokens > 1 and generating > 0 else None,
+        'error': error,
+    }
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the generation pipeline (Python API and HTTP views) with a fixed prompt corpus "
+            "and writes the results as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=['python', 'http', 'both'], default='both')
+        parser.add_argument('--concurrency', type=int, default=1, help="Requests in flight at once.")
+        parser.add_argument('--requests', type=int, help="Warm requests per target (default: corpus size).")
+        parser.add_argument('--max-tokens', type=int, default=32)
+        parser.add_argument('--corpus', help="Text file with one prompt per line instead of the built-in corpus.")
+        parser.add_argument('--model-path', help="Model to benchmark (default: the 'user' role's settings).")
+        parser.add_argument('--stub', action='store_true',
+                            help="Use a deterministic stub backend instead of llama_cpp (no model file needed).")
+        parser.add_argument('--stub-token-ms', type=float, default=50.0)
+        parser.add_argument('--stub-prompt-token-ms', type=float, default=2.0)
+        parser.add_argument('--output', help="Write JSON results to this file (default: stdout only).")
+        parser.add_argument('--keep-chats', action='store_true', help="Keep the chats created by the run.")
+
+    def handle(self, *args, **options):
+        corpus = self._load_corpus(options['corpus'])
+        total = options['requests'] or len(corpus)
+        prompts = [corpus[i % len(corpus)] for i in range(total)]
+        kwargs = {'max_tokens': options['max_tokens'], 'model_path': options['model_path']}
+        targets = ['python', 'http'] if options['target'] == 'both' else [options['target']]
+
+        params = resolve_generation_params(DEFAULT_ROLE, max_tokens=options['max_tokens'],
+                                           model_path=options['model_path'])
+        report = {
+            'run': {
+                'started_at': timezone.now().isoformat(),
+                'backend': 'stub' if options['stub'] else 'llama_cpp',
+                'model_path': params.model_path,
+                'chat_format': params.chat_format,
+                'n_ctx': params.n_ctx,
+                'n_threads': params.n_threads,
+                'n_batch': params.n_batch,
+                'n_gpu_layers': params.n_gpu_layers,
+                'max_tokens': params.max_tokens,
+                'concurrency': options['concurrency'],
+                'requests': total,
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+            },
+            'results': {},
+        }
+
+        original_cache = response_cache.cache
+        last_chat_id = Chat.objects.aggregate(last=Max('id'))['last'] or 0
+        if options['stub']:
+            registry.loader = partial(StubLlama, token_seconds=options['stub_token_ms'] / 1000,
+                                      prompt_token_seconds=options['stub_prompt_token_ms'] / 1000)
+        # Cached answers would measure the cache, not the model
+        response_cache.cache = None
+        try:
+            # The test client talks to the views in-process, as host "testserver"
+            with override_settings(ALLOWED_HOSTS=['*']):
+                for target in targets:
+                    report['results'][target] = self._bench_target(target, prompts, kwargs, options['concurrency'])
+        finally:
+            if options['stub']:
+                registry.loader = None  # back to llama_cpp.Llama
+            response_cache.cache = original_cache
+            registry.clear()
+            if not options['keep_chats']:
+                chat_writer.flush()
+                Chat.objects.filter(id__gt=last_chat_id).delete()
+
+        self._print_report(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def _load_corpus(self, path: Optional[str]) -> list[str]:
+        if not path:
+            return list(DEFAULT_CORPUS)
+        try:
+            with open(path, encoding='utf-8') as corpus_file:
+                prompts = [line.strip() for line in corpus_file if line.strip()]
+        except OSError as e:
+            raise CommandError(f"Cannot read corpus {path}: {e}")
+        if not prompts:
+            raise CommandError(f"Corpus {path} contains no prompts")
+        return prompts
+
+    def _bench_target(self, target: str, prompts: list[str], kwargs: dict, concurrency: int) -> dict:
+        run_one = self._run_python if target == 'python' else self._run_http
+        self.stdout.write(f"[{target}] cold request (model load included)...")
+        registry.clear()
+        cold = run_one(prompts[0], kwargs)
+
+        self.stdout.write(f"[{target}] {len(prompts)} warm requests, concurrency {concurrency}...")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            samples = list(pool.map(lambda prompt: run_one(prompt, kwargs), prompts))
+        summary = _summarize(samples, time.perf_counter() - started)
+        summary['cold'] = cold
+        return summary
+
+    def _run_python(self, prompt: str, kwargs: dict) -> dict:
+        # stream_text is the streaming path generate_text joins; it exposes the first token
+        started, first_token_at, tokens, error = time.perf_counter(), None, 0, None
+        for event in stream_text(prompt=prompt, **kwargs):
+            if event['event'] == 'token':
+                first_token_at = first_token_at or time.perf_counter()
+                tokens += 1
+            elif event['event'] == 'error':
+                error = event['error']
+        return _sample(started, first_token_at, tokens, error)
+
+    def _run_http(self, prompt: str, kwargs: dict) -> dict:
+        client = Client()
+        started, first_token_at, tokens, error = time.perf_counter(), None, 0, None
+        response = client.post(reverse('textgen:generate_stream'),
+                               json.dumps({'prompt': prompt, **kwargs}), content_type='application/json')
+        if response.status_code != 200:
+            return _sample(started, None, 0, f"HTTP {response.status_code}")
+        for frame in response.streaming_content:
+            frame = frame.decode() if isinstance(frame, bytes) else frame
+            if frame.startswith('event: token'):
+                first_token_at = first_token_at or time.perf_counter()
+                tokens += 1
+            elif frame.startswith('event: error'):
+                error = frame
+        return _sample(started, first_token_at, tokens, error)
+
+    def _print_report(self, report: dict) -> None:
+        def fmt(value: Optional[float], unit: str = 's') -> str:
+            return '-' if value is None else f"{value:.3f}{unit}"
+
+        run = report['run']
+        self.stdout.write(f"Backend {run['backend']}: {run['model_path']} (n_ctx={run['n_ctx']}, "
+                          f"n_threads={run['n_threads']}, n_batch={run['n_batch']})")
+        for target, result in report['results'].items():
+            cold = result['cold']
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{target}:"))
+            self.stdout.write(f"  cold     latency {fmt(cold['latency'])}  ttft {fmt(cold['ttft'])}")
+            self.stdout.write(f"  warm     latency p50 {fmt(result['latency']['p50'])}  p95 {fmt(result['latency']['p95'])}"
+                              f"  p99 {fmt(result['latency']['p99'])}")
+            self.stdout.write(f"  ttft     p50 {fmt(result['ttft']['p50'])}  p95 {fmt(result['ttft']['p95'])}")
+            self.stdout.write(f"  tokens/s p50 {fmt(result['tokens_per_second']['p50'], '')}  aggregate "
+                              f"{fmt(result['throughput']['tokens_per_second'], '')}")
+            self.stdout.write(f"  errors   {result['errors']}/{result['requests']}")
@@ -0,0 +1,39 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from textgen import transfer
+
+
+class Command(BaseCommand):
+    help = ("Exports chat history (and generation settings) as compressed JSON lines, "
+            "optionally only the chats since a timestamp.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', default='-',
+                            help="Archive to write, e.g. history.jsonl.gz (default: stdout).")
+        parser.add_argument('--format', choices=transfer.CODECS,
+                            help="Compression (default: from the output's extension, else gzip).")
+        parser.add_argument('--since', help="Only chats at or after this ISO date/time, for incremental exports.")
+        parser.add_argument('--no-settings', action='store_true', help="Leave out the settings rows.")
+        parser.add_argument('--chunk-size', type=int, default=transfer.DEFAULT_CHUNK_SIZE,
+                            help="Rows read from the database at a time.")
+
+    def handle(self, *args, **options):
+        output = options['output']
+        codec = options['format'] or transfer.codec_for_filename(output)
+        try:
+            since = transfer.parse_since(options['since'])
+            transfer.check_codec(codec)
+        except transfer.TransferError as e:
+            raise CommandError(str(e))
+
+        kwargs = {'codec': codec, 'since': since, 'include_settings': not options['no_settings'],
+                  'chunk_size': max(1, options['chunk_size'])}
+        if output == '-':
+            written = transfer.export_to_file(sys.stdout.buffer, **kwargs)
+            sys.stdout.buffer.flush()
+            log = self.stderr
+        else:
+            with open(output, 'wb') as fileobj:
+                written = transfer.export_to_file(fileobj, **kwargs)
+            log = self.stdout
+        log.write(self.style.SUCCESS(f"Exported {written / 1024:.1f} KB ({codec}) to {output}"))
@@ -0,0 +1,40 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from textgen import transfer
+
+
+class Command(BaseCommand):
+    help = ("Imports chat history exported by export_history (gzip, zstd or plain JSON lines). "
+            "Chats already present are skipped, so an interrupted import can be run again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive', help="Archive to read, or - for stdin.")
+        parser.add_argument('--batch-size', type=int, default=transfer.DEFAULT_IMPORT_BATCH_SIZE,
+                            help="Chats written per INSERT and transaction.")
+        parser.add_argument('--overwrite-settings', action='store_true',
+                            help="Replace settings rows with the same identifier instead of keeping them.")
+
+    def handle(self, *args, **options):
+        kwargs = {'batch_size': max(1, options['batch_size']), 'overwrite_settings': options['overwrite_settings']}
+        try:
+            if options['archive'] == '-':
+                result = transfer.import_stream(transfer.read_chunks(sys.stdin.buffer), **kwargs)
+            else:
+                with open(options['archive'], 'rb') as fileobj:
+                    result = transfer.import_stream(transfer.read_chunks(fileobj), **kwargs)
+        except OSError as e:
+            raise CommandError(f"Could not read {options['archive']}: {e}")
+        except transfer.TransferError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Chats: {result.chats_created} imported, {result.chats_skipped} already present. "
+            f"Settings: {result.settings_created} imported, {result.settings_updated} replaced, "
+            f"{result.settings_skipped} kept."
+        ))
+        if result.last_timestamp:
+            self.stdout.write(f"Newest chat: {result.last_timestamp.isoformat()} "
+                              f"(export with --since {result.last_timestamp.isoformat()} to continue from here)")
+        if not result.complete:
+            self.stdout.write(self.style.WARNING(
+                "The archive ended early (no end record); what was read has been imported."))
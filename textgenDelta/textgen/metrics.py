@@ -0,0 +1,219 @@
+import bisect
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+# --- Metrics Defaults ---
+# Recent observations kept per histogram for the percentiles on the stats page
+RECENT_SAMPLES = 256
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+RATE_BUCKETS = (0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0, 256.0, 512.0)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+class Gauge:
+    """A value read from ``read()`` at scrape time, so nothing is tracked between scrapes."""
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], Optional[float]]):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def render(self) -> list[str]:
+        value = self.read()
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    """Cumulative bucket counts plus a ring buffer of recent samples; both have a fixed size."""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...]):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self._recent: deque[float] = deque(maxlen=RECENT_SAMPLES)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._recent.append(value)
+            self.count += 1
+            self.sum += value
+
+    def summary(self) -> dict:
+        with self._lock:
+            recent = sorted(self._recent)
+            count, total = self.count, self.sum
+
+        def percentile(p: float) -> Optional[float]:
+            return recent[min(len(recent) - 1, int(p * len(recent)))] if recent else None
+
+        return {
+            'count': count,
+            'mean': total / count if count else None,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'max': recent[-1] if recent else None,
+        }
+
+    def render(self) -> list[str]:
+        with self._lock:
+            counts, count, total = list(self._counts), self.count, self.sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], Optional[float]]) -> Gauge:
+        return self._metrics.setdefault(name, Gauge(name, help_text, read))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple[float, ...]) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Plain values for the stats page: summaries for histograms, current values otherwise."""
+        snapshot = {}
+        for name, metric in self._metrics.items():
+            if isinstance(metric, Histogram):
+                snapshot[name] = metric.summary()
+            elif isinstance(metric, Counter):
+                snapshot[name] = metric.value
+            else:
+                snapshot[name] = metric.read()
+        return snapshot
+
+
+def resident_memory_bytes() -> Optional[int]:
+    # /proc is available on Linux and Android (Termux); elsewhere fall back to the peak RSS
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return None
+
+
+registry = MetricsRegistry()
+
+# --- Inference ---
+prompt_tokens_per_second = registry.histogram(
+    'textgen_prompt_tokens_per_second', 'Prompt tokens processed per second before the first output token.',
+    RATE_BUCKETS)
+generation_tokens_per_second = registry.histogram(
+    'textgen_generation_tokens_per_second', 'Output tokens generated per second after the first one.',
+    RATE_BUCKETS)
+time_to_first_token = registry.histogram(
+    'textgen_time_to_first_token_seconds', 'Time from starting inference to the first output token.',
+    LATENCY_BUCKETS)
+generation_seconds = registry.histogram(
+    'textgen_generation_seconds', 'Wall time of one completion, prompt evaluation included.', LATENCY_BUCKETS)
+queue_wait = registry.histogram(
+    'textgen_queue_wait_seconds', 'Time a request waited for an inference worker.', LATENCY_BUCKETS)
+generations = registry.counter('textgen_generations_total', 'Completions that finished successfully.')
+generation_errors = registry.counter('textgen_generation_errors_total', 'Completions that failed.')
+prompt_tokens = registry.counter('textgen_prompt_tokens_total', 'Prompt tokens sent to the model.')
+completion_tokens = registry.counter('textgen_completion_tokens_total', 'Tokens generated by the model.')
+generations_cancelled = registry.counter(
+    'textgen_generations_cancelled_total',
+    'Requests cancelled, or abandoned by a disconnecting client, before they finished.')
+deadline_stops = registry.counter(
+    'textgen_generation_deadline_stops_total',
+    'Completions stopped early for running past their deadline or below the tokens/s floor.')
+
+# --- Models ---
+model_load_seconds = registry.histogram(
+    'textgen_model_load_seconds', 'Time taken to load a model into memory.', LATENCY_BUCKETS)
+model_loads = registry.counter('textgen_model_loads_total', 'Models loaded into the registry.')
+model_evictions = registry.counter('textgen_model_evictions_total', 'Models evicted from the registry.')
+
+# --- Retrieval ---
+retrieval_seconds = registry.histogram(
+    'textgen_retrieval_seconds', 'Time taken to embed a prompt and find related earlier chats.', LATENCY_BUCKETS)
+
+registry.gauge('process_resident_memory_bytes', 'Resident memory size of this process in bytes.',
+               resident_memory_bytes)
+
+
+class GenerationTimer:
+    """Times one completion; call ``token()`` per streamed chunk and ``finish()`` at the end."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.chunks = 0
+        # Known once finish() ran; used to report usage to API clients
+        self.prompt_token_count = 0
+        self.completion_token_count = 0
+
+    def token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.chunks += 1
+
+    def finish(self, prompt_token_count: int, completion_token_count: Optional[int] = None) -> None:
+        finished = time.perf_counter()
+        completion_token_count = self.chunks if completion_token_count is None else completion_token_count
+        self.prompt_token_count = prompt_token_count
+        self.completion_token_count = completion_token_count
+        generations.inc()
+        prompt_tokens.inc(prompt_token_count)
+        completion_tokens.inc(completion_token_count)
+        generation_seconds.observe(finished - self.started)
+        if self.first_token_at is None:
+            # Not streamed, so prompt evaluation and generation cannot be told apart
+            return
+        ttft = self.first_token_at - self.started
+        time_to_first_token.observe(ttft)
+        if prompt_token_count and ttft > 0:
+            prompt_tokens_per_second.observe(prompt_token_count / ttft)
+        if completion_token_count > 1 and finished > self.first_token_at:
+            generation_tokens_per_second.observe((completion_token_count - 1) / (finished - self.first_token_at))
+
+    def fail(self) -> None:
+        generation_errors.inc()
@@ -0,0 +1,50 @@
+# Generated by Django 5.1 on 2026-10-17 11:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('textgen', '0003_textgenerationsettings_identifier_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(blank=True, max_length=200)),
+                ('system_prompt', models.TextField(blank=True)),
+                ('system_token_count', models.PositiveIntegerField(default=0)),
+                ('window_start', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['-updated_at'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='textgenerationsettings',
+            name='model_path',
+            field=models.CharField(default='"/sdcard/fuji/qwen2.5-1.5b-instruct-q4_k_m.gguf" or "/sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf"', max_length=200),
+        ),
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('role', models.CharField(choices=[('system', 'System'), ('user', 'User'), ('assistant', 'Assistant')], max_length=20)),
+                ('content', models.TextField()),
+                ('token_count', models.PositiveIntegerField(default=0)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='textgen.conversation')),
+            ],
+            options={
+                'ordering': ['position'],
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'position'), name='unique_message_position')],
+            },
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.1 on 2026-10-17 11:29
+
+from django.db import migrations, models
+
+OLD_PLACEHOLDER_MODEL_PATH = '"/sdcard/fuji/qwen2.5-1.5b-instruct-q4_k_m.gguf" or "/sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf"'
+
+
+def replace_placeholder_model_path(apps, schema_editor):
+    # model_path is now read from the settings row, so the old descriptive default must become a real path
+    TextGenerationSettings = apps.get_model('textgen', 'TextGenerationSettings')
+    TextGenerationSettings.objects.filter(model_path=OLD_PLACEHOLDER_MODEL_PATH).update(
+        model_path='/sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf',
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('textgen', '0004_conversation_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='chat_format',
+            field=models.CharField(default='saiga', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='n_batch',
+            field=models.IntegerField(default=512),
+        ),
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='n_ctx',
+            field=models.IntegerField(default=4096),
+        ),
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='n_gpu_layers',
+            field=models.IntegerField(default=-1),
+        ),
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='n_threads',
+            field=models.IntegerField(default=4),
+        ),
+        migrations.AlterField(
+            model_name='textgenerationsettings',
+            name='model_path',
+            field=models.CharField(default='/sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf', max_length=200),
+        ),
+        migrations.RunPython(replace_placeholder_model_path, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1 on 2026-10-17 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('textgen', '0005_textgenerationsettings_loader_fields'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='chat',
+            options={'ordering': ['-timestamp', '-id']},
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['-timestamp', '-id'], name='chat_timestamp_id_idx'),
+        ),
+    ]
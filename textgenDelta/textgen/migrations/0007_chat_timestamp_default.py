@@ -0,0 +1,19 @@
+# Generated by Django 5.1 on 2026-10-17 11:37
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('textgen', '0006_chat_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chat',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
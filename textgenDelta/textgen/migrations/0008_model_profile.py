@@ -0,0 +1,45 @@
+# Generated by Django 5.1 on 2026-10-17 11:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('textgen', '0007_chat_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModelProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_path', models.CharField(max_length=200, unique=True)),
+                ('file_size', models.BigIntegerField()),
+                ('file_mtime', models.FloatField()),
+                ('cpu_count', models.PositiveIntegerField()),
+                ('memory_bytes', models.BigIntegerField()),
+                ('architecture', models.CharField(blank=True, max_length=50)),
+                ('quantization', models.CharField(blank=True, max_length=20)),
+                ('n_layers', models.PositiveIntegerField(default=0)),
+                ('trained_n_ctx', models.PositiveIntegerField(default=0)),
+                ('n_threads', models.IntegerField()),
+                ('n_threads_batch', models.IntegerField()),
+                ('n_batch', models.IntegerField()),
+                ('n_ctx', models.IntegerField()),
+                ('n_gpu_layers', models.IntegerField()),
+                ('calibrated_tokens_per_second', models.FloatField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='auto_tune',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='n_threads_batch',
+            field=models.IntegerField(default=0),
+        ),
+    ]
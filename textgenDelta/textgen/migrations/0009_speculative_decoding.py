@@ -0,0 +1,28 @@
+# Generated by Django 5.1 on 2026-10-17 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('textgen', '0008_model_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='draft_model_path',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='draft_tokens',
+            field=models.IntegerField(default=10),
+        ),
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='speculative',
+            field=models.CharField(blank=True, choices=[('', 'Off'), ('prompt_lookup', 'Prompt lookup'), ('draft_model', 'Draft model')], default='', max_length=20),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations
+
+# External-content FTS5 index over Chat.prompt/Chat.response (see textgen/search.py). The triggers
+# keep it in sync with every write, including the write-behind buffer's bulk inserts.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE textgen_chat_fts USING fts5(
+        prompt, response,
+        content='textgen_chat', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER textgen_chat_fts_insert AFTER INSERT ON textgen_chat BEGIN
+        INSERT INTO textgen_chat_fts(rowid, prompt, response) VALUES (new.id, new.prompt, new.response);
+    END
+    """,
+    """
+    CREATE TRIGGER textgen_chat_fts_delete AFTER DELETE ON textgen_chat BEGIN
+        INSERT INTO textgen_chat_fts(textgen_chat_fts, rowid, prompt, response)
+        VALUES ('delete', old.id, old.prompt, old.response);
+    END
+    """,
+    """
+    CREATE TRIGGER textgen_chat_fts_update AFTER UPDATE OF prompt, response ON textgen_chat BEGIN
+        INSERT INTO textgen_chat_fts(textgen_chat_fts, rowid, prompt, response)
+        VALUES ('delete', old.id, old.prompt, old.response);
+        INSERT INTO textgen_chat_fts(rowid, prompt, response) VALUES (new.id, new.prompt, new.response);
+    END
+    """,
+    # Index the chats stored before this migration
+    "INSERT INTO textgen_chat_fts(textgen_chat_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS textgen_chat_fts_update",
+    "DROP TRIGGER IF EXISTS textgen_chat_fts_delete",
+    "DROP TRIGGER IF EXISTS textgen_chat_fts_insert",
+    "DROP TABLE IF EXISTS textgen_chat_fts",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('textgen', '0009_speculative_decoding'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_SQL, reverse_sql=DROP_SQL),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-17 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('textgen', '0010_chat_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textgenerationsettings',
+            name='system_prompt',
+            field=models.TextField(blank=True),
+        ),
+    ]
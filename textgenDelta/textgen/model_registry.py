@@ -0,0 +1,249 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+from django.conf import settings
+from . import batching, metrics, prompt_templates, speculative
+from .kv_cache import attach_prefix_cache
+
+if TYPE_CHECKING:
+    import llama_cpp
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Registry Defaults (overridable in settings.py) ---
+DEFAULT_MAX_LOADED_MODELS = 1
+DEFAULT_MODEL_MEMORY_BUDGET_MB = None  # None means "only limit by model count"
+
+
+@dataclass(frozen=True)
+class ModelKey:
+    """Everything that makes two loaded ``Llama`` instances non-interchangeable."""
+    model_path: str
+    chat_format: str
+    n_ctx: int
+    n_threads: int
+    n_gpu_layers: int
+    n_batch: int
+    n_threads_batch: int = 0
+    # The draft is a Llama constructor argument, so speculative settings select a separate instance
+    speculative: str = ''
+    draft_model_path: str = ''
+    draft_tokens: int = 0
+    # Chosen by the memory governor (see governor.py); type_k/type_v None means llama.cpp's f16 default
+    use_mmap: bool = True
+    use_mlock: bool = False
+    type_k: Optional[int] = None
+    type_v: Optional[int] = None
+    flash_attn: bool = False
+
+
+class _LoadedModel:
+    def __init__(self, model: "llama_cpp.Llama", size_bytes: int):
+        self.model = model
+        self.size_bytes = size_bytes
+        # llama_cpp contexts are not thread-safe, so every use of a model is serialized
+        self.lock = threading.RLock()
+        # Started on first use when TEXTGEN_PARALLEL_SEQUENCES > 1 (see batching.py)
+        self.engine: Optional[batching.BatchEngine] = None
+
+    def close(self) -> None:
+        if self.engine is not None:
+            self.engine.close()
+
+
+class ModelRegistry:
+    """Keeps loaded ``Llama`` instances alive for the life of the process.
+
+    Models are kept in least-recently-used order and evicted once either
+    ``max_models`` or ``memory_budget_bytes`` (estimated from the GGUF file
+    size) is exceeded. Concurrent requests for a model that is still loading
+    wait for the first load instead of loading it a second time.
+    """
+
+    def __init__(self, max_models: int = DEFAULT_MAX_LOADED_MODELS, memory_budget_bytes: Optional[int] = None,
+                 loader: Optional[Callable[..., "llama_cpp.Llama"]] = None):
+        self.max_models = max(1, max_models)
+        self.memory_budget_bytes = memory_budget_bytes
+        self._loader = loader
+        self._models: "OrderedDict[ModelKey, _LoadedModel]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: dict[ModelKey, threading.Lock] = {}
+
+    @property
+    def loader(self) -> Callable[..., "llama_cpp.Llama"]:
+        """Builds a model from ModelKey fields; swapped for a stub by ``manage.py bench --stub``."""
+        if self._loader is None:
+            # Imported on first use: loading the native library is only worth it on the inference path
+            import llama_cpp
+            self._loader = llama_cpp.Llama
+        return self._loader
+
+    @loader.setter
+    def loader(self, loader: Optional[Callable[..., "llama_cpp.Llama"]]) -> None:
+        # None restores the default, llama_cpp.Llama
+        self._loader = loader
+
+    def get(self, key: ModelKey, **llama_kwargs) -> "llama_cpp.Llama":
+        """Returns the model for ``key``, loading it on first use."""
+        return self._get_entry(key, **llama_kwargs).model
+
+    @contextmanager
+    def use(self, key: ModelKey, **llama_kwargs) -> Iterator["llama_cpp.Llama"]:
+        """Yields the model for ``key`` while holding its inference lock."""
+        entry = self._get_entry(key, **llama_kwargs)
+        with entry.lock:
+            yield entry.model
+
+    def engine(self, key: ModelKey, **llama_kwargs) -> Optional[batching.BatchEngine]:
+        """Returns the continuous-batching engine for ``key``'s model, or None if the backend has none."""
+        entry = self._get_entry(key, **llama_kwargs)
+        if not batching.supports(entry.model):
+            return None
+        with entry.lock:
+            if entry.engine is None:
+                entry.engine = batching.BatchEngine(entry.model, batching.parallel_sequences())
+            return entry.engine
+
+    def evict(self, key: ModelKey) -> bool:
+        with self._lock:
+            entry = self._models.pop(key, None)
+        if entry is None:
+            return False
+        entry.close()
+        metrics.model_evictions.inc()
+        logger.info(f"Evicted model {key.model_path} (n_ctx={key.n_ctx})")
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            for entry in self._models.values():
+                entry.close()
+            self._models.clear()
+
+    def has(self, key: ModelKey) -> bool:
+        """True if ``key`` is loaded or being loaded."""
+        with self._lock:
+            return key in self._models or key in self._load_locks
+
+    def reclaimable_bytes(self) -> int:
+        """Bytes the models that loading one more model would evict (by count) are estimated to hold."""
+        with self._lock:
+            excess = len(self._models) + 1 - self.max_models
+            return sum(entry.size_bytes for entry in list(self._models.values())[:max(0, excess)])
+
+    def loaded_keys(self) -> list[ModelKey]:
+        with self._lock:
+            return list(self._models)
+
+    def _get_entry(self, key: ModelKey, **llama_kwargs) -> _LoadedModel:
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None:
+                self._models.move_to_end(key)
+                return entry
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given key; the others block here and then find it loaded
+        with load_lock:
+            with self._lock:
+                entry = self._models.get(key)
+                if entry is not None:
+                    self._models.move_to_end(key)
+                    return entry
+
+            try:
+                entry = self._load(key, **llama_kwargs)
+            except BaseException:
+                with self._lock:
+                    self._load_locks.pop(key, None)
+                raise
+
+            # Published and unlocked in one step: a thread arriving in between would otherwise find
+            # neither the model nor its load lock and load the same weights a second time
+            with self._lock:
+                self._models[key] = entry
+                self._load_locks.pop(key, None)
+                self._evict_over_budget(keep=key)
+            return entry
+
+    def _load(self, key: ModelKey, **llama_kwargs) -> _LoadedModel:
+        size_bytes = os.path.getsize(key.model_path) if os.path.exists(key.model_path) else 0
+        if key.draft_model_path and os.path.exists(key.draft_model_path):
+            size_bytes += os.path.getsize(key.draft_model_path)
+        # Make room before mapping the new weights, not after
+        with self._lock:
+            self._evict_over_budget(incoming_bytes=size_bytes)
+
+        logger.info(f"Loading Llama model: {key.model_path} (n_ctx={key.n_ctx}, n_threads={key.n_threads})")
+        started = time.perf_counter()
+        draft = speculative.build_draft_model(key.speculative, key.draft_tokens)
+        if draft is not None:
+            llama_kwargs['draft_model'] = draft
+        model = self.loader(
+            model_path=key.model_path,
+            chat_format=key.chat_format,
+            n_ctx=key.n_ctx,
+            n_threads=key.n_threads,
+            n_gpu_layers=key.n_gpu_layers,
+            n_batch=key.n_batch,
+            n_threads_batch=key.n_threads_batch or None,
+            use_mmap=key.use_mmap,
+            use_mlock=key.use_mlock,
+            type_k=key.type_k,
+            type_v=key.type_v,
+            flash_attn=key.flash_attn,
+            **llama_kwargs,
+        )
+        # Follow-up turns restore the longest cached prompt prefix instead of re-evaluating it
+        attach_prefix_cache(model)
+        # Compiled once here so requests only tokenize their own text
+        prompt_templates.use_embedded_chat_template(model)
+        prompt_templates.for_model(model, key.chat_format)
+        if draft is not None and key.draft_model_path:
+            speculative.attach_draft_llama(model, draft, key.draft_model_path, key.draft_tokens, loader=self.loader,
+                                           n_threads=key.n_threads, n_gpu_layers=key.n_gpu_layers, verbose=False)
+        load_seconds = time.perf_counter() - started
+        metrics.model_load_seconds.observe(load_seconds)
+        metrics.model_loads.inc()
+        logger.info(f"Loaded {key.model_path} in {load_seconds:.2f}s")
+        return _LoadedModel(model, size_bytes)
+
+    def _evict_over_budget(self, keep: Optional[ModelKey] = None, incoming_bytes: Optional[int] = None) -> None:
+        # Caller must hold self._lock
+        def over_budget() -> bool:
+            count = len(self._models) + (1 if incoming_bytes is not None else 0)
+            if count > self.max_models:
+                return True
+            if self.memory_budget_bytes is None:
+                return False
+            used = sum(entry.size_bytes for entry in self._models.values()) + (incoming_bytes or 0)
+            return used > self.memory_budget_bytes
+
+        for key in list(self._models):
+            if not over_budget():
+                break
+            if key == keep:
+                continue
+            self._models.pop(key).close()
+            metrics.model_evictions.inc()
+            logger.info(f"Evicted model {key.model_path} to stay within the registry budget")
+
+
+def _budget_from_settings() -> Optional[int]:
+    budget_mb = getattr(settings, 'TEXTGEN_MODEL_MEMORY_BUDGET_MB', DEFAULT_MODEL_MEMORY_BUDGET_MB)
+    return int(budget_mb * 1024 * 1024) if budget_mb else None
+
+
+registry = ModelRegistry(
+    max_models=getattr(settings, 'TEXTGEN_MAX_LOADED_MODELS', DEFAULT_MAX_LOADED_MODELS),
+    memory_budget_bytes=_budget_from_settings(),
+)
+
+metrics.registry.gauge('textgen_loaded_models', 'Models currently held in memory.', lambda: len(registry.loaded_keys()))
@@ -1,5 +1,6 @@
 # textgen/models.py
 from django.db import models
+from django.utils import timezone
 
 class TextGenerationSettings(models.Model):
     # Add a unique identifier for the default settings instance
@@ -8,11 +9,30 @@ class TextGenerationSettings(models.Model):
 
     role = models.CharField(max_length=100, default='user')
     temperature = models.FloatField(default=0.7)
-    model_path = models.CharField(max_length=200, default='"/sdcard/fuji/qwen2.5-1.5b-instruct-q4_k_m.gguf" or "/sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf"')
+    # e.g. "/sdcard/fuji/qwen2.5-1.5b-instruct-q4_k_m.gguf" with chat_format "qwen"
+    model_path = models.CharField(max_length=200, default='/sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf')
     max_tokens = models.IntegerField(default=200)
     top_p = models.FloatField(default=1.0)
     top_k = models.IntegerField(default=50)
     seed = models.IntegerField(default=-1)
+    # Placed in the model's chat template ahead of every prompt (see prompt_templates.py)
+    system_prompt = models.TextField(blank=True)
+
+    # Model loader parameters; changing any of them loads a separate model instance
+    chat_format = models.CharField(max_length=50, default='saiga')
+    n_ctx = models.IntegerField(default=4096)
+    n_threads = models.IntegerField(default=4)
+    n_threads_batch = models.IntegerField(default=0)  # 0: llama_cpp default (all cores)
+    n_batch = models.IntegerField(default=512)
+    n_gpu_layers = models.IntegerField(default=-1)
+    # Replace the loader parameters above with the hardware profile measured for the model (see autotune.py)
+    auto_tune = models.BooleanField(default=False)
+
+    # Speculative decoding (see speculative.py); the draft model must share the main model's vocabulary
+    SPECULATIVE_CHOICES = [('', 'Off'), ('prompt_lookup', 'Prompt lookup'), ('draft_model', 'Draft model')]
+    speculative = models.CharField(max_length=20, choices=SPECULATIVE_CHOICES, default='', blank=True)
+    draft_model_path = models.CharField(max_length=200, blank=True)
+    draft_tokens = models.IntegerField(default=10)
 
     def __str__(self):
         return f"Settings ({self.identifier})"
@@ -26,10 +46,78 @@ class TextGenerationSettings(models.Model):
 class Chat(models.Model):
     prompt = models.TextField()
     response = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the chat is created, not when the write-behind buffer stores it (see persistence.py)
+    timestamp = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return f"Chat: {self.prompt[:50]}..."
 
     class Meta:
-        ordering = ['-timestamp'] # Orders by newest first by default
\ No newline at end of file
+        ordering = ['-timestamp', '-id'] # Orders by newest first by default; id breaks timestamp ties
+        indexes = [
+            # Backs the keyset pagination of the history sidebar (see history.py)
+            models.Index(fields=['-timestamp', '-id'], name='chat_timestamp_id_idx'),
+        ]
+
+
+class Conversation(models.Model):
+    title = models.CharField(max_length=200, blank=True)
+    system_prompt = models.TextField(blank=True)
+    system_token_count = models.PositiveIntegerField(default=0)
+    # Position of the oldest message still inside the context window; older turns are dropped
+    window_start = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Conversation: {self.title or self.id}"
+
+    class Meta:
+        ordering = ['-updated_at']
+
+class Message(models.Model):
+    ROLE_CHOICES = [('system', 'System'), ('user', 'User'), ('assistant', 'Assistant')]
+
+    conversation = models.ForeignKey(Conversation, related_name='messages', on_delete=models.CASCADE)
+    position = models.PositiveIntegerField()
+    role = models.CharField(max_length=20, choices=ROLE_CHOICES)
+    content = models.TextField()
+    # Counted once when the message is stored so windowing never re-tokenizes history
+    token_count = models.PositiveIntegerField(default=0)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.role}: {self.content[:50]}..."
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'position'], name='unique_message_position'),
+        ]
+
+
+class ModelProfile(models.Model):
+    """Loader parameters chosen for one model file on this device by ``autotune``."""
+    model_path = models.CharField(max_length=200, unique=True)
+    # The profile is recomputed when the file or the hardware it was measured on changes
+    file_size = models.BigIntegerField()
+    file_mtime = models.FloatField()
+    cpu_count = models.PositiveIntegerField()
+    memory_bytes = models.BigIntegerField()
+
+    architecture = models.CharField(max_length=50, blank=True)
+    quantization = models.CharField(max_length=20, blank=True)
+    n_layers = models.PositiveIntegerField(default=0)
+    trained_n_ctx = models.PositiveIntegerField(default=0)
+
+    n_threads = models.IntegerField()
+    n_threads_batch = models.IntegerField()
+    n_batch = models.IntegerField()
+    n_ctx = models.IntegerField()
+    n_gpu_layers = models.IntegerField()
+    # Generation speed with the chosen threads; set only by a calibration sweep
+    calibrated_tokens_per_second = models.FloatField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Profile: {self.model_path}"
@@ -0,0 +1,241 @@
+import logging
+import os
+import time
+import uuid
+from typing import Iterator, Optional, Union
+from django.conf import settings
+from . import metrics, retrieval
+from .generation import DEFAULT_ROLE, completion, resolve_generation_params
+from .governor import InsufficientMemory
+from .model_registry import registry
+from .models import TextGenerationSettings
+from .scheduler import GenerationCancelled, GenerationTimeout
+from .settings_cache import InvalidOverride, ResolvedSettings, validate_overrides
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- OpenAI-Compatible API Defaults ---
+OWNED_BY = 'textgen'
+MAX_STOP_SEQUENCES = 4  # as in the OpenAI API
+CHAT_ROLES = ('system', 'user', 'assistant')
+COMPLETION = 'text_completion'
+CHAT = 'chat.completion'
+MAX_EMBEDDING_INPUTS = 64
+
+
+class InvalidRequest(ValueError):
+    """A request the OpenAI API would answer with ``invalid_request_error``."""
+
+    def __init__(self, message: str, param: Optional[str] = None):
+        super().__init__(message)
+        self.param = param
+
+
+def api_key() -> Optional[str]:
+    return getattr(settings, 'TEXTGEN_API_KEY', None)
+
+
+def model_id(model_path: str) -> str:
+    return os.path.basename(model_path)
+
+
+def models() -> dict[str, str]:
+    """Model ids clients may ask for, mapped to their files: every configured and every loaded model."""
+    paths = list(TextGenerationSettings.objects.values_list('model_path', flat=True).distinct())
+    paths += [key.model_path for key in registry.loaded_keys()]
+    fallback = getattr(settings, 'TEXTGEN_FALLBACK_MODEL_PATH', None)
+    if fallback:
+        paths.append(fallback)
+    return {model_id(path): path for path in paths if path}
+
+
+def model_list() -> dict:
+    data = []
+    for name, path in models().items():
+        try:
+            created = int(os.path.getmtime(path))
+        except OSError:
+            created = 0
+        data.append({'id': name, 'object': 'model', 'created': created, 'owned_by': OWNED_BY})
+    return {'object': 'list', 'data': data}
+
+
+def _text(content, param: str) -> str:
+    if isinstance(content, str):
+        return content
+    # Content parts ({"type": "text", "text": ...}); images and audio cannot be used by these models
+    if isinstance(content, list) and all(isinstance(part, dict) for part in content):
+        if any(part.get('type') != 'text' for part in content):
+            raise InvalidRequest("Only text content is supported", param)
+        return ''.join(str(part.get('text', '')) for part in content)
+    if content is None:
+        return ''
+    raise InvalidRequest("Message content must be a string or a list of text parts", param)
+
+
+def parse_messages(value) -> list[dict]:
+    if not isinstance(value, list) or not value:
+        raise InvalidRequest("'messages' must be a non-empty list", 'messages')
+    messages = []
+    for index, message in enumerate(value):
+        if not isinstance(message, dict):
+            raise InvalidRequest("Each message must be an object", f'messages[{index}]')
+        role = 'system' if message.get('role') == 'developer' else message.get('role')
+        if role not in CHAT_ROLES:
+            raise InvalidRequest(f"Unsupported role {message.get('role')!r}", f'messages[{index}].role')
+        messages.append({'role': role, 'content': _text(message.get('content'), f'messages[{index}].content')})
+    return messages
+
+
+def parse_prompt(value) -> str:
+    if isinstance(value, list) and len(value) == 1 and isinstance(value[0], str):
+        value = value[0]
+    if not isinstance(value, str):
+        raise InvalidRequest("'prompt' must be a string (batched prompts are not supported)", 'prompt')
+    return value
+
+
+def generation_kwargs(data: dict) -> dict:
+    """Maps OpenAI request fields onto ``resolve_generation_params`` arguments."""
+    if data.get('n', 1) != 1:
+        raise InvalidRequest("Only n=1 is supported", 'n')
+    stop = data.get('stop')
+    if isinstance(stop, str):
+        stop = [stop]
+    if stop is not None and (not isinstance(stop, list) or len(stop) > MAX_STOP_SEQUENCES
+                             or not all(isinstance(s, str) for s in stop)):
+        raise InvalidRequest(f"'stop' must be a string or a list of at most {MAX_STOP_SEQUENCES} strings", 'stop')
+    max_tokens = data.get('max_completion_tokens', data.get('max_tokens'))
+    kwargs = {
+        'role': DEFAULT_ROLE,
+        # 0 is a valid temperature here, so only a missing value falls back to the settings
+        'temperature': data.get('temperature'),
+        'max_tokens': max_tokens,
+        'top_p': data.get('top_p'),
+        'top_k': data.get('top_k'),  # not in the OpenAI API, but llama.cpp's server accepts it too
+        'stop_sequences': stop or None,
+        'model_path': models().get(data.get('model') or ''),
+    }
+    for name in ('temperature', 'top_p'):
+        if kwargs[name] is not None and not isinstance(kwargs[name], (int, float)):
+            raise InvalidRequest(f"'{name}' must be a number", name)
+    for name in ('max_tokens', 'top_k'):
+        if kwargs[name] is not None and (not isinstance(kwargs[name], int) or isinstance(kwargs[name], bool)):
+            raise InvalidRequest(f"'{name}' must be an integer", name)
+    try:
+        # The same ranges as every other request path (e.g. top_p within [0, 1], max_tokens of at least 1)
+        validate_overrides(temperature=kwargs['temperature'], max_tokens=max_tokens, top_p=kwargs['top_p'],
+                           top_k=kwargs['top_k'])
+    except InvalidOverride as e:
+        param = 'max_completion_tokens' if e.name == 'max_tokens' and 'max_completion_tokens' in data else e.name
+        raise InvalidRequest(str(e), param) from None
+    return kwargs
+
+
+def embeddings(data: dict) -> dict:
+    """Embeds ``input`` (a string or a list of strings) with the retrieval embedding model."""
+    if not retrieval.enabled():
+        raise InvalidRequest("No embedding model is configured (set TEXTGEN_EMBEDDING_MODEL_PATH)", 'model')
+    texts = data.get('input')
+    if isinstance(texts, str):
+        texts = [texts]
+    if (not isinstance(texts, list) or not texts or len(texts) > MAX_EMBEDDING_INPUTS
+            or not all(isinstance(text, str) for text in texts)):
+        raise InvalidRequest(f"'input' must be a string or a list of at most {MAX_EMBEDDING_INPUTS} strings", 'input')
+    if data.get('encoding_format', 'float') != 'float':
+        raise InvalidRequest("Only encoding_format 'float' is supported", 'encoding_format')
+    vectors, token_count = retrieval.embedder.embed(texts)
+    return {
+        'object': 'list',
+        'data': [{'object': 'embedding', 'index': i, 'embedding': vector.tolist()} for i, vector in enumerate(vectors)],
+        'model': model_id(retrieval.embedding_model_path()),
+        'usage': {'prompt_tokens': token_count, 'total_tokens': token_count},
+    }
+
+
+# --- Generation (runs on a scheduler worker) ---
+
+def _response_id(kind: str) -> str:
+    return f"{'chatcmpl' if kind == CHAT else 'cmpl'}-{uuid.uuid4().hex}"
+
+
+def _usage(timer: metrics.GenerationTimer) -> dict:
+    return {
+        'prompt_tokens': timer.prompt_token_count,
+        'completion_tokens': timer.completion_token_count,
+        'total_tokens': timer.prompt_token_count + timer.completion_token_count,
+    }
+
+
+def _finish_reason(params: ResolvedSettings, timer: metrics.GenerationTimer) -> str:
+    return 'length' if params.max_tokens and timer.completion_token_count >= params.max_tokens else 'stop'
+
+
+def _choice(kind: str, text: Optional[str], finish_reason: Optional[str], stream: bool) -> dict:
+    if kind == COMPLETION:
+        return {'text': text or '', 'index': 0, 'logprobs': None, 'finish_reason': finish_reason}
+    if stream:
+        return {'index': 0, 'delta': {'content': text} if text is not None else {}, 'logprobs': None,
+                'finish_reason': finish_reason}
+    return {'index': 0, 'message': {'role': 'assistant', 'content': text}, 'logprobs': None,
+            'finish_reason': finish_reason}
+
+
+def create(kind: str, prompt: Union[str, list[dict]], **kwargs) -> dict:
+    """Runs a completion (``prompt`` is raw text) or a chat completion (a list of messages)."""
+    params = resolve_generation_params(**kwargs)
+    timer = metrics.GenerationTimer()
+    try:
+        with completion(prompt, params, timer, raw=kind == COMPLETION) as chunks:
+            text = ''.join(chunks)
+    except Exception:
+        timer.fail()
+        raise
+    return {
+        'id': _response_id(kind),
+        'object': kind,
+        'created': int(time.time()),
+        'model': model_id(params.model_path),
+        'choices': [_choice(kind, text, _finish_reason(params, timer), stream=False)],
+        'usage': _usage(timer),
+    }
+
+
+def stream(kind: str, prompt: Union[str, list[dict]], include_usage: bool = False, **kwargs) -> Iterator[dict]:
+    """Streaming variant of ``create`` yielding OpenAI chunk objects, then ``{'event': 'done'}``."""
+    try:
+        params = resolve_generation_params(**kwargs)
+    except InsufficientMemory as e:
+        yield {'event': 'error', 'error': str(e)}
+        return
+    base = {
+        'id': _response_id(kind),
+        'object': 'text_completion' if kind == COMPLETION else 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model_id(params.model_path),
+    }
+    timer = metrics.GenerationTimer()
+    try:
+        if kind == CHAT:
+            yield dict(base, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ''},
+                                       'logprobs': None, 'finish_reason': None}])
+        with completion(prompt, params, timer, raw=kind == COMPLETION) as chunks:
+            for text in chunks:
+                yield dict(base, choices=[_choice(kind, text, None, stream=True)])
+    except GenerationCancelled:
+        raise
+    except GenerationTimeout as e:
+        timer.fail()
+        yield {'event': 'error', 'error': str(e)}
+        return
+    except Exception as e:
+        timer.fail()
+        logger.error(f"OpenAI-compatible {kind} stream failed: {e}")
+        yield {'event': 'error', 'error': 'An error occurred during generation.'}
+        return
+    yield dict(base, choices=[_choice(kind, None, _finish_reason(params, timer), stream=True)])
+    if include_usage:
+        yield dict(base, choices=[], usage=_usage(timer))
+    yield {'event': 'done'}
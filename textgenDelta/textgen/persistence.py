@@ -0,0 +1,222 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Iterable, Optional
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.utils import timezone
+from .models import Chat
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Chat Persistence Defaults (overridable in settings.py) ---
+DEFAULT_WRITE_BEHIND = True
+DEFAULT_WRITE_BATCH_SIZE = 256
+DEFAULT_WRITE_INTERVAL = 0.2  # seconds the writer waits to gather more rows into one INSERT
+DEFAULT_SHUTDOWN_FLUSH_TIMEOUT = 5.0
+# A failed batch (e.g. "database is locked") is retried at once a few times, then kept queued and retried
+# every WRITE_BACKOFF seconds until it is written
+WRITE_ATTEMPTS = 3
+WRITE_RETRY_DELAY = 0.5
+WRITE_BACKOFF = 5.0
+# Ids reserved in the database per round trip; the unused rest of a block is skipped at shutdown
+ID_BLOCK_SIZE = 64
+
+
+def reserve_chat_ids(count: int) -> int:
+    """Reserves ``count`` consecutive chat ids in the database and returns the first.
+
+    The table is AUTOINCREMENT, so SQLite hands out ids above
+    ``sqlite_sequence.seq`` to every other insert (the admin, ``import_history``,
+    another server process); raising it first keeps those ids to ourselves.
+    """
+    table = Chat._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Only present once the table has had an insert
+        cursor.execute(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT %s, 0 "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)", [table, table])
+        # Writing first takes the write lock, so no other reservation can read the same value in between
+        cursor.execute(
+            f"UPDATE sqlite_sequence SET seq = max(seq, (SELECT coalesce(max(id), 0) FROM {table})) + %s "
+            f"WHERE name = %s", [count, table])
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+        last = cursor.fetchone()[0]
+    return last - count + 1
+
+
+class ChatWriter:
+    """Saves chats on a background thread so responses never wait on the disk.
+
+    ``save`` returns the ``Chat`` straight away with its primary key and
+    timestamp already assigned; the row itself is inserted a moment later
+    together with whatever else was queued in the meantime. Ids come from
+    blocks reserved in the database (see ``reserve_chat_ids``), so inserts
+    elsewhere never take an id already returned to a client. Ids never go
+    backwards, even when the newest chats were deleted: clients and the
+    retrieval index (which only embeds ids above its last one) rely on an id
+    always meaning the same chat. A chat that cannot be written stays queued
+    and is retried; it is never dropped while the process runs.
+    """
+
+    def __init__(self, enabled: bool = DEFAULT_WRITE_BEHIND, batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+                 interval: float = DEFAULT_WRITE_INTERVAL):
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._queue: "queue.Queue[Chat]" = queue.Queue()
+        self._lock = threading.Lock()
+        # The reserved block ids are taken from: [_next_id, _block_end)
+        self._next_id = 0
+        self._block_end = 0
+        self._pending: dict[int, Chat] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def save(self, prompt: str, response: str) -> Chat:
+        return self.save_many([(prompt, response)])[0]
+
+    def save_many(self, rows: Iterable[tuple[str, str]]) -> list[Chat]:
+        rows = list(rows)
+        if not self.enabled or connection.vendor != 'sqlite':
+            # Ids can only be reserved ahead through SQLite's sqlite_sequence
+            return Chat.objects.bulk_create([Chat(prompt=prompt, response=response) for prompt, response in rows])
+
+        now = timezone.now()
+        with self._lock:
+            first_id = self._allocate_ids(len(rows))
+            chats = [
+                Chat(id=first_id + offset, prompt=prompt, response=response, timestamp=now)
+                for offset, (prompt, response) in enumerate(rows)
+            ]
+            for chat in chats:
+                self._pending[chat.id] = chat
+                self._queue.put(chat)
+            self._ensure_thread()
+        return chats
+
+    def pending(self, chat_id: int) -> Optional[Chat]:
+        """Returns a chat that was saved but not yet written, so readers never miss it."""
+        with self._lock:
+            return self._pending.get(chat_id)
+
+    def reserve_ids(self, count: int) -> Optional[int]:
+        """Returns the first of ``count`` ids for rows inserted outside the buffer (None without write-behind)."""
+        if not self.enabled or connection.vendor != 'sqlite':
+            return None
+        with self._lock:
+            return self._allocate_ids(count)
+
+    def flush(self, timeout: float = DEFAULT_SHUTDOWN_FLUSH_TIMEOUT) -> bool:
+        """Waits until every queued chat is written; returns False if ``timeout`` ran out first."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _allocate_ids(self, count: int) -> int:
+        # Caller must hold self._lock
+        if self._next_id + count > self._block_end:
+            self._next_id = reserve_chat_ids(max(count, ID_BLOCK_SIZE))
+            self._block_end = self._next_id + max(count, ID_BLOCK_SIZE)
+        first_id = self._next_id
+        self._next_id += count
+        return first_id
+
+    def _ensure_thread(self) -> None:
+        # Caller must hold self._lock
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="textgen-chat-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            # Stays pending (and visible to readers) until it is written; a conflict can change an id
+            ids = [chat.id for chat in batch]
+            while not self._write(batch):
+                time.sleep(WRITE_BACKOFF)
+            with self._lock:
+                for chat_id in ids:
+                    self._pending.pop(chat_id, None)
+            for _ in batch:
+                self._queue.task_done()
+            close_old_connections()
+
+    def _write(self, batch: list[Chat]) -> bool:
+        """Inserts ``batch``; returns False if the database kept failing."""
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                try:
+                    Chat.objects.bulk_create(batch)
+                except IntegrityError as e:
+                    # Some of the rows are there already (or their ids were taken); the others keep theirs
+                    logger.warning(f"Id conflict while writing {len(batch)} chats, writing them one by one: {e}")
+                    self._write_each(batch)
+                logger.debug(f"Wrote {len(batch)} chats to database")
+                return True
+            except Exception as e:
+                logger.warning(f"Error saving {len(batch)} chats to database (attempt {attempt}/{WRITE_ATTEMPTS}): {e}")
+                close_old_connections()
+                if attempt < WRITE_ATTEMPTS:
+                    time.sleep(WRITE_RETRY_DELAY * attempt)
+        logger.error(f"Could not save {len(batch)} chats; they stay queued and are retried in {WRITE_BACKOFF}s")
+        return False
+
+    def _write_each(self, batch: list[Chat]) -> None:
+        for chat in batch:
+            try:
+                with transaction.atomic():
+                    Chat.objects.bulk_create([chat])
+            except IntegrityError:
+                existing = Chat.objects.filter(id=chat.id).values_list('prompt', 'response').first()
+                if existing == (chat.prompt, chat.response):
+                    continue  # written by an earlier attempt whose commit was not acknowledged
+                # The id was taken outside the reservation (e.g. an explicit id); a new id beats losing the chat
+                old_id = chat.id
+                chat.id = None
+                chat.save(force_insert=True)
+                logger.error(f"Chat id {old_id} was taken by another row; saved the chat as {chat.id} instead")
+
+    def log_unsaved(self) -> None:
+        """Logs chats still queued, so they can be recovered by hand when the process exits without them."""
+        with self._lock:
+            chats = sorted(self._pending.values(), key=lambda chat: chat.id)
+        if chats:
+            _log_unsaved(chats)
+
+
+def _log_unsaved(chats: list[Chat]) -> None:
+    ids = ', '.join(str(chat.id) for chat in chats)
+    logger.error(f"Exiting with {len(chats)} acknowledged chats not saved (ids {ids})")
+    for chat in chats:
+        # The text is kept in the log so it can still be recovered by hand
+        logger.error(f"Unsaved chat {chat.id} at {chat.timestamp.isoformat()}: "
+                     f"prompt={chat.prompt!r} response={chat.response!r}")
+
+
+chat_writer = ChatWriter(
+    enabled=getattr(settings, 'TEXTGEN_CHAT_WRITE_BEHIND', DEFAULT_WRITE_BEHIND),
+    batch_size=getattr(settings, 'TEXTGEN_CHAT_WRITE_BATCH_SIZE', DEFAULT_WRITE_BATCH_SIZE),
+    interval=getattr(settings, 'TEXTGEN_CHAT_WRITE_INTERVAL', DEFAULT_WRITE_INTERVAL),
+)
+
+
+def _flush_at_exit() -> None:
+    # Rows still in the buffer when the server stops are written before exit, or at least logged
+    if not chat_writer.flush():
+        chat_writer.log_unsaved()
+
+
+atexit.register(_flush_at_exit)
@@ -0,0 +1,237 @@
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Prompt Template Defaults ---
+EMBEDDED_TEMPLATE_KEY = 'tokenizer.chat_template'
+# Name llama_cpp registers the embedded template's chat handler under
+EMBEDDED_CHAT_FORMAT = 'chat_template.default'
+TOKEN_CACHE_ENTRIES = 64
+# Stands in for the user's message while a template is rendered; private-use characters survive
+# every filter templates apply to message content (trim, replace, ...)
+_SENTINEL = 'textgen-user-message'
+# Texts used to check that tokenizing the template's fixed parts separately gives the same tokens
+_PROBES = ('Hello, world!', ' 2 + 2 =\nanswer:')
+
+
+@dataclass(frozen=True)
+class PreparedPrompt:
+    """A request's prompt as token ids, plus the stop sequences to apply on top of the model's EOG tokens."""
+    tokens: list[int]
+    stop: tuple[str, ...]
+
+
+class _Split:
+    """A rendered template cut around the user message, for one system prompt."""
+
+    def __init__(self, prefix: str, suffix: str, prefix_tokens: list[int], suffix_tokens: list[int],
+                 separable: bool):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.prefix_tokens = prefix_tokens
+        self.suffix_tokens = suffix_tokens
+        # False when the tokenizer merges across the cut (e.g. SentencePiece's leading space), in which
+        # case the whole prompt is tokenized per request instead
+        self.separable = separable
+
+
+def _token_text(model, token: int) -> str:
+    if token is None or token < 0:
+        return ''
+    return model.detokenize([token], special=True).decode('utf-8', errors='ignore')
+
+
+def _named_formatter(name: str) -> Optional[Callable]:
+    # llama_cpp registers its formats as handlers only; the formatter functions are named after them
+    # ('saiga' -> format_saiga, 'llama-2' -> format_llama2, 'open-orca' -> format_open_orca)
+    from llama_cpp import llama_chat_format
+    for attribute in (f"format_{name.replace('-', '_')}", f"format_{name.replace('-', '')}"):
+        formatter = getattr(llama_chat_format, attribute, None)
+        if callable(formatter):
+            return formatter
+    return None
+
+
+class PromptTemplate:
+    """One loaded model's chat template, compiled once and split around the user message.
+
+    The template comes from the GGUF metadata (``tokenizer.chat_template``)
+    when the file has one and from the llama_cpp format named by
+    ``chat_format`` otherwise; without either the prompt is sent as is.
+    For every system prompt the text before and after the user message is
+    rendered and tokenized once, so a request only tokenizes its own text.
+    """
+
+    def __init__(self, model, chat_format: str):
+        self._model = model
+        self.bos_token = _token_text(model, model.token_bos())
+        self.eos_token = _token_text(model, model.token_eos())
+        metadata = getattr(model, 'metadata', None) or {}
+        embedded = metadata.get(EMBEDDED_TEMPLATE_KEY)
+        self.formatter: Optional[Callable] = None
+        self.source = 'raw'
+        # Jinja templates write the BOS token themselves; llama_cpp's named formats leave it to the tokenizer
+        self.add_bos = True
+        if embedded:
+            try:
+                from llama_cpp import llama_chat_format
+                self.formatter = llama_chat_format.Jinja2ChatFormatter(
+                    template=embedded, eos_token=self.eos_token, bos_token=self.bos_token,
+                    add_generation_prompt=True,
+                )
+                self.source = 'gguf'
+                self.add_bos = False
+            except Exception as e:
+                logger.error(f"Chat template in {getattr(model, 'model_path', 'model')} does not compile, "
+                             f"falling back to chat_format {chat_format!r}: {e}")
+        if self.formatter is None and chat_format:
+            try:
+                self.formatter = _named_formatter(chat_format)
+            except ImportError:
+                # Stub backends (``manage.py bench --stub``, tests) run without llama_cpp installed
+                logger.info(f"llama_cpp is not installed; prompts are sent without the {chat_format!r} template")
+            else:
+                if self.formatter is not None:
+                    self.source = chat_format
+                else:
+                    logger.warning(f"Unknown chat_format {chat_format!r}; prompts are sent without a template")
+        self.stop: tuple[str, ...] = ()
+        self._lock = threading.Lock()
+        self._splits: dict[str, _Split] = {}
+        self._tokens: OrderedDict[tuple[str, str], tuple[int, ...]] = OrderedDict()
+        logger.info(f"Prompt template for {getattr(model, 'model_path', 'model')}: {self.source}")
+
+    def _render(self, system_prompt: str) -> tuple[str, str]:
+        messages = [{'role': 'user', 'content': _SENTINEL}]
+        if system_prompt:
+            messages.insert(0, {'role': 'system', 'content': system_prompt})
+        try:
+            response = self.formatter(messages=messages)
+        except Exception as e:
+            if not system_prompt:
+                raise
+            # Some templates (e.g. Gemma's) reject a system role; put it in front of the user's message instead
+            logger.debug(f"Template {self.source} rejected a system message, merging it into the user turn: {e}")
+            prefix, suffix = self._render('')
+            return prefix + system_prompt + '\n\n', suffix
+        stop = response.stop or ()
+        self.stop = tuple([stop] if isinstance(stop, str) else stop)
+        prefix, sentinel, suffix = response.prompt.partition(_SENTINEL)
+        if not sentinel or _SENTINEL in suffix:
+            raise ValueError(f"Template {self.source} does not place the user message exactly once")
+        return prefix, suffix
+
+    def _split(self, system_prompt: str) -> _Split:
+        with self._lock:
+            split = self._splits.get(system_prompt)
+        if split is not None:
+            return split
+
+        if self.formatter is None:
+            prefix, suffix = (system_prompt + '\n\n' if system_prompt else ''), ''
+        else:
+            prefix, suffix = self._render(system_prompt)
+        add_bos = self.add_bos and not (self.bos_token and prefix.startswith(self.bos_token))
+        tokenize = self._model.tokenize
+        prefix_tokens = tokenize(prefix.encode('utf-8'), add_bos=add_bos, special=True)
+        suffix_tokens = tokenize(suffix.encode('utf-8'), add_bos=False, special=True) if suffix else []
+        separable = all(
+            tokenize((prefix + probe + suffix).encode('utf-8'), add_bos=add_bos, special=True)
+            == prefix_tokens + tokenize(probe.encode('utf-8'), add_bos=False, special=False) + suffix_tokens
+            for probe in _PROBES
+        )
+        split = _Split(prefix, suffix, prefix_tokens, suffix_tokens, separable)
+        with self._lock:
+            self._splits[system_prompt] = split
+        logger.debug(f"Template {self.source}: {len(prefix_tokens)} prefix and {len(suffix_tokens)} suffix tokens "
+                     f"cached ({'separable' if separable else 'tokenized per request'})")
+        return split
+
+    def prepare(self, text: str, system_prompt: str = '', stop: tuple[str, ...] = ()) -> PreparedPrompt:
+        """Returns ``text`` wrapped as a user turn, tokenized, with the template's and ``stop``'s stop sequences."""
+        split = self._split(system_prompt)
+        key = (system_prompt, text)
+        with self._lock:
+            tokens = self._tokens.get(key)
+            if tokens is not None:
+                self._tokens.move_to_end(key)
+        if tokens is None:
+            if split.separable:
+                # special=False: the user's text cannot smuggle in control tokens like <|im_start|>
+                body = self._model.tokenize(text.encode('utf-8'), add_bos=False, special=False)
+                tokens = tuple(split.prefix_tokens + body + split.suffix_tokens)
+            else:
+                add_bos = self.add_bos and not (self.bos_token and split.prefix.startswith(self.bos_token))
+                tokens = tuple(self._model.tokenize((split.prefix + text + split.suffix).encode('utf-8'),
+                                                    add_bos=add_bos, special=True))
+            with self._lock:
+                self._tokens[key] = tokens
+                while len(self._tokens) > TOKEN_CACHE_ENTRIES:
+                    self._tokens.popitem(last=False)
+        return PreparedPrompt(list(tokens), tuple(dict.fromkeys(self.stop + tuple(stop))))
+
+
+    def prepare_messages(self, messages: list[dict], system_prompt: str = '',
+                         stop: tuple[str, ...] = ()) -> PreparedPrompt:
+        """Renders a whole chat; ``system_prompt`` is used when the messages bring none of their own."""
+        if system_prompt and not any(message['role'] == 'system' for message in messages):
+            messages = [{'role': 'system', 'content': system_prompt}] + list(messages)
+        roles = [message['role'] for message in messages]
+        if roles == ['user'] or roles == ['system', 'user']:
+            # A single turn is the common case and can use the cached prefix and suffix
+            return self.prepare(messages[-1]['content'], messages[0]['content'] if len(messages) == 2 else '', stop)
+        if self.formatter is None:
+            tokens = self._model.tokenize('\n\n'.join(m['content'] for m in messages).encode('utf-8'),
+                                          add_bos=True, special=False)
+        else:
+            self._split('')  # the first render also records the template's stop sequences
+            text = self.formatter(messages=messages).prompt
+            add_bos = self.add_bos and not (self.bos_token and text.startswith(self.bos_token))
+            tokens = self._model.tokenize(text.encode('utf-8'), add_bos=add_bos, special=True)
+        return PreparedPrompt(tokens, tuple(dict.fromkeys(self.stop + tuple(stop))))
+
+
+_templates_lock = threading.Lock()
+_templates: "weakref.WeakKeyDictionary[object, PromptTemplate]" = weakref.WeakKeyDictionary()
+
+
+def for_model(model, chat_format: str) -> PromptTemplate:
+    """Returns the model's template, compiling it on first use (the registry does so right after loading)."""
+    with _templates_lock:
+        template = _templates.get(model)
+        if template is None:
+            template = PromptTemplate(model, chat_format)
+            _templates[model] = template
+    return template
+
+
+def prepare(model, params, text: str) -> PreparedPrompt:
+    return for_model(model, params.chat_format).prepare(text, params.system_prompt, params.stop)
+
+
+def prepare_messages(model, params, messages: list[dict]) -> PreparedPrompt:
+    return for_model(model, params.chat_format).prepare_messages(messages, params.system_prompt, params.stop)
+
+
+def prepare_raw(model, text: str, stop: tuple[str, ...] = ()) -> PreparedPrompt:
+    """Tokenizes ``text`` without any template, the way ``Llama.create_completion`` does."""
+    return PreparedPrompt(model.tokenize(text.encode('utf-8'), special=True), tuple(stop))
+
+
+def use_embedded_chat_template(model) -> None:
+    """Makes ``create_chat_completion`` use the GGUF's own template too, as prompts built here do.
+
+    llama_cpp only falls back to the embedded template when no chat_format
+    is given, but every settings row names one.
+    """
+    handlers = getattr(model, '_chat_handlers', None) or {}
+    if EMBEDDED_CHAT_FORMAT in handlers and getattr(model, 'chat_format', None) != EMBEDDED_CHAT_FORMAT:
+        logger.info(f"Using the chat template embedded in {model.model_path} instead of {model.chat_format!r}")
+        model.chat_format = EMBEDDED_CHAT_FORMAT
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from django.conf import settings
+from . import metrics
+from .settings_cache import ResolvedSettings
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Response Cache Defaults (overridable in settings.py) ---
+DEFAULT_RESPONSE_CACHE = None  # 'memory', 'sqlite' (memory in front of an SQLite file) or None to disable
+DEFAULT_RESPONSE_CACHE_ENTRIES = 256
+DEFAULT_RESPONSE_CACHE_TTL = 24 * 60 * 60  # seconds
+DEFAULT_RESPONSE_CACHE_DB = '.response_cache.sqlite3'
+DEFAULT_RESPONSE_CACHE_DB_ENTRIES = 10000
+
+# Values of the X-Cache response header
+HIT = 'HIT'
+MISS = 'MISS'
+BYPASS = 'BYPASS'
+
+
+def is_deterministic(params: ResolvedSettings) -> bool:
+    """Greedy sampling or a fixed seed always produces the same text for the same input."""
+    return params.temperature == 0 or params.seed != -1
+
+
+def _model_identity(model_path: str) -> str:
+    # Size and mtime change whenever the file is replaced, without hashing gigabytes
+    try:
+        stat = os.stat(model_path)
+    except OSError:
+        return model_path
+    return f"{os.path.realpath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def cache_key(params: ResolvedSettings, prompt: str) -> str:
+    material = json.dumps([
+        _model_identity(params.model_path),
+        params.chat_format,
+        params.system_prompt,
+        prompt,
+        params.temperature,
+        params.top_p,
+        params.top_k,
+        params.max_tokens,
+        list(params.stop),
+        params.seed,
+    ])
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class _SQLiteTier:
+    """Second-level store that survives restarts; kept in its own file, away from the app database."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed_at)")
+
+    def get(self, key: str, min_created_at: float) -> Optional[tuple[str, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < min_created_at:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return row
+
+    def set(self, key: str, response: str, created_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)", (key, response, created_at, created_at)
+            )
+            # Drop the least recently used rows beyond the limit
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+
+
+class ResponseCache:
+    """In-memory LRU of generated texts with an optional SQLite tier behind it.
+
+    Only deterministic requests are cached, so a hit returns exactly what the
+    model would have generated. Entries expire ``ttl`` seconds after they were
+    generated.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, disk: Optional[_SQLiteTier] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = disk
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        min_created_at = time.time() - self.ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < min_created_at:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        if self.disk is not None:
+            try:
+                entry = self.disk.get(key, min_created_at)
+            except sqlite3.Error as e:
+                logger.error(f"Response cache database lookup failed: {e}")
+                entry = None
+            if entry is not None:
+                self._remember(key, entry)
+                with self._lock:
+                    self.hits += 1
+                return entry[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, response: str) -> None:
+        entry = (response, time.time())
+        self._remember(key, entry)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, *entry)
+            except sqlite3.Error as e:
+                logger.error(f"Response cache database write failed: {e}")
+
+    def _remember(self, key: str, entry: tuple[str, float]) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+            }
+
+
+def build_response_cache() -> Optional[ResponseCache]:
+    """Creates the response cache configured in settings, or None when disabled."""
+    kind = getattr(settings, 'TEXTGEN_RESPONSE_CACHE', DEFAULT_RESPONSE_CACHE)
+    if not kind:
+        return None
+    max_entries = getattr(settings, 'TEXTGEN_RESPONSE_CACHE_ENTRIES', DEFAULT_RESPONSE_CACHE_ENTRIES)
+    ttl = getattr(settings, 'TEXTGEN_RESPONSE_CACHE_TTL', DEFAULT_RESPONSE_CACHE_TTL)
+    if kind == 'memory':
+        return ResponseCache(max_entries, ttl)
+    if kind == 'sqlite':
+        disk = _SQLiteTier(
+            str(getattr(settings, 'TEXTGEN_RESPONSE_CACHE_DB', DEFAULT_RESPONSE_CACHE_DB)),
+            getattr(settings, 'TEXTGEN_RESPONSE_CACHE_DB_ENTRIES', DEFAULT_RESPONSE_CACHE_DB_ENTRIES),
+        )
+        return ResponseCache(max_entries, ttl, disk)
+    raise ValueError(f"Unknown TEXTGEN_RESPONSE_CACHE backend: {kind!r}")
+
+
+cache = build_response_cache()
+metrics.registry.gauge('textgen_response_cache_hit_ratio', 'Share of deterministic requests answered from cache.',
+                       lambda: cache.snapshot()['hit_rate'] if cache else None)
+
+
+def applies(params: ResolvedSettings) -> bool:
+    """Whether responses for ``params`` are looked up and stored at all."""
+    return cache is not None and is_deterministic(params)
+
+
+def lookup(params: ResolvedSettings, prompt: str) -> tuple[str, Optional[str]]:
+    """Returns the X-Cache status and the cached response (None unless it is a hit).
+
+    ``prompt`` is the text the model is given, after retrieval added any earlier turns.
+    """
+    if not applies(params):
+        return BYPASS, None
+    response = cache.get(cache_key(params, prompt))
+    return (HIT, response) if response is not None else (MISS, None)
+
+
+def store(params: ResolvedSettings, prompt: str, response: str) -> None:
+    if response and applies(params):
+        cache.set(cache_key(params, prompt), response)
@@ -0,0 +1,211 @@
+import logging
+import threading
+import time
+from typing import Optional
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections
+from . import metrics
+from .model_registry import registry
+from .models import Chat
+from .persistence import chat_writer
+from .scheduler import scheduler
+from .vector_index import VectorIndex, normalize
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Retrieval Defaults (overridable in settings.py) ---
+DEFAULT_EMBEDDING_MODEL_PATH = None  # None disables embeddings and retrieval
+DEFAULT_EMBEDDING_N_CTX = 512
+DEFAULT_EMBEDDING_THREADS = 2
+DEFAULT_RETRIEVAL_TOP_K = 3
+DEFAULT_RETRIEVAL_MIN_SCORE = 0.5
+DEFAULT_INDEX_INTERVAL = 30.0  # seconds between checks for chats that are not indexed yet
+# Small batches keep the embedding model free for a request's query within a fraction of a second
+INDEX_BATCH_SIZE = 8
+# Longer texts are cut before embedding; a turn's gist is near its start
+EMBED_TEXT_CHARS = 2000
+CONTEXT_TURN_CHARS = 600
+CONTEXT_HEADER = "Relevant earlier conversation:"
+QUESTION_HEADER = "Current message:"
+
+
+def embedding_model_path() -> Optional[str]:
+    return getattr(settings, 'TEXTGEN_EMBEDDING_MODEL_PATH', DEFAULT_EMBEDDING_MODEL_PATH)
+
+
+def enabled() -> bool:
+    return bool(embedding_model_path())
+
+
+class Embedder:
+    """A small model loaded with ``embedding=True``, kept apart from the generation models.
+
+    It is not part of the model registry, so loading it never evicts the
+    chat model; embedding models are a few hundred MB at most.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._model = None
+        self._model_path: Optional[str] = None
+
+    def _get(self):
+        # Caller must hold self._lock
+        path = embedding_model_path()
+        if self._model is None or self._model_path != path:
+            logger.info(f"Loading embedding model: {path}")
+            started = time.perf_counter()
+            self._model = registry.loader(
+                model_path=path,
+                embedding=True,
+                n_ctx=getattr(settings, 'TEXTGEN_EMBEDDING_N_CTX', DEFAULT_EMBEDDING_N_CTX),
+                n_batch=getattr(settings, 'TEXTGEN_EMBEDDING_N_CTX', DEFAULT_EMBEDDING_N_CTX),
+                n_threads=getattr(settings, 'TEXTGEN_EMBEDDING_THREADS', DEFAULT_EMBEDDING_THREADS),
+                verbose=False,
+            )
+            self._model_path = path
+            logger.info(f"Loaded embedding model in {time.perf_counter() - started:.2f}s")
+        return self._model
+
+    def embed(self, texts: list[str]) -> tuple[np.ndarray, int]:
+        """Returns unit-length float32 vectors for ``texts`` and the number of tokens they took."""
+        texts = [text[:EMBED_TEXT_CHARS] for text in texts]
+        with self._lock:
+            model = self._get()
+            token_count = sum(len(model.tokenize(text.encode('utf-8'))) for text in texts)
+            embeddings = model.embed(texts, normalize=False, truncate=True)
+        vectors = []
+        for embedding in embeddings:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            # Models without a pooling layer return one vector per token; average them
+            vectors.append(embedding.mean(axis=0) if embedding.ndim == 2 else embedding)
+        return normalize(np.stack(vectors)), token_count
+
+
+embedder = Embedder()
+
+_index_lock = threading.Lock()
+_index: Optional[VectorIndex] = None
+
+
+def get_index() -> VectorIndex:
+    """The chat index, stored next to the database; rebuilt when the embedding model changes."""
+    global _index
+    with _index_lock:
+        if _index is None or _index.model != embedding_model_path():
+            directory = getattr(settings, 'TEXTGEN_VECTOR_INDEX_DIR', None) or settings.BASE_DIR / '.vector_index'
+            _index = VectorIndex(directory, model=embedding_model_path() or '')
+        return _index
+
+
+def _chat_text(prompt: str, response: str) -> str:
+    return f"{prompt}\n{response}"
+
+
+class Indexer:
+    """Embeds new chats on a background thread, a few at a time, when generation is idle."""
+
+    def __init__(self, interval: float = DEFAULT_INDEX_INTERVAL):
+        self.interval = interval
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def notify(self) -> None:
+        """Asks the indexer to look for new chats soon (starting it if needed)."""
+        if not enabled():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='textgen-indexer', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                # Rows saved by the write-behind buffer must be in the table before they can be read
+                chat_writer.flush()
+                self.catch_up()
+            except Exception as e:
+                logger.error(f"Indexing chats failed: {e}")
+            finally:
+                close_old_connections()
+
+    def catch_up(self) -> int:
+        """Embeds every chat newer than the index; returns how many were added."""
+        index = get_index()
+        added = 0
+        while True:
+            # Waiting requests come first; this thread shares the CPU with them
+            while scheduler.queue_size():
+                time.sleep(1.0)
+            rows = list(Chat.objects.filter(id__gt=index.last_id).order_by('id')
+                        .values_list('id', 'prompt', 'response')[:INDEX_BATCH_SIZE])
+            if not rows:
+                break
+            vectors, _ = embedder.embed([_chat_text(prompt, response) for _, prompt, response in rows])
+            index.add([chat_id for chat_id, _, _ in rows], vectors)
+            added += len(rows)
+        if added:
+            logger.info(f"Indexed {added} chats ({len(index)} in the vector index)")
+        return added
+
+
+indexer = Indexer(interval=getattr(settings, 'TEXTGEN_INDEX_INTERVAL', DEFAULT_INDEX_INTERVAL))
+
+
+def retrieve(text: str, top_k: Optional[int] = None) -> list[Chat]:
+    """Returns up to ``top_k`` earlier chats similar to ``text``, most similar first."""
+    top_k = getattr(settings, 'TEXTGEN_RETRIEVAL_TOP_K', DEFAULT_RETRIEVAL_TOP_K) if top_k is None else top_k
+    if not enabled() or top_k <= 0:
+        return []
+    index = get_index()
+    if not len(index):
+        return []
+    started = time.perf_counter()
+    vectors, _ = embedder.embed([text])
+    min_score = getattr(settings, 'TEXTGEN_RETRIEVAL_MIN_SCORE', DEFAULT_RETRIEVAL_MIN_SCORE)
+    # Extra candidates make up for chats deleted since they were indexed
+    hits = [(chat_id, score) for chat_id, score in index.search(vectors[0], 2 * top_k) if score >= min_score]
+    chats = Chat.objects.in_bulk([chat_id for chat_id, _ in hits])
+    found, seen = [], set()
+    for chat_id, _ in hits:
+        chat = chats.get(chat_id)
+        # The same question asked twice would otherwise fill the context with copies of one turn
+        if chat is not None and (chat.prompt, chat.response) not in seen:
+            seen.add((chat.prompt, chat.response))
+            found.append(chat)
+    found = found[:top_k]
+    metrics.retrieval_seconds.observe(time.perf_counter() - started)
+    logger.debug(f"Retrieved {len(found)} earlier chats in {time.perf_counter() - started:.3f}s")
+    return found
+
+
+def _clip(text: str) -> str:
+    return text if len(text) <= CONTEXT_TURN_CHARS else text[:CONTEXT_TURN_CHARS].rstrip() + '…'
+
+
+def augment(prompt: str) -> str:
+    """Puts the most relevant earlier turns in front of ``prompt``; returns it unchanged if there are none."""
+    try:
+        chats = retrieve(prompt)
+    except Exception as e:
+        # Retrieval only adds context; a broken embedding model must not fail the request
+        logger.error(f"Retrieval failed, generating without earlier context: {e}")
+        return prompt
+    if not chats:
+        return prompt
+    # Oldest first, so the context reads like the conversation it came from
+    turns = '\n\n'.join(f"User: {_clip(chat.prompt)}\nAssistant: {_clip(chat.response)}"
+                        for chat in sorted(chats, key=lambda chat: chat.id))
+    return f"{CONTEXT_HEADER}\n\n{turns}\n\n{QUESTION_HEADER}\n{prompt}"
+
+
+metrics.registry.gauge('textgen_vector_index_vectors', 'Chats in the retrieval vector index.',
+                       lambda: len(_index) if _index is not None else None)
@@ -0,0 +1,340 @@
+import asyncio
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, Future
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Iterator, Optional
+from django.conf import settings
+from django.db import close_old_connections
+from . import metrics
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Scheduler Defaults (overridable in settings.py) ---
+DEFAULT_WORKERS = 1
+DEFAULT_MAX_QUEUE_SIZE = 8
+DEFAULT_REQUEST_TIMEOUT = 300  # seconds, measured from the moment the request is queued
+DEFAULT_PRIORITY = 10  # lower runs first; ties are served in FIFO order
+INTERACTIVE_PRIORITY = 0
+
+_STREAM_END = object()
+
+
+class QueueFull(Exception):
+    """Raised when the scheduler cannot accept more work right now."""
+
+    def __init__(self, queue_size: int, retry_after: int):
+        super().__init__(f"Generation queue is full ({queue_size} requests waiting)")
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+
+
+class GenerationTimeout(Exception):
+    """Raised when a request did not finish within its deadline."""
+
+
+class GenerationCancelled(Exception):
+    """Raised when a request was cancelled by its client before it finished."""
+
+
+class _Job:
+    def __init__(self, func: Callable, args: tuple, kwargs: dict, priority: int, timeout: float,
+                 request_id: Optional[str] = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.deadline = self.enqueued_at + timeout
+        self.future: Future = Future()
+        self.cancelled = threading.Event()
+        self.position = 0  # requests already waiting when this one was queued
+        self.waiting = True  # counted in GenerationScheduler._waiting until started or cancelled
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+
+# The job a worker thread is running, so generation code can find its cancel flag and deadline
+_current_job: ContextVar[Optional[_Job]] = ContextVar('textgen_current_job', default=None)
+
+
+def current_job() -> Optional[_Job]:
+    """The job being run on this inference worker, or None outside the scheduler."""
+    return _current_job.get()
+
+
+class GenerationScheduler:
+    """Runs generation jobs on a fixed pool of inference workers.
+
+    Views submit work here instead of calling into llama_cpp from their own
+    threads, so the number of concurrent decodes is bounded by ``num_workers``
+    regardless of how many requests arrive. Requests beyond ``max_queue_size``
+    are rejected with ``QueueFull`` instead of piling up. Every job has a
+    request id under which ``cancel`` can stop it, queued or running.
+    """
+
+    def __init__(self, num_workers: int = DEFAULT_WORKERS, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+                 request_timeout: float = DEFAULT_REQUEST_TIMEOUT):
+        self.num_workers = max(1, num_workers)
+        self.max_queue_size = max(1, max_queue_size)
+        self.request_timeout = request_timeout
+        self._queue: "queue.PriorityQueue[tuple[int, int, _Job]]" = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._workers: list[threading.Thread] = []
+        self._jobs: dict[str, _Job] = {}  # unfinished jobs by request id
+        # Jobs still waiting to start; the queue also holds cancelled ones until a worker pops them
+        self._waiting = 0
+
+    def queue_size(self) -> int:
+        return self._waiting
+
+    def cancel(self, request_id: str) -> bool:
+        """Cancels the unfinished job with ``request_id``; returns False if there is none.
+
+        A queued job never starts. A running one is stopped at its next token
+        by the stopping criterion in ``deadlines.py``.
+        """
+        with self._lock:
+            job = self._jobs.get(request_id)
+        if job is None:
+            return False
+        _cancel(job)
+        logger.info(f"Cancelled generation request {request_id}")
+        return True
+
+    def submit(self, func: Callable, *args, priority: int = DEFAULT_PRIORITY, timeout: Optional[float] = None,
+               request_id: Optional[str] = None, **kwargs) -> Future:
+        """Queues ``func(*args, **kwargs)`` and returns a future for its result."""
+        return self._enqueue(_Job(func, args, kwargs, priority, timeout or self.request_timeout, request_id)).future
+
+    def run(self, func: Callable, *args, priority: int = DEFAULT_PRIORITY, timeout: Optional[float] = None,
+            request_id: Optional[str] = None, **kwargs):
+        """Queues ``func`` and blocks until it has run on an inference worker."""
+        job = self._enqueue(_Job(func, args, kwargs, priority, timeout or self.request_timeout, request_id))
+        try:
+            return job.future.result(timeout=max(0.0, job.remaining()))
+        except TimeoutError:
+            job.cancelled.set()
+            # Frees its queue slot if it has not started
+            job.future.cancel()
+            raise GenerationTimeout(f"Generation did not finish within {self.request_timeout}s")
+        except CancelledError:
+            raise GenerationCancelled("Generation was cancelled") from None
+
+    async def arun(self, func: Callable, *args, priority: int = DEFAULT_PRIORITY, timeout: Optional[float] = None,
+                   request_id: Optional[str] = None, **kwargs):
+        """Async variant of ``run``: awaits the worker without blocking a thread.
+
+        If the awaiting task is cancelled (an ASGI client disconnecting), the
+        job is cancelled with it.
+        """
+        job = self._enqueue(_Job(func, args, kwargs, priority, timeout or self.request_timeout, request_id))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(job.future), timeout=max(0.0, job.remaining()))
+        except asyncio.TimeoutError:
+            job.cancelled.set()
+            job.future.cancel()
+            raise GenerationTimeout(f"Generation did not finish within {self.request_timeout}s")
+        except asyncio.CancelledError:
+            if job.cancelled.is_set():
+                # cancel() was called while the job was queued; the awaiting task itself carries on
+                raise GenerationCancelled("Generation was cancelled") from None
+            _cancel(job)
+            raise
+
+    def stream(self, gen_func: Callable[..., Iterator], *args, priority: int = INTERACTIVE_PRIORITY,
+               timeout: Optional[float] = None, request_id: Optional[str] = None, **kwargs) -> Iterator:
+        """Queues a generator function and relays what it yields from the worker thread.
+
+        The job is queued eagerly, so ``QueueFull`` is raised here rather than
+        once iteration starts. Closing the returned iterator cancels the job,
+        whether it is still waiting or already producing output.
+        """
+        events: "queue.Queue" = queue.Queue()
+        job = self._enqueue_stream(gen_func, args, kwargs, priority, timeout, request_id, events.put)
+
+        def consume():
+            try:
+                if job.position:
+                    yield {'event': 'queued', 'position': job.position}
+                while True:
+                    try:
+                        event = events.get(timeout=max(0.0, job.remaining()))
+                    except queue.Empty:
+                        job.cancelled.set()
+                        raise GenerationTimeout(f"Generation did not finish within {self.request_timeout}s")
+                    if event is _STREAM_END:
+                        _raise_job_error(job)
+                        return
+                    yield event
+            finally:
+                # A no-op once the job finished; otherwise the client went away
+                _cancel(job)
+
+        return consume()
+
+    def astream(self, gen_func: Callable[..., Iterator], *args, priority: int = INTERACTIVE_PRIORITY,
+                timeout: Optional[float] = None, request_id: Optional[str] = None, **kwargs) -> AsyncIterator:
+        """Async variant of ``stream`` for ASGI views; must be called from the event loop."""
+        loop = asyncio.get_running_loop()
+        events: "asyncio.Queue" = asyncio.Queue()
+
+        def put(event):
+            try:
+                loop.call_soon_threadsafe(events.put_nowait, event)
+            except RuntimeError:
+                # The event loop is gone, so nobody is listening any more
+                job.cancelled.set()
+
+        job = self._enqueue_stream(gen_func, args, kwargs, priority, timeout, request_id, put)
+
+        async def consume():
+            try:
+                if job.position:
+                    yield {'event': 'queued', 'position': job.position}
+                while True:
+                    try:
+                        event = await asyncio.wait_for(events.get(), timeout=max(0.0, job.remaining()))
+                    except asyncio.TimeoutError:
+                        job.cancelled.set()
+                        raise GenerationTimeout(f"Generation did not finish within {self.request_timeout}s")
+                    if event is _STREAM_END:
+                        _raise_job_error(job)
+                        return
+                    yield event
+            finally:
+                _cancel(job)
+
+        return consume()
+
+    def _enqueue_stream(self, gen_func: Callable[..., Iterator], args: tuple, kwargs: dict, priority: int,
+                        timeout: Optional[float], request_id: Optional[str], put: Callable) -> _Job:
+        def produce():
+            generator = gen_func(*args, **kwargs)
+            try:
+                for event in generator:
+                    if job.cancelled.is_set():
+                        break
+                    put(event)
+            finally:
+                generator.close()
+            if job.cancelled.is_set():
+                raise GenerationCancelled("Generation was cancelled")
+
+        job = _Job(produce, (), {}, priority, timeout or self.request_timeout, request_id)
+        # Fires on success, failure, expiry and cancellation alike
+        job.future.add_done_callback(lambda future: put(_STREAM_END))
+        return self._enqueue(job)
+
+    def _enqueue(self, job: _Job) -> _Job:
+        with self._lock:
+            # A client reusing the id of its unfinished request (a resubmit) replaces that request
+            superseded = self._jobs.get(job.request_id)
+            waiting = self._waiting - (1 if superseded is not None and superseded.waiting else 0)
+            if waiting >= self.max_queue_size:
+                raise QueueFull(waiting, retry_after=self._retry_after_hint(waiting))
+            if superseded is not None and superseded.waiting:
+                # Cancelled below, so its slot goes to the resubmitted request
+                superseded.waiting = False
+                self._waiting -= 1
+            job.position = waiting
+            self._jobs[job.request_id] = job
+            self._queue.put((job.priority, next(self._sequence), job))
+            self._waiting += 1
+            self._ensure_workers()
+        # Cancelling a queued job completes its future, so this also frees its slot
+        job.future.add_done_callback(lambda future: self._forget(job))
+        if superseded is not None:
+            _cancel(superseded)
+            logger.info(f"Request {job.request_id} was resubmitted; cancelled the earlier one")
+        logger.debug(f"Queued generation job {job.request_id} (priority={job.priority}, waiting={waiting + 1})")
+        return job
+
+    def _forget(self, job: _Job) -> None:
+        self._leave_queue(job)
+        with self._lock:
+            if self._jobs.get(job.request_id) is job:
+                del self._jobs[job.request_id]
+
+    def _leave_queue(self, job: _Job) -> None:
+        # Called when a job starts and when it finishes; only the first call counts
+        with self._lock:
+            if job.waiting:
+                job.waiting = False
+                self._waiting -= 1
+
+    def _retry_after_hint(self, waiting: int) -> int:
+        # A rough guess: every waiting request needs a few seconds per worker
+        return max(1, int(waiting * 5 / self.num_workers))
+
+    def _ensure_workers(self) -> None:
+        # Caller must hold self._lock; workers are started lazily so management commands never spawn them
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        while len(self._workers) < self.num_workers:
+            worker = threading.Thread(target=self._work, name=f"textgen-worker-{len(self._workers)}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self) -> None:
+        while True:
+            _, _, job = self._queue.get()
+            self._leave_queue(job)
+            try:
+                if job.cancelled.is_set():
+                    job.future.cancel()
+                    continue
+                # Returns False if cancel() got to the job first
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                if job.remaining() <= 0:
+                    job.future.set_exception(GenerationTimeout("Request expired while waiting in the queue"))
+                    continue
+                waited = time.monotonic() - job.enqueued_at
+                metrics.queue_wait.observe(waited)
+                logger.debug(f"Starting generation job {job.request_id} after {waited:.2f}s in queue")
+                token = _current_job.set(job)
+                try:
+                    job.future.set_result(job.func(*job.args, **job.kwargs))
+                except Exception as e:
+                    job.future.set_exception(e)
+                finally:
+                    _current_job.reset(token)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+
+def _cancel(job: _Job) -> None:
+    if job.future.done() or job.cancelled.is_set():
+        return
+    job.cancelled.set()
+    metrics.generations_cancelled.inc()
+    # Only succeeds while the job is queued; a running job stops at its next token
+    job.future.cancel()
+
+
+def _raise_job_error(job: _Job) -> None:
+    if job.future.cancelled():
+        raise GenerationCancelled("Generation was cancelled")
+    if job.future.exception() is not None:
+        raise job.future.exception()
+
+
+scheduler = GenerationScheduler(
+    # Every sequence in a batch engine keeps its worker waiting for tokens, so there must be enough of them
+    num_workers=max(getattr(settings, 'TEXTGEN_SCHEDULER_WORKERS', DEFAULT_WORKERS),
+                    getattr(settings, 'TEXTGEN_PARALLEL_SEQUENCES', 1)),
+    max_queue_size=getattr(settings, 'TEXTGEN_SCHEDULER_MAX_QUEUE', DEFAULT_MAX_QUEUE_SIZE),
+    request_timeout=getattr(settings, 'TEXTGEN_REQUEST_TIMEOUT', DEFAULT_REQUEST_TIMEOUT),
+)
+
+metrics.registry.gauge('textgen_queue_size', 'Requests waiting for an inference worker.', scheduler.queue_size)
@@ -0,0 +1,85 @@
+import logging
+import re
+from typing import Optional
+from django.db import DatabaseError
+from django.utils.html import escape
+from .models import Chat
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Search Defaults ---
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+MAX_QUERY_TERMS = 12
+PROMPT_SNIPPET_TOKENS = 10
+RESPONSE_SNIPPET_TOKENS = 24
+# bm25 column weights: a match in the prompt ranks above the same match in the response
+PROMPT_WEIGHT = 2.0
+RESPONSE_WEIGHT = 1.0
+# Control characters cannot occur in FTS tokens, so they safely mark matches until the text is escaped
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+# textgen_chat_fts is an external-content FTS5 index over textgen_chat kept in sync by triggers
+# (see migration 0010_chat_search), so it stores only the index, not a second copy of the text
+_SEARCH_SQL = f"""
+    SELECT c.id, c.timestamp,
+           snippet(textgen_chat_fts, 0, %s, %s, '…', {PROMPT_SNIPPET_TOKENS}) AS prompt_snippet,
+           snippet(textgen_chat_fts, 1, %s, %s, '…', {RESPONSE_SNIPPET_TOKENS}) AS response_snippet
+    FROM textgen_chat_fts
+    JOIN textgen_chat c ON c.id = textgen_chat_fts.rowid
+    WHERE textgen_chat_fts MATCH %s
+    ORDER BY bm25(textgen_chat_fts, {PROMPT_WEIGHT}, {RESPONSE_WEIGHT}), c.id DESC
+    LIMIT %s OFFSET %s
+"""
+
+
+def match_expression(query: str) -> Optional[str]:
+    """Turns free text into an FTS5 query: every word must match, the last one as a prefix.
+
+    Words are quoted, so FTS5 operators and punctuation typed by the user
+    are searched for literally instead of raising a syntax error.
+    """
+    terms = _TERM.findall(query)[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    # Prefix match on the last word so results appear while it is still being typed
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def _highlight(snippet: str) -> str:
+    return escape(snippet).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def search_chats(query: str, page: int = 1, limit: int = DEFAULT_PAGE_SIZE) -> tuple[list[dict], Optional[int]]:
+    """Returns one page of chats matching ``query``, best first, and the next page number.
+
+    Snippets are HTML-escaped with matches wrapped in ``<mark>``.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return [], None
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    page = max(1, page)
+    params = [_MARK_START, _MARK_END, _MARK_START, _MARK_END, expression, limit + 1, (page - 1) * limit]
+    try:
+        # One row more than the page tells whether another page exists without counting every match
+        rows = list(Chat.objects.raw(_SEARCH_SQL, params))
+    except DatabaseError as e:
+        logger.error(f"Chat search for {query!r} failed: {e}")
+        return [], None
+    items = [
+        {
+            'id': chat.id,
+            'timestamp': chat.timestamp,
+            'prompt_snippet': _highlight(chat.prompt_snippet),
+            'response_snippet': _highlight(chat.response_snippet),
+        }
+        for chat in rows[:limit]
+    ]
+    return items, page + 1 if len(rows) > limit else None
@@ -0,0 +1,203 @@
+import dataclasses
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from .defaults import (
+    DEFAULT_BATCH_SIZE, DEFAULT_CHAT_FORMAT, DEFAULT_CONTEXT_LENGTH, DEFAULT_DRAFT_TOKENS, DEFAULT_GPU_LAYERS,
+    DEFAULT_MAX_TOKENS, DEFAULT_MODEL_PATH, DEFAULT_ROLE, DEFAULT_SEED, DEFAULT_SPECULATIVE, DEFAULT_STOP_TOKENS,
+    DEFAULT_SYSTEM_PROMPT, DEFAULT_TEMPERATURE, DEFAULT_THREADS, DEFAULT_THREADS_BATCH,
+    DEFAULT_TOP_K, DEFAULT_TOP_P, DEFAULT_VERBOSE,
+)
+from .model_registry import ModelKey
+from .models import TextGenerationSettings
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+class InvalidOverride(ValueError):
+    """Raised when a request's generation parameter cannot be used as the setting it overrides."""
+
+    def __init__(self, name: str, value, expected: str = ''):
+        super().__init__(f"Invalid value for '{name}': {value!r}" + (f" (must be {expected})" if expected else ''))
+        self.name = name
+
+
+# Bounds (inclusive, None for open) of overridable sampling settings; llama_cpp treats max_tokens <= 0 as
+# "until the context is full", which the memory governor's large-request check would not catch
+OVERRIDE_RANGES = {
+    'temperature': (0.0, None),
+    'top_p': (0.0, 1.0),
+    'top_k': (0, None),
+    'max_tokens': (1, None),
+}
+
+
+def _check_range(name: str, value) -> None:
+    low, high = OVERRIDE_RANGES.get(name, (None, None))
+    # Written so NaN fails both comparisons
+    if (low is not None and not value >= low) or (high is not None and not value <= high):
+        expected = f"between {low} and {high}" if high is not None else f"at least {low}"
+        raise InvalidOverride(name, value, expected)
+
+
+@dataclass(frozen=True)
+class ResolvedSettings:
+    """One role's generation and model-loader settings with every default filled in."""
+    role: str = DEFAULT_ROLE
+    model_path: str = DEFAULT_MODEL_PATH
+    chat_format: str = DEFAULT_CHAT_FORMAT
+    temperature: float = DEFAULT_TEMPERATURE
+    max_tokens: int = DEFAULT_MAX_TOKENS
+    top_p: float = DEFAULT_TOP_P
+    top_k: int = DEFAULT_TOP_K
+    seed: int = DEFAULT_SEED
+    n_ctx: int = DEFAULT_CONTEXT_LENGTH
+    n_threads: int = DEFAULT_THREADS
+    n_threads_batch: int = DEFAULT_THREADS_BATCH
+    n_batch: int = DEFAULT_BATCH_SIZE
+    n_gpu_layers: int = DEFAULT_GPU_LAYERS
+    stop: tuple[str, ...] = tuple(DEFAULT_STOP_TOKENS)
+    system_prompt: str = DEFAULT_SYSTEM_PROMPT
+    auto_tune: bool = False
+    speculative: str = DEFAULT_SPECULATIVE
+    draft_model_path: str = ''
+    draft_tokens: int = DEFAULT_DRAFT_TOKENS
+    # Set by the memory governor, not stored per settings row
+    use_mmap: bool = True
+    use_mlock: bool = False
+    type_k: Optional[int] = None
+    type_v: Optional[int] = None
+    flash_attn: bool = False
+
+    @classmethod
+    def from_model(cls, row: TextGenerationSettings) -> "ResolvedSettings":
+        values = {}
+        for field in dataclasses.fields(cls):
+            value = getattr(row, field.name, None)
+            if value is not None and value != '':
+                values[field.name] = value
+        return cls(**values)
+
+    def with_overrides(self, **overrides) -> "ResolvedSettings":
+        """Returns a copy with every non-empty override applied and cast to the field's type.
+
+        Raises ``InvalidOverride`` for values that cannot be cast (e.g. ``"abc"`` as a temperature)
+        or fall outside ``OVERRIDE_RANGES``.
+        """
+        changes = {}
+        for name, value in overrides.items():
+            if value is None or value == '':
+                continue
+            current = getattr(self, name)
+            if isinstance(value, (dict, list)) and not isinstance(current, tuple):
+                # int([]) fails but str({}) would not; neither is a usable setting
+                raise InvalidOverride(name, value)
+            try:
+                changes[name] = tuple(value) if isinstance(current, tuple) else type(current)(value)
+            except (TypeError, ValueError, OverflowError):
+                raise InvalidOverride(name, value) from None
+            _check_range(name, changes[name])
+        return dataclasses.replace(self, **changes) if changes else self
+
+    def model_key(self) -> ModelKey:
+        return ModelKey(
+            model_path=self.model_path,
+            chat_format=self.chat_format,
+            n_ctx=self.n_ctx,
+            n_threads=self.n_threads,
+            n_threads_batch=self.n_threads_batch,
+            n_gpu_layers=self.n_gpu_layers,
+            n_batch=self.n_batch,
+            speculative=self.speculative,
+            draft_model_path=self.draft_model_path if self.speculative == 'draft_model' else '',
+            draft_tokens=self.draft_tokens if self.speculative else 0,
+            use_mmap=self.use_mmap,
+            use_mlock=self.use_mlock,
+            type_k=self.type_k,
+            type_v=self.type_v,
+            flash_attn=self.flash_attn,
+        )
+
+    def load_kwargs(self) -> dict:
+        # Loader parameters that do not change which model instance is shared
+        return {'verbose': DEFAULT_VERBOSE}
+
+    def sampling_kwargs(self) -> dict:
+        kwargs = {
+            'temperature': self.temperature,
+            'max_tokens': self.max_tokens,
+            'top_p': self.top_p,
+            'top_k': self.top_k,
+        }
+        # -1 asks llama.cpp for a random seed, which is what not passing one does
+        if self.seed != -1:
+            kwargs['seed'] = self.seed
+        return kwargs
+
+
+def validate_overrides(**overrides) -> None:
+    """Raises ``InvalidOverride`` now for a request whose generation parameters could never be applied."""
+    ResolvedSettings().with_overrides(**overrides)
+
+
+_lock = threading.Lock()
+_by_role: dict[str, ResolvedSettings] = {}
+_default_role: Optional[str] = None
+# Bumped by every invalidate(), so a read that raced with one is not cached
+_generation = 0
+
+
+def get_settings(role: Optional[str] = None) -> ResolvedSettings:
+    """Returns the settings for ``role``, hitting the database only on the first call."""
+    role = role or DEFAULT_ROLE
+    with _lock:
+        resolved = _by_role.get(role)
+        generation = _generation
+    if resolved is not None:
+        return resolved
+
+    try:
+        row = TextGenerationSettings.objects.filter(role=role).first()
+        logger.debug(f"Fetched settings for role '{role}': {row}")
+    except Exception as e:
+        # Not cached, so the next request tries the database again
+        logger.error(f"Error fetching settings for role '{role}' from database: {e}")
+        return ResolvedSettings(role=role)
+
+    resolved = ResolvedSettings.from_model(row) if row else ResolvedSettings(role=role)
+    with _lock:
+        # A save that invalidated the cache after the read may not be in ``row``; the next call reads again
+        if generation == _generation:
+            _by_role[role] = resolved
+    return resolved
+
+
+def ensure_default_settings() -> ResolvedSettings:
+    """Creates the 'default' settings row once per process and returns its resolved settings."""
+    global _default_role
+    if _default_role is None:
+        row, created = TextGenerationSettings.objects.get_or_create(
+            identifier='default',
+            defaults={
+                'role': DEFAULT_ROLE,
+                'temperature': DEFAULT_TEMPERATURE,
+                'model_path': DEFAULT_MODEL_PATH,
+                'max_tokens': DEFAULT_MAX_TOKENS,
+                'top_p': DEFAULT_TOP_P,
+                'top_k': DEFAULT_TOP_K,
+                'seed': DEFAULT_SEED,
+            }
+        )
+        _default_role = row.role
+    return get_settings(_default_role)
+
+
+def invalidate() -> None:
+    global _default_role, _generation
+    with _lock:
+        _by_role.clear()
+        _default_role = None
+        _generation += 1
+    logger.debug("Text generation settings cache invalidated")
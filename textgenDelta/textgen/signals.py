@@ -0,0 +1,17 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from . import autotune, settings_cache
+from .models import ModelProfile, TextGenerationSettings
+
+
+@receiver([post_save, post_delete], sender=TextGenerationSettings)
+def invalidate_settings_cache(sender, **kwargs):
+    settings_cache.invalidate()
+    # A read between the save and its commit still sees the old row, so invalidate again once it is visible
+    transaction.on_commit(settings_cache.invalidate)
+
+
+@receiver([post_save, post_delete], sender=ModelProfile)
+def invalidate_model_profiles(sender, **kwargs):
+    autotune.invalidate()
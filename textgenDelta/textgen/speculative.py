@@ -0,0 +1,153 @@
+import logging
+from typing import TYPE_CHECKING, Optional
+import numpy as np
+from . import metrics
+from .defaults import DEFAULT_DRAFT_TOKENS
+
+if TYPE_CHECKING:
+    import llama_cpp
+    from llama_cpp.llama_speculative import LlamaDraftModel
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Speculative Decoding Defaults ---
+PROMPT_LOOKUP = 'prompt_lookup'
+DRAFT_MODEL = 'draft_model'
+PROMPT_LOOKUP_MAX_NGRAM = 2
+# Token ids whose text is compared to decide whether two vocabularies are the same
+VOCAB_PROBE_IDS = (0, 1, 2, 100, 1000, 5000, 10000, 20000, 30000)
+
+draft_tokens_proposed = metrics.registry.counter(
+    'textgen_draft_tokens_proposed_total', 'Tokens proposed by the speculative draft.')
+draft_tokens_accepted = metrics.registry.counter(
+    'textgen_draft_tokens_accepted_total', 'Draft tokens the main model accepted.')
+acceptance_rate = metrics.registry.histogram(
+    'textgen_draft_acceptance_rate', 'Share of draft tokens accepted per completion.',
+    (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+metrics.registry.gauge(
+    'textgen_draft_acceptance_ratio', 'Share of draft tokens the main model accepted.',
+    lambda: draft_tokens_accepted.value / draft_tokens_proposed.value if draft_tokens_proposed.value else None)
+
+
+# The draft classes follow llama_cpp's LlamaDraftModel interface (a callable returning proposed tokens)
+# without subclassing it, so this module can be imported without loading the llama.cpp library
+
+class DraftLlama:
+    """Proposes tokens by greedily decoding with a small model that shares the main model's vocabulary."""
+
+    def __init__(self, model: "llama_cpp.Llama", num_pred_tokens: int = DEFAULT_DRAFT_TOKENS):
+        self.model = model
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        if len(input_ids) + self.num_pred_tokens > self.model.n_ctx():
+            # A decode past the draft's context would fail the main completion; propose nothing instead
+            return np.array([], dtype=np.intc)
+        proposed = []
+        # reset=True keeps the longest matching prefix in the draft's KV cache, so only new tokens are evaluated
+        for token in self.model.generate(input_ids.tolist(), top_k=1, temp=0.0, reset=True):
+            proposed.append(token)
+            if len(proposed) >= self.num_pred_tokens:
+                break
+        return np.array(proposed, dtype=np.intc)
+
+
+class CountingDraftModel:
+    """Wraps a draft model and counts how many of its proposals the main model kept.
+
+    llama_cpp calls the draft with the verified sequence so far, so the
+    tokens accepted from the previous proposal are the ones it has in common
+    with what follows that proposal's start.
+    """
+
+    def __init__(self, draft: "LlamaDraftModel"):
+        self.draft = draft
+        self._pending: Optional[tuple[int, np.ndarray]] = None
+        self.proposed = 0
+        self.accepted = 0
+
+    def begin(self) -> None:
+        """Starts counting for a new completion; call with the model's inference lock held."""
+        self._pending = None
+        self.proposed = 0
+        self.accepted = 0
+
+    def __call__(self, input_ids: np.ndarray, /, **kwargs) -> np.ndarray:
+        self._settle(input_ids)
+        proposal = self.draft(input_ids, **kwargs)
+        if len(proposal):
+            self._pending = (len(input_ids), proposal)
+        return proposal
+
+    def _settle(self, input_ids: np.ndarray) -> None:
+        if self._pending is None:
+            return
+        start, proposal = self._pending
+        self._pending = None
+        following = input_ids[start:start + len(proposal)]
+        mismatches = np.nonzero(following != proposal[:len(following)])[0]
+        accepted = int(mismatches[0]) if len(mismatches) else len(following)
+        self.proposed += len(proposal)
+        self.accepted += accepted
+        draft_tokens_proposed.inc(len(proposal))
+        draft_tokens_accepted.inc(accepted)
+
+    def finish(self) -> Optional[float]:
+        """Records and returns this completion's acceptance rate (None if nothing was proposed)."""
+        # The last proposal was cut short by a stop condition, so it says nothing about the draft
+        self._pending = None
+        if not self.proposed:
+            return None
+        rate = self.accepted / self.proposed
+        acceptance_rate.observe(rate)
+        return rate
+
+
+def counting_draft(model) -> Optional[CountingDraftModel]:
+    draft = getattr(model, 'draft_model', None)
+    return draft if isinstance(draft, CountingDraftModel) else None
+
+
+def vocabularies_match(main: "llama_cpp.Llama", draft: "llama_cpp.Llama") -> bool:
+    if main.n_vocab() != draft.n_vocab():
+        return False
+    probe = [token for token in VOCAB_PROBE_IDS if token < main.n_vocab()]
+    return all(main.detokenize([token]) == draft.detokenize([token]) for token in probe)
+
+
+def build_draft_model(mode: str, draft_tokens: int) -> Optional[CountingDraftModel]:
+    """Returns the draft to pass to ``Llama(draft_model=...)``, or None when speculation is off.
+
+    A separate draft model is attached by ``attach_draft_llama`` once the
+    main model is loaded; until then (and if it turns out to be unusable)
+    prompt-lookup decoding stands in for it.
+    """
+    if not mode:
+        return None
+    if mode not in (PROMPT_LOOKUP, DRAFT_MODEL):
+        raise ValueError(f"Unknown speculative decoding mode: {mode!r}")
+    from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+    return CountingDraftModel(LlamaPromptLookupDecoding(
+        max_ngram_size=PROMPT_LOOKUP_MAX_NGRAM, num_pred_tokens=draft_tokens,
+    ))
+
+
+def attach_draft_llama(model: "llama_cpp.Llama", draft: CountingDraftModel, draft_model_path: str,
+                       draft_tokens: int, loader, **llama_kwargs) -> bool:
+    """Loads the draft model and hands it to ``draft``; returns False if prompt lookup stays in use."""
+    try:
+        # The draft is fed the whole verified sequence, so it needs the main model's context length
+        draft_llama = loader(model_path=draft_model_path, n_ctx=model.n_ctx(), **llama_kwargs)
+    except Exception as e:
+        logger.error(f"Could not load draft model {draft_model_path}, using prompt lookup instead: {e}")
+        return False
+    if not vocabularies_match(model, draft_llama):
+        # e.g. a Qwen draft for a Saiga (llama) model: token ids mean different things
+        logger.error(f"Draft model {draft_model_path} does not share the main model's vocabulary; "
+                     f"using prompt lookup instead")
+        return False
+    draft.draft = DraftLlama(draft_llama, num_pred_tokens=draft_tokens)
+    logger.info(f"Speculative decoding with draft model {draft_model_path}")
+    return True
@@ -0,0 +1,145 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from django.conf import settings
+from . import metrics
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Startup Defaults (overridable in settings.py) ---
+DEFAULT_PRELOAD_MODEL = True
+
+STARTING = 'starting'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+
+def _process_age() -> Optional[float]:
+    """Seconds since the OS started this process (Linux and Android), so interpreter and Django start-up count too."""
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name may contain spaces and parentheses; the fields after it are fixed
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimeline:
+    """When each start-up step happened, in seconds since the process started.
+
+    Falls back to the time this module was imported where ``/proc`` is not
+    available.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._origin = time.monotonic() - (_process_age() or 0.0)
+        self.events: list[dict] = []
+        self.state = STARTING
+        self.error: Optional[str] = None
+        self.ready_after: Optional[float] = None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._origin
+
+    def mark(self, event: str) -> None:
+        with self._lock:
+            self.events.append({'event': event, 'at': round(self.elapsed(), 3)})
+
+    @contextmanager
+    def step(self, event: str) -> Iterator[None]:
+        """Records ``event`` with the time the block took."""
+        at = self.elapsed()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.events.append({'event': event, 'at': round(at, 3), 'seconds': round(self.elapsed() - at, 3)})
+
+    def set_state(self, state: str, error: Optional[str] = None) -> None:
+        with self._lock:
+            self.state = state
+            self.error = error
+            if state == READY and self.ready_after is None:
+                self.ready_after = round(self.elapsed(), 3)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'ready': self.state == READY,
+                'error': self.error,
+                'uptime': round(self.elapsed(), 3),
+                'ready_after': self.ready_after,
+                'timeline': list(self.events),
+            }
+
+    def summary(self) -> str:
+        with self._lock:
+            steps = ', '.join(f"{e['event']} {e['seconds']:.2f}s" if 'seconds' in e else f"{e['event']} at {e['at']:.2f}s"
+                              for e in self.events)
+        return f"{steps}; {self.state} after {self.elapsed():.2f}s"
+
+
+timeline = StartupTimeline()
+metrics.registry.gauge('textgen_startup_seconds', 'Seconds from process start until the server was ready.',
+                       lambda: timeline.ready_after)
+
+
+def _preload() -> None:
+    timeline.set_state(LOADING)
+    try:
+        with timeline.step('import llama_cpp'):
+            import llama_cpp  # noqa: F401
+        from .generation import preload_default_model
+        with timeline.step('load default model'):
+            preload_default_model()
+    except Exception as e:
+        logger.error(f"Failed to preload the default model: {e}")
+        timeline.set_state(FAILED, str(e))
+        return
+    timeline.set_state(READY)
+    logger.info(f"Startup: {timeline.summary()}")
+    _start_indexer()
+
+
+def _start_indexer() -> None:
+    from .retrieval import indexer
+    # Embeds chats saved while the server was down (or all of them after switching embedding models)
+    indexer.notify()
+
+
+_start_lock = threading.Lock()
+_started = False
+
+
+def start() -> None:
+    """Starts background start-up work; called once by the WSGI and ASGI entry points.
+
+    ``manage.py runserver`` loads the WSGI entry point in the process that
+    serves requests, so management commands such as ``migrate`` never get
+    here and never load a model.
+    """
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    timeline.mark('server entry point')
+    if getattr(settings, 'TEXTGEN_PRELOAD_MODEL', DEFAULT_PRELOAD_MODEL):
+        # The model loads while the server starts accepting requests; the first one waits for it in the registry
+        threading.Thread(target=_preload, name='textgen-preload', daemon=True).start()
+        return
+    # Without preloading the first request loads the model, so there is nothing to wait for
+    timeline.set_state(READY)
+    logger.info(f"Startup: {timeline.summary()}")
+    _start_indexer()
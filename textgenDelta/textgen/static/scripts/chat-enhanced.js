@@ -123,6 +123,9 @@ function initEnhancedChat() {
         }
     });
 
+    // X-Request-ID of the stream in progress, so it can be cancelled
+    let activeRequestId = null;
+
     // Form Submission Handler
     form.addEventListener('submit', async function(event) {
         event.preventDefault();
@@ -168,60 +171,271 @@ function initEnhancedChat() {
         chatHistoryDiv.appendChild(messageContainer);
         chatHistoryDiv.scrollTop = chatHistoryDiv.scrollHeight; // Scroll to bottom
 
+        const aiBubble = messageContainer.querySelector('.message-ai .message-content');
+        let receivedText = '';
+        activeRequestId = newRequestId();
+
         try {
-            const response = await fetch('', {
+            const response = await fetch(form.dataset.streamUrl, {
                 method: 'POST',
-                body: new URLSearchParams({ 
-                    prompt: prompt, 
-                    role: role, 
-                    temperature: temp, 
-                    maxTokens: maxtokens, 
-                    topP: topp, 
-                    topK: topk, 
-                    model_path: modelpath 
+                body: JSON.stringify({
+                    prompt: prompt,
+                    role: role,
+                    temperature: temp,
+                    max_tokens: maxtokens,
+                    top_p: topp,
+                    top_k: topk,
+                    model_path: modelpath
                 }),
                 headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
+                    'Content-Type': 'application/json',
                     'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value,
+                    'X-Request-ID': activeRequestId,
                 },
             });
 
-            if (response.redirected) {
-                window.location.href = response.url;
+            if (response.status === 429) {
+                // Generation queue is full; the server tells us how long to back off
+                const busy = await response.json();
+                showNotification(`Server is busy (queue position ${busy.queue_position}). Retry in ${busy.retry_after}s.`, 'error');
+                throw new Error(busy.error);
             } else if (!response.ok) {
                 const errorText = await response.text();
                 throw new Error(`HTTP error! status: ${response.status}, details: ${errorText}`);
-            } else {
-                window.location.reload();
             }
 
+            await readEventStream(response, function(eventName, data) {
+                if (eventName === 'token') {
+                    if (!receivedText) {
+                        // First token: swap the typing indicator for the streamed text
+                        aiBubble.classList.remove('typing-indicator');
+                        aiBubble.textContent = '';
+                        loadingIndicator.classList.add('d-none');
+                    }
+                    receivedText += data.text;
+                    aiBubble.textContent = receivedText;
+                    chatHistoryDiv.scrollTop = chatHistoryDiv.scrollHeight;
+                } else if (eventName === 'done') {
+                    aiBubble.classList.remove('typing-indicator');
+                    aiBubble.textContent = data.response;
+                    addChatToSidebar(prompt, data.chat_id, data.timestamp);
+                } else if (eventName === 'error') {
+                    throw new Error(data.error);
+                }
+            });
+
         } catch (error) {
             console.error('Error submitting prompt:', error);
-            const aiBubble = messageContainer.querySelector('.message-ai .message-content');
             if (aiBubble) {
-                aiBubble.innerHTML = `<span class="text-danger">Error: ${error.message}</span>`;
+                aiBubble.classList.remove('typing-indicator');
+                aiBubble.innerHTML = `<span class="text-danger">Error: ${escapeHtml(error.message)}</span>`;
             }
         } finally {
-            if (promptInput.disabled && !loadingIndicator.classList.contains('d-none')) {
-                promptInput.disabled = false;
-                sendButton.disabled = false;
-                loadingIndicator.classList.add('d-none');
-            }
+            activeRequestId = null;
+            promptInput.disabled = false;
+            sendButton.disabled = false;
+            loadingIndicator.classList.add('d-none');
+            promptInput.value = '';
+            promptInput.style.height = 'auto';
+            promptInput.focus();
         }
     });
 
-    // Add click functionality to chat history items
-    document.querySelectorAll('.chat-history-list li').forEach(item => {
-        item.addEventListener('click', function() {
-            document.querySelectorAll('.chat-history-list li').forEach(i => i.classList.remove('active'));
-            this.classList.add('active');
-            
-            // Add ripple effect on click
-            createRippleEffect(this);
+    // Closing or reloading the tab stops the server generating an answer nobody will read
+    window.addEventListener('pagehide', function() {
+        if (activeRequestId) {
+            navigator.sendBeacon(form.dataset.cancelUrl.replace('REQUEST_ID', activeRequestId));
+        }
+    });
+
+    function addChatToSidebar(prompt, chatId, timestamp) {
+        const historyList = document.querySelector('.chat-history-list');
+        if (!historyList) return;
+
+        const emptyItem = historyList.querySelector('li:not([data-chat-id]):not(.history-sentinel)');
+        if (emptyItem) emptyItem.remove();
+
+        const item = document.createElement('li');
+        item.dataset.chatId = chatId;
+        const date = timestamp ? new Date(timestamp) : new Date();
+        const title = prompt.length > 30 ? prompt.slice(0, 29) + '…' : prompt;
+        item.innerHTML = `
+            <div class="chat-title">${escapeHtml(title)}</div>
+            <div class="chat-date">${date.toLocaleString([], { month: 'short', day: '2-digit', hour: '2-digit', minute: '2-digit' })}</div>
+        `;
+        historyList.prepend(item);
+    }
+
+    // Add click functionality to chat history items (delegated, so paged-in items work too)
+    const historyList = document.querySelector('.chat-history-list');
+    historyList.addEventListener('click', function(event) {
+        const item = event.target.closest('li[data-chat-id]');
+        if (!item) return;
+        historyList.querySelectorAll('li').forEach(i => i.classList.remove('active'));
+        item.classList.add('active');
+
+        // Add ripple effect on click
+        createRippleEffect(item);
+        showChat(item.dataset.chatId);
+    });
+
+    async function showChat(chatId) {
+        // Chats older than the first page are not rendered up front; fetch them on demand
+        let container = chatHistoryDiv.querySelector(`.message-container[data-chat-id="${chatId}"]`);
+        if (!container) {
+            try {
+                const response = await fetch(`${historyList.dataset.historyUrl}${chatId}/`);
+                if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                const chat = await response.json();
+                container = document.createElement('div');
+                container.className = 'message-container mb-3';
+                container.dataset.chatId = chat.id;
+                container.innerHTML = `
+                    <div class="message-user d-flex justify-content-end mb-1">
+                        <div class="message-bubble bg-primary text-white p-3 rounded">
+                            <div class="message-content">${escapeHtml(chat.prompt)}</div>
+                        </div>
+                    </div>
+                    <div class="message-ai d-flex justify-content-start mb-1">
+                        <div class="message-bubble bg-light border p-3 rounded">
+                            <div class="message-content">${escapeHtml(chat.response)}</div>
+                        </div>
+                    </div>
+                `;
+                chatHistoryDiv.appendChild(container);
+            } catch (error) {
+                console.error('Error loading chat:', error);
+                showNotification('Could not load this chat.', 'error');
+                return;
+            }
+        }
+        container.scrollIntoView({ behavior: 'smooth', block: 'start' });
+    }
+
+    initHistoryInfiniteScroll(historyList);
+    initHistorySearch(historyList, showChat);
+}
+
+function initHistorySearch(historyList, showChat) {
+    // Searches chats on the server (SQLite FTS5) and shows ranked results in place of the history list
+    const input = document.querySelector('.history-search');
+    const resultsList = document.querySelector('.search-results');
+    if (!input || !resultsList) return;
+
+    let debounceTimer = null;
+    let activeQuery = '';
+    let nextPage = null;
+
+    async function loadResults(query, page) {
+        const url = `${input.dataset.searchUrl}?q=${encodeURIComponent(query)}&page=${page}`;
+        const response = await fetch(url);
+        if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+        const result = await response.json();
+        // Ignore answers to queries the user has already typed past
+        if (query !== activeQuery) return;
+
+        if (page === 1) resultsList.innerHTML = '';
+        resultsList.querySelector('.search-more')?.remove();
+        if (page === 1 && result.items.length === 0) {
+            resultsList.innerHTML = '<li><em>No matching chats.</em></li>';
+        }
+        result.items.forEach(chat => {
+            const item = document.createElement('li');
+            item.dataset.chatId = chat.id;
+            const date = new Date(chat.timestamp);
+            // Snippets arrive escaped by the server with matches wrapped in <mark>
+            item.innerHTML = `
+                <div class="chat-title">${chat.prompt_snippet}</div>
+                <div class="chat-snippet">${chat.response_snippet}</div>
+                <div class="chat-date">${date.toLocaleString([], { month: 'short', day: '2-digit', hour: '2-digit', minute: '2-digit' })}</div>
+            `;
+            resultsList.appendChild(item);
         });
+        nextPage = result.next_page;
+        if (nextPage) {
+            const more = document.createElement('li');
+            more.className = 'search-more';
+            more.innerHTML = '<em>More results…</em>';
+            resultsList.appendChild(more);
+        }
+    }
+
+    input.addEventListener('input', function() {
+        clearTimeout(debounceTimer);
+        debounceTimer = setTimeout(async () => {
+            activeQuery = input.value.trim();
+            const searching = activeQuery.length > 0;
+            historyList.classList.toggle('d-none', searching);
+            resultsList.classList.toggle('d-none', !searching);
+            if (!searching) return;
+            try {
+                await loadResults(activeQuery, 1);
+            } catch (error) {
+                console.error('Error searching chats:', error);
+            }
+        }, 250);
+    });
+
+    resultsList.addEventListener('click', async function(event) {
+        if (event.target.closest('.search-more')) {
+            try {
+                await loadResults(activeQuery, nextPage);
+            } catch (error) {
+                console.error('Error searching chats:', error);
+            }
+            return;
+        }
+        const item = event.target.closest('li[data-chat-id]');
+        if (!item) return;
+        resultsList.querySelectorAll('li').forEach(i => i.classList.remove('active'));
+        item.classList.add('active');
+        showChat(item.dataset.chatId);
     });
 }
 
+function initHistoryInfiniteScroll(historyList) {
+    // Loads further pages of the sidebar when its last item scrolls into view
+    const sidebar = historyList.closest('.sidebar');
+    const sentinel = document.createElement('li');
+    sentinel.className = 'history-sentinel';
+    sentinel.style.cssText = 'height: 1px; padding: 0; margin: 0; border: none; opacity: 0;';
+    historyList.appendChild(sentinel);
+
+    let loading = false;
+    const observer = new IntersectionObserver(async (entries) => {
+        if (!entries.some(entry => entry.isIntersecting) || loading) return;
+        const cursor = historyList.dataset.nextCursor;
+        if (!cursor) {
+            observer.disconnect();
+            return;
+        }
+
+        loading = true;
+        try {
+            const response = await fetch(`${historyList.dataset.historyUrl}?cursor=${encodeURIComponent(cursor)}`);
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            const page = await response.json();
+            page.items.forEach(chat => {
+                const item = document.createElement('li');
+                item.dataset.chatId = chat.id;
+                const date = new Date(chat.timestamp);
+                item.innerHTML = `
+                    <div class="chat-title">${escapeHtml(chat.preview)}</div>
+                    <div class="chat-date">${date.toLocaleString([], { month: 'short', day: '2-digit', hour: '2-digit', minute: '2-digit' })}</div>
+                `;
+                historyList.insertBefore(item, sentinel);
+            });
+            historyList.dataset.nextCursor = page.next_cursor || '';
+        } catch (error) {
+            console.error('Error loading chat history:', error);
+        } finally {
+            loading = false;
+        }
+    }, { root: sidebar, rootMargin: '0px 0px 200px 0px' });
+
+    observer.observe(sentinel);
+}
+
 function initTypingAnimation() {
     // Add typing animation to AI messages
     const style = document.createElement('style');
@@ -565,6 +779,39 @@ function showNotification(message, type = 'info') {
     });
 }
 
+async function readEventStream(response, onEvent) {
+    // Minimal server-sent events parser for fetch() bodies (EventSource cannot POST)
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let eventName = 'message';
+            let data = '';
+            frame.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            onEvent(eventName, data ? JSON.parse(data) : {});
+        }
+    }
+}
+
+function newRequestId() {
+    // crypto.randomUUID() needs a secure context, which the app served over plain HTTP on a LAN is not
+    const bytes = crypto.getRandomValues(new Uint8Array(16));
+    return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+}
+
 function escapeHtml(unsafe) {
     return unsafe
         .replace(/&/g, "&amp;")
@@ -0,0 +1,126 @@
+import hashlib
+import time
+from typing import Callable, Iterator, Optional, Union
+
+# --- Stub Timing Defaults ---
+# Roughly a 1.5B q4 model on a recent phone; only relative changes matter in a benchmark
+DEFAULT_LOAD_SECONDS = 0.5
+DEFAULT_PROMPT_TOKEN_SECONDS = 0.002
+DEFAULT_TOKEN_SECONDS = 0.05
+STUB_EMBEDDING_DIM = 64
+
+_WORDS = (
+    " the", " model", " answers", " with", " a", " short", " and", " steady", " stream", " of",
+    " tokens", " so", " that", " timings", " stay", " comparable", " between", " runs", ".", "\n",
+)
+
+
+class StubLlama:
+    """Deterministic stand-in for ``llama_cpp.Llama`` that needs no weights.
+
+    Implements the subset of the Llama API this app calls, sleeping for a
+    fixed time per prompt token and per generated token. Output depends only
+    on the prompt, so benchmark runs are reproducible on machines with no
+    model files (e.g. CI). Plug it in through ``ModelRegistry.loader``.
+    """
+
+    def __init__(self, model_path: str = '', n_ctx: int = 4096, load_seconds: float = DEFAULT_LOAD_SECONDS,
+                 prompt_token_seconds: float = DEFAULT_PROMPT_TOKEN_SECONDS,
+                 token_seconds: float = DEFAULT_TOKEN_SECONDS, **kwargs):
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.prompt_token_seconds = prompt_token_seconds
+        self.token_seconds = token_seconds
+        self.metadata: dict = {}
+        self.cache = None
+        time.sleep(load_seconds)
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def set_cache(self, cache) -> None:
+        # Accepted for API compatibility; the stub has no KV state to save
+        self.cache = cache
+
+    def token_bos(self) -> int:
+        return 1
+
+    def token_eos(self) -> int:
+        return 2
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list[int]:
+        # One token per four bytes is close to what BPE vocabularies give for prose
+        tokens = [int.from_bytes(text[i:i + 4].ljust(4, b'\0'), 'little') for i in range(0, len(text), 4)]
+        return ([1] if add_bos else []) + tokens
+
+    def detokenize(self, tokens: list[int], special: bool = False) -> bytes:
+        return b''.join(token.to_bytes(4, 'little').rstrip(b'\0') for token in tokens if token not in (1, 2))
+
+    def _prompt_bytes(self, prompt: Union[str, list[int]]) -> bytes:
+        # Like Llama, prompts arrive as text or as token ids (see prompt_templates.py)
+        return self.detokenize(prompt) if isinstance(prompt, list) else prompt.encode('utf-8')
+
+    def _words(self, prompt: Union[str, list[int]], max_tokens: Optional[int],
+               stopping_criteria: Optional[Callable] = None) -> Iterator[str]:
+        prompt_token_count = len(prompt) if isinstance(prompt, list) else len(self.tokenize(prompt.encode('utf-8')))
+        time.sleep(prompt_token_count * self.prompt_token_seconds)
+        offset = hashlib.sha256(self._prompt_bytes(prompt)).digest()[0]
+        for i in range(max_tokens or 16):
+            time.sleep(self.token_seconds)
+            yield _WORDS[(offset + i) % len(_WORDS)]
+            # Checked after each token, like Llama (which passes input ids and logits)
+            if stopping_criteria is not None and stopping_criteria(None, None):
+                return
+
+    def __call__(self, prompt: Union[str, list[int]], max_tokens: Optional[int] = 16, stream: bool = False,
+                 stopping_criteria: Optional[Callable] = None, **kwargs) -> Union[dict, Iterator[dict]]:
+        if stream:
+            return self._stream(prompt, max_tokens, stopping_criteria)
+        words = list(self._words(prompt, max_tokens, stopping_criteria))
+        prompt_tokens = len(prompt) if isinstance(prompt, list) else len(self.tokenize(prompt.encode('utf-8')))
+        return {
+            'id': 'stub', 'object': 'text_completion', 'model': self.model_path,
+            'choices': [{'text': "".join(words), 'index': 0, 'finish_reason': 'length'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(words),
+                      'total_tokens': prompt_tokens + len(words)},
+        }
+
+    create_completion = __call__
+
+    def _stream(self, prompt: Union[str, list[int]], max_tokens: Optional[int],
+                stopping_criteria: Optional[Callable] = None) -> Iterator[dict]:
+        for word in self._words(prompt, max_tokens, stopping_criteria):
+            yield {'id': 'stub', 'choices': [{'text': word, 'index': 0, 'finish_reason': None}]}
+        yield {'id': 'stub', 'choices': [{'text': '', 'index': 0, 'finish_reason': 'length'}]}
+
+    def create_chat_completion(self, messages: list[dict], max_tokens: Optional[int] = 16, stream: bool = False,
+                               stopping_criteria: Optional[Callable] = None,
+                               **kwargs) -> Union[dict, Iterator[dict]]:
+        prompt = "\n".join(message['content'] for message in messages)
+        if stream:
+            return self._chat_stream(prompt, max_tokens, stopping_criteria)
+        result = self(prompt, max_tokens=max_tokens, stopping_criteria=stopping_criteria)
+        return {
+            'id': 'stub', 'object': 'chat.completion', 'model': self.model_path,
+            'choices': [{'index': 0, 'finish_reason': 'length',
+                         'message': {'role': 'assistant', 'content': result['choices'][0]['text']}}],
+            'usage': result['usage'],
+        }
+
+    def embed(self, input: Union[str, list[str]], normalize: bool = True, truncate: bool = True) -> list:
+        # Hashed bag of words: texts sharing words get similar vectors, which is enough to exercise retrieval
+        texts = [input] if isinstance(input, str) else input
+        vectors = []
+        for text in texts:
+            vector = [0.0] * STUB_EMBEDDING_DIM
+            for word in text.lower().split():
+                vector[hashlib.sha256(word.encode('utf-8')).digest()[0] % STUB_EMBEDDING_DIM] += 1.0
+            vectors.append(vector)
+        return vectors[0] if isinstance(input, str) else vectors
+
+    def _chat_stream(self, prompt: str, max_tokens: Optional[int],
+                     stopping_criteria: Optional[Callable] = None) -> Iterator[dict]:
+        yield {'id': 'stub', 'choices': [{'index': 0, 'delta': {'role': 'assistant'}, 'finish_reason': None}]}
+        for word in self._words(prompt, max_tokens, stopping_criteria):
+            yield {'id': 'stub', 'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]}
+        yield {'id': 'stub', 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'length'}]}
@@ -1,3 +1,1500 @@
-from django.test import TestCase
+import asyncio
+import dataclasses
+import gzip
+import itertools
+import json
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import CancelledError
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+import numpy as np
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from . import (
+    autotune, batching, conversations, deadlines, generation, gguf, governor, history, kv_cache, metrics,
+    model_registry, openai_api, persistence, prompt_templates, response_cache, search, settings_cache, speculative,
+    startup, stub_backend, transfer,
+)
+from .management.commands import bench
+from .models import Chat, Conversation, Message, ModelProfile, TextGenerationSettings
+from .scheduler import (
+    GenerationCancelled, GenerationScheduler, GenerationTimeout, QueueFull, current_job, scheduler,
+)
+from .settings_cache import ResolvedSettings
 
-# Create your tests here.
+try:
+    import zstandard
+except ImportError:  # optional, like in transfer.py
+    zstandard = None
+
+# Long enough for a loaded CI machine, short enough that a hang fails the run
+WAIT = 5
+
+
+def _use_stub_models(test, token_seconds=0.0):
+    """Serves every model from ``StubLlama`` for the rest of ``test`` and saves chats nowhere."""
+    def load(**kwargs):
+        return stub_backend.StubLlama(load_seconds=0, prompt_token_seconds=0, token_seconds=token_seconds, **kwargs)
+
+    saved = []
+
+    def save(prompt, response):
+        saved.append(prompt)
+        return Chat(id=len(saved), prompt=prompt, response=response, timestamp=timezone.now())
+
+    patches = [
+        mock.patch.object(model_registry.registry, '_loader', load),
+        # Jobs run on scheduler threads, outside the test's transaction
+        mock.patch.object(generation, '_save_chat', save),
+        mock.patch.object(generation, '_save_batch_chats',
+                          lambda results: [save(r['prompt'], r['response']) for r in results if 'response' in r]),
+    ]
+    for patch in patches:
+        patch.start()
+        test.addCleanup(patch.stop)
+    test.addCleanup(model_registry.registry.clear)
+    # Resolved here so the workers never read the settings table
+    settings_cache.invalidate()
+    test.addCleanup(settings_cache.invalidate)
+    settings_cache.get_settings()
+    return saved
+
+
+def _sse_events(response) -> list[tuple[str, dict]]:
+    events = []
+    for frame in b''.join(response.streaming_content).decode('utf-8').split('\n\n'):
+        if frame:
+            name, data = frame.split('\n')
+            events.append((name.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+    return events
+
+
+class SchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = GenerationScheduler(num_workers=1, max_queue_size=1, request_timeout=WAIT)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def _occupy_worker(self):
+        # Keeps the only worker busy so later jobs stay queued
+        def block():
+            self.started.set()
+            self.release.wait(WAIT)
+            return 'first'
+        future = self.scheduler.submit(block)
+        self.assertTrue(self.started.wait(WAIT))
+        return future
+
+    def test_rejects_jobs_beyond_the_queue_size(self):
+        first = self._occupy_worker()
+        queued = self.scheduler.submit(lambda: 'second')
+        with self.assertRaises(QueueFull) as raised:
+            self.scheduler.submit(lambda: 'third')
+        self.assertEqual(raised.exception.queue_size, 1)
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        self.release.set()
+        self.assertEqual(first.result(WAIT), 'first')
+        self.assertEqual(queued.result(WAIT), 'second')
+
+    def test_cancel_keeps_a_queued_job_from_starting(self):
+        ran = threading.Event()
+        self._occupy_worker()
+        queued = self.scheduler.submit(ran.set, request_id='queued')
+        self.assertTrue(self.scheduler.cancel('queued'))
+        self.release.set()
+        with self.assertRaises(CancelledError):
+            queued.result(WAIT)
+        self.assertFalse(ran.is_set())
+        # Finished jobs are forgotten
+        self.assertFalse(self.scheduler.cancel('queued'))
+        self.assertFalse(self.scheduler.cancel('missing'))
+
+    def test_cancelled_and_resubmitted_jobs_do_not_fill_the_queue(self):
+        first = self._occupy_worker()
+        self.scheduler.submit(lambda: 'cancelled', request_id='gone')
+        self.assertTrue(self.scheduler.cancel('gone'))
+        # Both cancelled jobs are still in the priority queue behind the busy worker
+        self.scheduler.submit(lambda: 'old', request_id='again')
+        resubmitted = self.scheduler.submit(lambda: 'new', request_id='again')
+        self.assertEqual(self.scheduler.queue_size(), 1)
+        self.release.set()
+        self.assertEqual(first.result(WAIT), 'first')
+        self.assertEqual(resubmitted.result(WAIT), 'new')
+        self.assertEqual(self.scheduler.queue_size(), 0)
+
+    def test_cancel_signals_a_running_job(self):
+        def wait_for_cancel():
+            self.started.set()
+            return current_job().cancelled.wait(WAIT)
+        future = self.scheduler.submit(wait_for_cancel, request_id='running')
+        self.assertTrue(self.started.wait(WAIT))
+        self.assertTrue(self.scheduler.cancel('running'))
+        self.assertTrue(future.result(WAIT))
+
+    def test_run_reports_a_cancelled_job(self):
+        self._occupy_worker()
+        threading.Timer(0.2, self.scheduler.cancel, args=('waiting',)).start()
+        with self.assertRaises(GenerationCancelled):
+            self.scheduler.run(lambda: 'never', request_id='waiting')
+
+
+class ChatPageTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        # Two chats share a timestamp so the id has to break the tie between pages
+        self.chats = [Chat.objects.create(prompt=f"prompt {i}", response='r', timestamp=now - timedelta(minutes=i // 2))
+                      for i in range(7)]
+
+    def test_pages_cover_every_chat_once_newest_first(self):
+        seen, cursor = [], None
+        while True:
+            items, cursor = history.chat_page(cursor, limit=2)
+            seen.extend(item['id'] for item in items)
+            if cursor is None:
+                break
+        expected = [chat.id for chat in sorted(self.chats, key=lambda chat: (chat.timestamp, chat.id), reverse=True)]
+        self.assertEqual(seen, expected)
+
+    def test_last_page_has_no_cursor(self):
+        items, cursor = history.chat_page(limit=len(self.chats))
+        self.assertEqual(len(items), len(self.chats))
+        self.assertIsNone(cursor)
+
+    def test_previews_are_truncated(self):
+        Chat.objects.create(prompt='x' * 100, response='r')
+        items, _ = history.chat_page(limit=1)
+        self.assertEqual(items[0]['preview'], 'x' * (history.PREVIEW_CHARS - 1) + '…')
+
+    def test_malformed_cursor_is_rejected(self):
+        with self.assertRaises(history.InvalidCursor):
+            history.chat_page('not a cursor')
+
+
+class SearchTests(TestCase):
+    def test_match_expression_quotes_words_and_prefixes_the_last(self):
+        self.assertEqual(search.match_expression('llama "cpp" OR'), '"llama" "cpp" "OR"*')
+        self.assertEqual(search.match_expression('wh'), '"wh"*')
+        self.assertIsNone(search.match_expression(' -*" '))
+
+    def test_match_expression_caps_the_number_of_terms(self):
+        expression = search.match_expression(' '.join(f"w{i}" for i in range(50)))
+        self.assertEqual(len(expression.split()), search.MAX_QUERY_TERMS)
+
+    def test_finds_chats_through_the_index(self):
+        Chat.objects.create(prompt='How do I bake bread?', response='Knead the dough.')
+        match = Chat.objects.create(prompt='Tell me about <llamas>', response='Llamas live in the Andes.')
+        items, next_page = search.search_chats('llam')
+        self.assertEqual([item['id'] for item in items], [match.id])
+        self.assertIsNone(next_page)
+        # Matches are marked and the rest of the text is escaped
+        self.assertIn('&lt;<mark>llamas</mark>&gt;', items[0]['prompt_snippet'])
+
+    def test_prompt_matches_rank_first_and_pages_continue(self):
+        in_response = Chat.objects.create(prompt='Question', response='The answer mentions kettles.')
+        in_prompt = Chat.objects.create(prompt='Kettles?', response='Yes.')
+        items, next_page = search.search_chats('kettles', limit=1)
+        self.assertEqual([item['id'] for item in items], [in_prompt.id])
+        self.assertEqual(next_page, 2)
+        items, next_page = search.search_chats('kettles', page=2, limit=1)
+        self.assertEqual([item['id'] for item in items], [in_response.id])
+        self.assertIsNone(next_page)
+
+    def test_deleted_chats_leave_the_index(self):
+        chat = Chat.objects.create(prompt='ephemeral', response='gone soon')
+        chat.delete()
+        self.assertEqual(search.search_chats('ephemeral'), ([], None))
+
+    def test_edited_chats_are_reindexed(self):
+        chat = Chat.objects.create(prompt='before', response='old words')
+        Chat.objects.filter(pk=chat.pk).update(response='new phrasing')
+        self.assertEqual(search.search_chats('old'), ([], None))
+        self.assertEqual([item['id'] for item in search.search_chats('phrasing')[0]], [chat.id])
+
+    def test_bulk_inserts_are_indexed(self):
+        # The write-behind buffer stores chats with multi-row INSERTs
+        chats = Chat.objects.bulk_create([Chat(prompt=f'bulk {i}', response='rows') for i in range(3)])
+        self.assertEqual(len(search.search_chats('bulk')[0]), len(chats))
+
+
+class TransferTests(TestCase):
+    def setUp(self):
+        TextGenerationSettings.objects.update_or_create(identifier='default', defaults={'temperature': 0.3})
+        for i in range(5):
+            Chat.objects.create(prompt=f"prompt {i}", response=f"response {i}")
+
+    def _export(self, codec=transfer.GZIP) -> bytes:
+        # A small chunk size exercises the multi-chunk path
+        return b''.join(transfer.export_stream(codec, chunk_size=2))
+
+    def test_round_trip_skips_chats_already_present(self):
+        archive = self._export()
+        expected = list(Chat.objects.order_by('timestamp', 'id').values_list('prompt', 'response', 'timestamp'))
+        Chat.objects.filter(id__in=Chat.objects.order_by('id').values('id')[:3]).delete()
+
+        result = transfer.import_stream([archive[:7], archive[7:]], batch_size=2)
+        self.assertEqual((result.chats_created, result.chats_skipped), (3, 2))
+        self.assertEqual(result.settings_skipped, 1)
+        self.assertTrue(result.complete)
+        self.assertEqual(list(Chat.objects.order_by('timestamp', 'id').values_list('prompt', 'response', 'timestamp')),
+                         expected)
+
+        again = transfer.import_stream([archive])
+        self.assertEqual((again.chats_created, again.chats_skipped), (0, 5))
+
+    def test_settings_are_replaced_only_when_asked(self):
+        archive = self._export()
+        TextGenerationSettings.objects.filter(identifier='default').update(temperature=0.9)
+        transfer.import_stream([archive])
+        self.assertEqual(TextGenerationSettings.objects.get(identifier='default').temperature, 0.9)
+        result = transfer.import_stream([archive], overwrite_settings=True)
+        self.assertEqual(result.settings_updated, 1)
+        self.assertEqual(TextGenerationSettings.objects.get(identifier='default').temperature, 0.3)
+
+    def test_truncated_archive_keeps_complete_records(self):
+        archive = self._export(transfer.PLAIN)
+        # Cut into the last chat, dropping the trailer with it
+        cut = archive.rindex(b'{"type": "chat"') + 20
+        Chat.objects.all().delete()
+        result = transfer.import_stream([archive[:cut]])
+        self.assertFalse(result.complete)
+        self.assertEqual(result.chats_created, 4)
+        self.assertEqual(Chat.objects.count(), 4)
+
+    def test_rejects_data_that_is_not_an_archive(self):
+        with self.assertRaises(transfer.TransferError):
+            transfer.import_stream([b'{"type": "chat"}\n'])
+        with self.assertRaises(transfer.TransferError):
+            transfer.import_stream([b'not json\n'])
+
+    def _archive(self, *records) -> bytes:
+        header = {'type': 'header', 'format': transfer.FORMAT_NAME, 'version': transfer.FORMAT_VERSION}
+        return b''.join(json.dumps(record).encode() + b'\n' for record in (header, *records))
+
+    def test_invalid_settings_records_are_rejected(self):
+        row = TextGenerationSettings.objects.values(*transfer.SETTINGS_FIELDS).get(identifier='default')
+        for bad in [{'temperature': 'hot'}, {'top_p': 5}, {'chat_format': 'x' * 100}, {'speculative': 'guess'}]:
+            with self.assertRaises(transfer.TransferError):
+                transfer.import_stream([self._archive({'type': 'settings', **row, **bad})], overwrite_settings=True)
+        self.assertEqual(TextGenerationSettings.objects.get(identifier='default').temperature, 0.3)
+
+    def test_decompressed_size_is_capped(self):
+        # Megabytes of newlines compress to a few kilobytes
+        padding = self._archive() + b'\n' * (3 * 1024 * 1024)
+        codecs = [gzip.compress] + ([zstandard.ZstdCompressor().compress] if zstandard else [])
+        for compress in codecs:
+            with self.settings(TEXTGEN_IMPORT_MAX_MB=2), self.assertRaises(transfer.TransferError):
+                transfer.import_stream([compress(padding)])
+            self.assertEqual(transfer.import_stream([compress(padding)]).chats_created, 0)
+
+    def test_overlong_records_are_rejected(self):
+        with mock.patch.object(transfer, 'MAX_RECORD_BYTES', 1024), self.assertRaises(transfer.TransferError):
+            transfer.import_stream([self._archive(), b'{"type": "chat", "prompt": "' + b'x' * 4096])
+
+    def test_concatenated_gzip_archives_are_read_member_by_member(self):
+        first = gzip.compress(self._archive({'type': 'chat', 'timestamp': '2020-01-01T00:00:00+00:00',
+                                             'prompt': 'a', 'response': 'b'}))
+        second = gzip.compress(self._archive({'type': 'chat', 'timestamp': '2020-01-02T00:00:00+00:00',
+                                              'prompt': 'c', 'response': 'd'}, {'type': 'end'}))
+        result = transfer.import_stream([first + second])
+        self.assertEqual(result.chats_created, 2)
+        self.assertTrue(result.complete)
+
+    def test_http_import_requires_a_csrf_token(self):
+        client = Client(HTTP_HOST='localhost', enforce_csrf_checks=True)
+        response = client.post('/history/import/?overwrite_settings=1', self._archive(),
+                               content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 403)
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def test_only_greedy_or_seeded_sampling_is_deterministic(self):
+        self.assertTrue(response_cache.is_deterministic(ResolvedSettings(temperature=0)))
+        self.assertTrue(response_cache.is_deterministic(ResolvedSettings(temperature=0.7, seed=42)))
+        self.assertFalse(response_cache.is_deterministic(ResolvedSettings(temperature=0.7, seed=-1)))
+
+    def test_key_covers_prompt_and_sampling_settings(self):
+        params = ResolvedSettings(temperature=0)
+        key = response_cache.cache_key(params, 'hello')
+        self.assertEqual(key, response_cache.cache_key(ResolvedSettings(temperature=0), 'hello'))
+        for other, prompt in [(params, 'hello!'), (params.with_overrides(max_tokens=7), 'hello'),
+                              (params.with_overrides(stop=['\n']), 'hello'),
+                              (params.with_overrides(system_prompt='Be brief.'), 'hello')]:
+            self.assertNotEqual(key, response_cache.cache_key(other, prompt))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = response_cache.ResponseCache(max_entries=2, ttl=60)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        cache.get('a')
+        cache.set('c', 'C')
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), ('A', None, 'C'))
+        self.assertEqual(cache.snapshot()['misses'], 1)
+
+    def test_expired_entries_are_misses(self):
+        cache = response_cache.ResponseCache(max_entries=2, ttl=60)
+        with mock.patch('time.time', return_value=1000.0):
+            cache.set('a', 'A')
+        with mock.patch('time.time', return_value=1061.0):
+            self.assertIsNone(cache.get('a'))
+
+    def test_sqlite_tier_answers_after_the_memory_tier_is_gone(self):
+        disk = response_cache._SQLiteTier(':memory:', max_entries=10)
+        response_cache.ResponseCache(max_entries=2, ttl=60, disk=disk).set('a', 'A')
+        self.assertEqual(response_cache.ResponseCache(max_entries=2, ttl=60, disk=disk).get('a'), 'A')
+
+    def test_random_sampling_bypasses_the_cache(self):
+        cache = response_cache.ResponseCache(max_entries=2, ttl=60)
+        params = ResolvedSettings(temperature=0.7, seed=-1)
+        with mock.patch.object(response_cache, 'cache', cache):
+            response_cache.store(params, 'hello', 'world')
+            self.assertEqual(response_cache.lookup(params, 'hello'), (response_cache.BYPASS, None))
+        self.assertEqual(cache.snapshot()['entries'], 0)
+
+
+class ReplayCachedTests(TestCase):
+    def setUp(self):
+        settings_cache.invalidate()
+        self.addCleanup(settings_cache.invalidate)
+        patches = [
+            mock.patch.object(response_cache, 'cache', response_cache.ResponseCache(max_entries=8, ttl=60)),
+            mock.patch.object(generation, '_save_chat',
+                              lambda prompt, response: Chat(prompt=prompt, response=response)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_hits_are_keyed_on_the_prompt_the_model_was_given(self):
+        params = generation.resolve_generation_params(temperature=0)
+        response_cache.store(params, 'Earlier context\n\nhello', 'cached answer')
+
+        # Without retrieval context the same typed prompt is a different request
+        with mock.patch.object(generation.retrieval, 'augment', lambda prompt: prompt):
+            self.assertEqual(generation.replay_cached('hello', temperature=0), (response_cache.MISS, None))
+        with mock.patch.object(generation.retrieval, 'augment', lambda prompt: f"Earlier context\n\n{prompt}"):
+            status, chat = generation.replay_cached('hello', temperature=0)
+        self.assertEqual(status, response_cache.HIT)
+        # The chat records the prompt as typed
+        self.assertEqual((chat.prompt, chat.response), ('hello', 'cached answer'))
+
+    def test_random_sampling_skips_retrieval(self):
+        with mock.patch.object(generation.retrieval, 'augment') as augment:
+            self.assertEqual(generation.replay_cached('hello', temperature=0.7), (response_cache.BYPASS, None))
+        augment.assert_not_called()
+
+
+class _ScriptedDraft:
+    """Proposes the given token lists in turn."""
+
+    def __init__(self, *proposals):
+        self.proposals = [np.array(proposal, dtype=np.intc) for proposal in proposals]
+
+    def __call__(self, input_ids, **kwargs):
+        return self.proposals.pop(0)
+
+
+class CountingDraftModelTests(SimpleTestCase):
+    def test_counts_the_accepted_prefix_of_each_proposal(self):
+        draft = speculative.CountingDraftModel(_ScriptedDraft([5, 6, 7], [9, 9], []))
+        draft.begin()
+        draft(np.array([1, 2], dtype=np.intc))
+        # The main model kept 5 and 6, then sampled 8 instead of 7
+        draft(np.array([1, 2, 5, 6, 8], dtype=np.intc))
+        # Both tokens of the second proposal were kept
+        draft(np.array([1, 2, 5, 6, 8, 9, 9, 3], dtype=np.intc))
+        self.assertEqual((draft.proposed, draft.accepted), (5, 4))
+        self.assertEqual(draft.finish(), 0.8)
+
+    def test_a_proposal_cut_short_by_a_stop_is_not_counted(self):
+        draft = speculative.CountingDraftModel(_ScriptedDraft([5, 6]))
+        draft.begin()
+        draft(np.array([1], dtype=np.intc))
+        self.assertIsNone(draft.finish())
+        self.assertEqual(draft.proposed, 0)
+
+    def test_begin_resets_the_counts(self):
+        draft = speculative.CountingDraftModel(_ScriptedDraft([5], []))
+        draft(np.array([1], dtype=np.intc))
+        draft(np.array([1, 5], dtype=np.intc))
+        draft.begin()
+        self.assertEqual((draft.proposed, draft.accepted), (0, 0))
+
+
+class DraftLlamaTests(SimpleTestCase):
+    def test_proposes_nothing_past_the_draft_context(self):
+        model = mock.Mock()
+        model.n_ctx.return_value = 8
+        model.generate.return_value = iter([4, 5, 6])
+        draft = speculative.DraftLlama(model, num_pred_tokens=2)
+        self.assertEqual(draft(np.arange(6, dtype=np.intc)).tolist(), [4, 5])
+        self.assertEqual(len(draft(np.arange(7, dtype=np.intc))), 0)
+
+
+class BatchStopSequenceTests(SimpleTestCase):
+    def setUp(self):
+        # _emit only touches the sequence, so the engine needs no model or context
+        self.engine = batching.BatchEngine.__new__(batching.BatchEngine)
+        self.sequence = batching._Sequence([1], ('</s>', 'STOP'), ResolvedSettings())
+
+    def _feed(self, *pieces):
+        stopped = False
+        for piece in pieces:
+            self.sequence.text += piece
+            stopped = self.engine._emit(self.sequence)
+        emitted = []
+        while not self.sequence.events.empty():
+            emitted.append(self.sequence.events.get())
+        return ''.join(emitted), stopped
+
+    def test_holds_back_text_that_may_start_a_stop_sequence(self):
+        self.assertEqual(self._feed('Hello <'), ('Hello ', False))
+        self.assertEqual(self.sequence.text, '<')
+        self.assertEqual(self._feed('b>'), ('<b>', False))
+
+    def test_stop_sequence_split_across_tokens_is_cut(self):
+        emitted, stopped = self._feed('Answer: 4', '</', 's> trailing')
+        self.assertEqual(emitted, 'Answer: 4')
+        self.assertTrue(stopped)
+        self.assertEqual(self.sequence.text, '')
+
+    def test_longest_partial_match_is_held(self):
+        self.assertEqual(self._feed('go ST'), ('go ', False))
+        self.assertEqual(self._feed('OP'), ('', True))
+
+
+class DeadlineTests(SimpleTestCase):
+    def test_cancellation_stops_at_the_next_token(self):
+        cancelled = threading.Event()
+        deadline = deadlines.Deadline(cancelled=cancelled)
+        self.assertFalse(deadline())
+        cancelled.set()
+        self.assertTrue(deadline())
+        self.assertEqual(deadline.reason, deadlines.CANCELLED)
+        with self.assertRaises(GenerationCancelled):
+            deadline.raise_if_stopped()
+
+    def test_expiry_is_a_timeout(self):
+        deadline = deadlines.Deadline(expires_at=time.monotonic() - 1)
+        self.assertTrue(deadline())
+        self.assertEqual(deadline.reason, deadlines.TIMED_OUT)
+        with self.assertRaises(GenerationTimeout):
+            deadline.raise_if_stopped()
+
+    def test_rate_floor_applies_after_the_grace_tokens(self):
+        deadline = deadlines.Deadline(min_tokens_per_second=1000)
+        with mock.patch('time.monotonic', side_effect=itertools.count(0, 0.5)):
+            stops = [deadline() for _ in range(deadlines.RATE_GRACE_TOKENS + 1)]
+        self.assertEqual(stops, [False] * deadlines.RATE_GRACE_TOKENS + [True])
+        self.assertEqual(deadline.reason, deadlines.TOO_SLOW)
+        self.assertIn('below the floor', deadline.describe())
+
+    def test_reason_is_kept_once_stopped(self):
+        cancelled = threading.Event()
+        deadline = deadlines.Deadline(cancelled=cancelled, expires_at=time.monotonic() - 1)
+        self.assertTrue(deadline.expired())
+        cancelled.set()
+        self.assertEqual(deadline.reason, deadlines.TIMED_OUT)
+
+    def test_unbounded_deadline_never_stops(self):
+        deadline = deadlines.Deadline()
+        self.assertFalse(any(deadline() for _ in range(100)))
+        deadline.raise_if_stopped()
+
+    def test_current_request_uses_the_earlier_of_both_deadlines(self):
+        scheduler = GenerationScheduler(num_workers=1, max_queue_size=1, request_timeout=2)
+        with self.settings(TEXTGEN_MAX_GENERATION_SECONDS=60):
+            deadline = scheduler.submit(deadlines.for_current_request).result(WAIT)
+        self.assertLess(deadline.expires_at - time.monotonic(), 2)
+        self.assertIsNotNone(deadline.cancelled)
+        self.assertIsNone(deadlines.for_current_request().cancelled)
+
+
+@mock.patch.object(batching, 'enabled', lambda: False)
+class GovernorFitTests(SimpleTestCase):
+    def setUp(self):
+        # Not a GGUF file, so the governor sizes the KV cache from its fallbacks
+        handle, self.model_path = tempfile.mkstemp(suffix='.gguf')
+        os.close(handle)
+        os.truncate(self.model_path, 8 * 1024 * 1024)
+        self.addCleanup(os.remove, self.model_path)
+        self.params = ResolvedSettings(model_path=self.model_path, n_ctx=4096)
+
+    def _fit(self, headroom):
+        return governor._fit(self.params, headroom, [])
+
+    def test_keeps_the_request_when_it_fits(self):
+        plan = self._fit(10 ** 12)
+        self.assertEqual(plan.degradations, ())
+        self.assertEqual(plan.overrides['n_ctx'], 4096)
+        self.assertIsNone(plan.overrides['type_k'])
+        self.assertTrue(plan.overrides['use_mmap'])
+
+    def test_weights_are_locked_only_where_mlock_is_allowed(self):
+        for allowed in (True, False):
+            with mock.patch.object(governor, '_mlock_allowed', return_value=allowed):
+                plan = self._fit(10 ** 12)
+            # Without mlock the weights stay mapped rather than being copied into anonymous memory
+            self.assertEqual((plan.overrides['use_mmap'], plan.overrides['use_mlock']), (True, allowed))
+
+    def test_degrades_step_by_step(self):
+        full = self._fit(10 ** 12)
+        tight = self._fit(full.required_bytes)
+        self.assertEqual(tight.degradations, ())
+        self.assertEqual((tight.overrides['use_mmap'], tight.overrides['use_mlock']), (True, False))
+
+        quantized_k = self._fit(full.required_bytes - 1)
+        self.assertEqual((quantized_k.overrides['type_k'], quantized_k.overrides['type_v']),
+                         (governor.GGML_TYPE_Q8_0, None))
+        self.assertEqual(quantized_k.overrides['n_ctx'], 4096)
+
+        quantized_kv = self._fit(quantized_k.required_bytes - 1)
+        self.assertEqual(quantized_kv.overrides['type_v'], governor.GGML_TYPE_Q8_0)
+        self.assertTrue(quantized_kv.overrides['flash_attn'])
+
+        shrunk = self._fit(quantized_kv.required_bytes - 1)
+        self.assertEqual(shrunk.overrides['n_ctx'], 2048)
+        self.assertIn('Context shrunk from 4096 to 2048 tokens', shrunk.degradations)
+
+    def test_nothing_fits_below_the_minimum_context(self):
+        self.assertIsNone(self._fit(os.path.getsize(self.model_path)))
+
+    def test_falls_back_to_the_smaller_model(self):
+        handle, fallback_path = tempfile.mkstemp(suffix='.gguf')
+        os.close(handle)
+        os.truncate(fallback_path, 1024 * 1024)
+        self.addCleanup(os.remove, fallback_path)
+        # Shrinking the main model's context and KV cache as far as it goes is still 1 byte short
+        smallest = dataclasses.replace(self.params, n_ctx=governor.MIN_CTX)
+        plan = governor._fit(smallest, 10 ** 12, [])
+        for _ in range(len(governor._KV_LAYOUTS) - 1):
+            plan = governor._fit(smallest, plan.required_bytes - 1, [])
+        with self.settings(TEXTGEN_FALLBACK_MODEL_PATH=fallback_path, TEXTGEN_MEMORY_RESERVED_MB=0), \
+                mock.patch.object(governor.autotune, 'available_memory_bytes', return_value=plan.required_bytes - 1), \
+                mock.patch.object(governor.registry, 'reclaimable_bytes', return_value=0):
+            plan = governor._plan(self.params)
+        self.assertEqual(plan.overrides['model_path'], fallback_path)
+        self.assertTrue(plan.degradations[0].startswith('Fell back from'))
+
+    def test_refuses_when_nothing_fits(self):
+        with self.settings(TEXTGEN_MEMORY_RESERVED_MB=0), \
+                mock.patch.object(governor.autotune, 'available_memory_bytes', return_value=1024), \
+                mock.patch.object(governor.registry, 'reclaimable_bytes', return_value=0):
+            with self.assertRaises(governor.InsufficientMemory):
+                governor._plan(self.params)
+
+    def test_large_requests_are_refused_while_memory_is_critical(self):
+        with self.settings(TEXTGEN_LARGE_MAX_TOKENS=100, TEXTGEN_MEMORY_RESERVED_MB=64), \
+                mock.patch.object(governor.autotune, 'available_memory_bytes', return_value=1024):
+            governor._check_request(self.params.with_overrides(max_tokens=100))
+            with self.assertRaises(governor.InsufficientMemory):
+                governor._check_request(self.params.with_overrides(max_tokens=101))
+
+
+class OpenAIRequestTests(TestCase):
+    def setUp(self):
+        self.client = Client(HTTP_HOST='localhost')
+
+    def _post(self, path, data, **extra):
+        return self.client.post(path, data, content_type='application/json', **extra)
+
+    def test_messages_are_validated(self):
+        self.assertEqual(openai_api.parse_messages([
+            {'role': 'developer', 'content': 'Be brief.'},
+            {'role': 'user', 'content': [{'type': 'text', 'text': 'Hi'}, {'type': 'text', 'text': '!'}]},
+        ]), [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': 'Hi!'}])
+        for messages, param in [([], 'messages'), (['hi'], 'messages[0]'),
+                                ([{'role': 'tool', 'content': 'x'}], 'messages[0].role'),
+                                ([{'role': 'user', 'content': [{'type': 'image_url'}]}], 'messages[0].content')]:
+            with self.assertRaises(openai_api.InvalidRequest) as raised:
+                openai_api.parse_messages(messages)
+            self.assertEqual(raised.exception.param, param)
+
+    def test_prompt_must_be_a_single_string(self):
+        self.assertEqual(openai_api.parse_prompt(['Once upon']), 'Once upon')
+        with self.assertRaises(openai_api.InvalidRequest):
+            openai_api.parse_prompt(['a', 'b'])
+
+    def test_generation_fields_map_onto_settings_overrides(self):
+        kwargs = openai_api.generation_kwargs({'temperature': 0, 'max_completion_tokens': 5, 'stop': '\n'})
+        self.assertEqual((kwargs['temperature'], kwargs['max_tokens'], kwargs['stop_sequences']), (0, 5, ['\n']))
+        self.assertIsNone(kwargs['model_path'])
+        for data, param in [({'n': 2}, 'n'), ({'stop': ['a'] * 5}, 'stop'), ({'temperature': 'hot'}, 'temperature'),
+                            ({'max_tokens': -1}, 'max_tokens'), ({'top_k': 1.5}, 'top_k')]:
+            with self.assertRaises(openai_api.InvalidRequest) as raised:
+                openai_api.generation_kwargs(data)
+            self.assertEqual(raised.exception.param, param)
+
+    def test_invalid_requests_get_openai_errors(self):
+        response = self._post('/v1/chat/completions', {'messages': [{'role': 'user', 'content': 'Hi'}], 'n': 3})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error']['type'], 'invalid_request_error')
+        self.assertEqual(response.json()['error']['param'], 'n')
+        response = self._post('/v1/completions', 'not json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._post('/v1/completions', ['a list']).status_code, 400)
+
+    def test_api_key_is_required_when_configured(self):
+        with self.settings(TEXTGEN_API_KEY='secret'):
+            response = self._post('/v1/completions', {'prompt': 'Hi'}, HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.json()['error']['type'], 'authentication_error')
+            response = self._post('/v1/completions', {'prompt': 'Hi', 'n': 2}, HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 400)
+
+
+class ChatWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.writer = persistence.ChatWriter(enabled=True, interval=0)
+
+    def _saved(self, chat):
+        return Chat.objects.filter(id=chat.id).values_list('prompt', 'response').first()
+
+    def test_reserved_ids_are_not_handed_to_other_inserts(self):
+        first = persistence.reserve_chat_ids(5)
+        self.assertEqual(persistence.reserve_chat_ids(1), first + 5)
+        # An insert outside the writer (the admin, import_history, another process) gets an id above both
+        self.assertGreater(Chat.objects.create(prompt='admin', response='r').id, first + 5)
+
+    def test_chats_keep_their_ids_around_outside_inserts(self):
+        early = self.writer.save('early', 'a')
+        outside = Chat.objects.create(prompt='outside', response='b')
+        late = self.writer.save('late', 'c')
+        self.assertTrue(self.writer.flush())
+        self.assertEqual(self._saved(early), ('early', 'a'))
+        self.assertEqual(self._saved(late), ('late', 'c'))
+        self.assertEqual(self._saved(outside), ('outside', 'b'))
+        self.assertEqual(len({early.id, outside.id, late.id}), 3)
+
+    def test_pending_chats_are_visible_until_written(self):
+        with mock.patch.object(self.writer, '_write', side_effect=[False, True]), \
+                mock.patch.object(persistence, 'WRITE_BACKOFF', 0.2):
+            chat = self.writer.save('pending', 'r')
+            self.assertIs(self.writer.pending(chat.id), chat)
+            self.assertTrue(self.writer.flush())
+        self.assertIsNone(self.writer.pending(chat.id))
+
+    def test_failed_writes_are_retried_not_dropped(self):
+        real_bulk_create = Chat.objects.bulk_create
+        failures = iter([OperationalError('database is locked')] * (persistence.WRITE_ATTEMPTS + 1))
+
+        def flaky_bulk_create(chats, *args, **kwargs):
+            error = next(failures, None)
+            if error is not None:
+                raise error
+            return real_bulk_create(chats, *args, **kwargs)
+
+        with mock.patch.object(Chat.objects, 'bulk_create', side_effect=flaky_bulk_create), \
+                mock.patch.object(persistence, 'WRITE_RETRY_DELAY', 0), \
+                mock.patch.object(persistence, 'WRITE_BACKOFF', 0.05):
+            chat = self.writer.save('stubborn', 'r')
+            self.assertTrue(self.writer.flush())
+        self.assertEqual(self._saved(chat), ('stubborn', 'r'))
+
+    def test_a_taken_id_moves_the_chat_instead_of_dropping_it(self):
+        with mock.patch.object(self.writer, '_ensure_thread'):
+            chat = self.writer.save('mine', 'r')
+            neighbour = self.writer.save('neighbour', 'r')
+        # Something inserted a row under an explicit id inside our reservation
+        taken_id = chat.id
+        Chat.objects.create(id=taken_id, prompt='intruder', response='x')
+        self.assertTrue(self.writer._write([chat, neighbour]))
+        self.assertEqual(self._saved(neighbour), ('neighbour', 'r'))
+        self.assertNotEqual(chat.id, taken_id)
+        self.assertEqual(self._saved(chat), ('mine', 'r'))
+        self.assertEqual(Chat.objects.get(id=taken_id).prompt, 'intruder')
+
+    def test_rows_written_by_an_unacknowledged_attempt_are_not_duplicated(self):
+        with mock.patch.object(self.writer, '_ensure_thread'):
+            chat = self.writer.save('once', 'r')
+        Chat.objects.bulk_create([Chat(id=chat.id, prompt='once', response='r', timestamp=chat.timestamp)])
+        self.assertTrue(self.writer._write([chat]))
+        self.assertEqual(Chat.objects.filter(prompt='once').count(), 1)
+
+
+class SQLiteSettingsTests(SimpleTestCase):
+    def test_connections_use_wal_and_the_tuned_pragmas(self):
+        handle, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        for suffix in ('', '-wal', '-shm'):
+            self.addCleanup(lambda name=path + suffix: os.path.exists(name) and os.remove(name))
+        # The test database lives in memory, where WAL does not apply, so open a file with the same options
+        wrapper = DatabaseWrapper({**connection.settings_dict, 'NAME': path}, alias='pragma_check')
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            values = [cursor.execute(f'PRAGMA {name}').fetchone()[0]
+                      for name in ('journal_mode', 'synchronous', 'temp_store', 'cache_size', 'busy_timeout')]
+        # synchronous=NORMAL is 1 and temp_store=MEMORY is 2
+        self.assertEqual(values, ['wal', 1, 2, -8000, 5000])
+        self.assertEqual(wrapper.transaction_mode, 'IMMEDIATE')
+
+
+class ModelRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.loads = []
+        self.registry = model_registry.ModelRegistry(max_models=2, loader=self._load)
+
+    def _load(self, model_path, **kwargs):
+        self.loads.append(model_path)
+        return stub_backend.StubLlama(model_path, load_seconds=0.05, **kwargs)
+
+    def _key(self, name, **changes):
+        return ResolvedSettings(model_path=f"/models/{name}.gguf", **changes).model_key()
+
+    def test_concurrent_first_use_loads_once(self):
+        key = self._key('a')
+        models = []
+        # Staggered so that some threads arrive while the model is loading and some just after
+        threads = [threading.Timer(i * 0.01, lambda: models.append(self.registry.get(key))) for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(WAIT)
+        self.assertEqual(self.loads, ['/models/a.gguf'])
+        self.assertEqual(len(models), 12)
+        self.assertTrue(all(model is models[0] for model in models))
+        self.assertFalse(self.registry._load_locks)
+
+    def test_least_recently_used_model_is_evicted(self):
+        first, second, third = self._key('a'), self._key('b'), self._key('c')
+        self.registry.get(first)
+        self.registry.get(second)
+        self.registry.get(first)
+        self.registry.get(third)
+        self.assertEqual(self.registry.loaded_keys(), [first, third])
+        self.registry.get(second)
+        self.assertEqual(self.loads, ['/models/a.gguf', '/models/b.gguf', '/models/c.gguf', '/models/b.gguf'])
+
+    def test_loader_settings_select_separate_instances(self):
+        self.assertIsNot(self.registry.get(self._key('a', n_ctx=1024)), self.registry.get(self._key('a', n_ctx=2048)))
+
+    def test_memory_budget_evicts_before_loading(self):
+        paths = []
+        for size in (3, 2):
+            handle, path = tempfile.mkstemp(suffix='.gguf')
+            os.close(handle)
+            os.truncate(path, size * 1024 * 1024)
+            self.addCleanup(os.remove, path)
+            paths.append(path)
+        registry = model_registry.ModelRegistry(max_models=4, memory_budget_bytes=4 * 1024 * 1024, loader=self._load)
+        registry.get(ResolvedSettings(model_path=paths[0]).model_key())
+        registry.get(ResolvedSettings(model_path=paths[1]).model_key())
+        self.assertEqual([key.model_path for key in registry.loaded_keys()], [paths[1]])
+
+    def test_failed_load_can_be_retried(self):
+        key = self._key('a')
+        with mock.patch.object(self.registry, '_load', side_effect=OSError('bad file')):
+            with self.assertRaises(OSError):
+                self.registry.get(key)
+        self.assertFalse(self.registry.has(key))
+        self.registry.get(key)
+        self.assertTrue(self.registry.has(key))
+
+
+class SettingsOverrideTests(TestCase):
+    def test_values_are_cast_to_the_setting_type(self):
+        params = ResolvedSettings().with_overrides(temperature='0', max_tokens='12', top_k=0, stop=['\n'])
+        self.assertEqual((params.temperature, params.max_tokens, params.top_k, params.stop), (0.0, 12, 0, ('\n',)))
+
+    def test_out_of_range_values_are_rejected(self):
+        for name, value in [('max_tokens', 0), ('max_tokens', -5), ('temperature', -0.1), ('temperature', 'nan'),
+                            ('top_p', 1.5), ('top_p', -1), ('top_k', -1), ('temperature', 'hot'), ('top_k', [])]:
+            with self.assertRaises(settings_cache.InvalidOverride) as raised:
+                ResolvedSettings().with_overrides(**{name: value})
+            self.assertEqual(raised.exception.name, name)
+
+    def test_views_answer_unusable_overrides_with_400(self):
+        client = Client(HTTP_HOST='localhost')
+        for body in [{'prompt': 'Hi', 'max_tokens': 0}, {'prompt': 'Hi', 'top_p': 2}]:
+            response = client.post('/generate/stream/', body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(response.json()['param'], ('max_tokens', 'top_p'))
+        response = client.post('/v1/completions', {'prompt': 'Hi', 'max_completion_tokens': 0},
+                               content_type='application/json')
+        self.assertEqual(response.json()['error']['param'], 'max_completion_tokens')
+
+
+class SettingsCacheTests(TestCase):
+    def setUp(self):
+        settings_cache.invalidate()
+        self.addCleanup(settings_cache.invalidate)
+        self.row, _ = TextGenerationSettings.objects.update_or_create(
+            identifier='default', defaults={'role': 'user', 'temperature': 0.5})
+
+    def test_saving_a_row_invalidates_the_cache(self):
+        self.assertEqual(settings_cache.get_settings('user').temperature, 0.5)
+        self.row.temperature = 0.1
+        with self.captureOnCommitCallbacks(execute=True):
+            self.row.save()
+        self.assertEqual(settings_cache.get_settings('user').temperature, 0.1)
+
+    def test_deleting_a_row_falls_back_to_defaults(self):
+        settings_cache.get_settings('user')
+        self.row.delete()
+        self.assertEqual(settings_cache.get_settings('user'), ResolvedSettings(role='user'))
+
+    def test_reads_are_cached(self):
+        settings_cache.get_settings('user')
+        with self.assertNumQueries(0):
+            settings_cache.get_settings('user')
+
+    def test_a_read_racing_an_invalidation_is_not_cached(self):
+        real_filter = TextGenerationSettings.objects.filter
+
+        def filter_then_save(*args, **kwargs):
+            row = real_filter(*args, **kwargs).first()
+            # Another thread saves (and invalidates) after this read
+            real_filter(pk=self.row.pk).update(temperature=0.9)
+            settings_cache.invalidate()
+            return mock.Mock(first=mock.Mock(return_value=row))
+
+        with mock.patch.object(TextGenerationSettings.objects, 'filter', side_effect=filter_then_save):
+            self.assertEqual(settings_cache.get_settings('user').temperature, 0.5)
+        self.assertEqual(settings_cache.get_settings('user').temperature, 0.9)
+
+
+class ConversationTests(TestCase):
+    def setUp(self):
+        self.conversation = conversations.create_conversation()
+        self.model = stub_backend.StubLlama(load_seconds=0, prompt_token_seconds=0, token_seconds=0)
+        use = mock.patch.object(conversations.registry, 'use', return_value=mock.MagicMock(
+            __enter__=mock.Mock(return_value=self.model), __exit__=mock.Mock(return_value=False)))
+        params = mock.patch.object(conversations, 'resolve_generation_params',
+                                   return_value=ResolvedSettings(max_tokens=4))
+        for patcher in (use, params):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _add(self, *roles, token_count=10):
+        for position, role in enumerate(roles):
+            Message.objects.create(conversation=self.conversation, position=position, role=role,
+                                   content=f"{role} {position}", token_count=token_count)
+
+    def test_window_drops_the_oldest_messages_over_budget(self):
+        self._add('user', 'assistant', 'user', 'assistant', 'user', 'assistant')
+        history = conversations.window_messages(self.conversation, budget=35)
+        # Dropping down to 30 tokens would open the window with an assistant reply, so it is skipped too
+        self.assertEqual([message['content'] for message in history], ['user 4', 'assistant 5'])
+        self.assertEqual(self.conversation.window_start, 4)
+
+    def test_window_keeps_the_newest_message_and_the_system_prompt(self):
+        self.conversation.system_prompt = 'Be brief.'
+        self._add('user', 'assistant', 'user', token_count=100)
+        history = conversations.window_messages(self.conversation, budget=10)
+        self.assertEqual(history, [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': 'user 2'}])
+
+    def test_a_turn_stores_both_messages(self):
+        self._add('user', 'assistant')
+        answer = conversations.reply(self.conversation, 'Hello')
+        self.assertEqual(list(self.conversation.messages.values_list('position', 'role')),
+                         [(0, 'user'), (1, 'assistant'), (2, 'user'), (3, 'assistant')])
+        self.assertEqual(answer.position, 3)
+
+    def test_a_failed_turn_stores_nothing(self):
+        with mock.patch.object(self.model, 'create_chat_completion', side_effect=RuntimeError('decode failed')):
+            with self.assertRaises(RuntimeError):
+                conversations.reply(self.conversation, 'Hello')
+            events = list(conversations.stream_reply(self.conversation, 'Hello'))
+        self.assertEqual(events[-1]['event'], 'error')
+        self.assertFalse(self.conversation.messages.exists())
+
+        # The retry is the conversation's first turn, not its second
+        conversations.reply(self.conversation, 'Hello')
+        self.assertEqual(list(self.conversation.messages.values_list('role', 'content')[:1]), [('user', 'Hello')])
+        self.assertEqual(self.conversation.messages.count(), 2)
+
+    def test_a_window_opened_at_the_new_message_is_stored(self):
+        self._add('user', 'assistant', token_count=10_000)
+        events = list(conversations.stream_reply(self.conversation, 'Hello'))
+        self.assertEqual(events[-1]['event'], 'done')
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).window_start, 2)
+
+
+@override_settings(TEXTGEN_KV_CACHE=None)
+class BatchViewTests(TestCase):
+    def setUp(self):
+        self.saved = _use_stub_models(self)
+        self.client = Client(HTTP_HOST='localhost')
+
+    def _post(self, body):
+        return self.client.post('/generate/batch/', body, content_type='application/json')
+
+    def test_bodies_that_are_not_objects_are_rejected(self):
+        for body in ['[]', '["Hi"]', '"Hi"', '3', 'null']:
+            response = self._post(body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertEqual(response.json(), {'error': 'Invalid JSON'})
+        # Other JSON endpoints read their body the same way
+        response = self.client.post('/generate/stream/', '["Hi"]', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_items_must_be_prompts_or_objects_with_a_prompt(self):
+        for items in [[], 'Hi', [3], [['Hi']], [None], [{'prompt': ['Hi']}]]:
+            response = self._post({'items': items})
+            self.assertEqual(response.status_code, 400, items)
+    def test_results_come_back_in_order_with_per_item_errors(self):
+        response = self._post({'items': ['First', {'prompt': 'Second', 'max_tokens': 2}, {'prompt': ''},
+                                         {'prompt': 'Fourth', 'temperature': 'hot'}], 'max_tokens': 4})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['index'] for result in results], [0, 1, 2, 3])
+        # Every stub token is a word with its leading space, "." or a newline
+        token_counts = [len(re.findall(r' \w+|[.\n]', result['response'])) for result in results[:2]]
+        # Per-item values override the shared ones
+        self.assertEqual(token_counts, [4, 2])
+        self.assertEqual(results[2]['error'], 'Prompt is required')
+        self.assertIn('temperature', results[3]['error'])
+        self.assertEqual([result.get('chat_id') for result in results], [1, 2, None, None])
+        self.assertEqual(self.saved, ['First', 'Second'])
+
+    def test_streamed_results_end_with_a_summary(self):
+        response = self._post({'prompts': ['First', 'Second'], 'stream': True, 'max_tokens': 2})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([line.get('prompt') for line in lines], ['First', 'Second', None])
+        self.assertEqual(lines[-1], {'done': True, 'count': 2, 'saved': 2})
+
+    def test_batches_are_limited_in_size(self):
+        response = self._post({'prompts': ['Hi'] * 1001})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unusable_shared_values_fail_the_whole_batch(self):
+        response = self._post({'prompts': ['Hi'], 'top_p': 3})
+        self.assertEqual((response.status_code, response.json()['param']), (400, 'top_p'))
+
+
+@override_settings(TEXTGEN_KV_CACHE=None)
+class EventStreamTests(TestCase):
+    def setUp(self):
+        # Slow enough that a 1000-token answer is still running when the client goes away
+        self.saved = _use_stub_models(self, token_seconds=0.002)
+        self.client = Client(HTTP_HOST='localhost')
+
+    def _stream(self, body, **headers):
+        return self.client.post('/generate/stream/', body, content_type='application/json', **headers)
+
+    def test_tokens_arrive_as_events_followed_by_done(self):
+        response = self._stream({'prompt': 'Hello', 'max_tokens': 5}, HTTP_X_REQUEST_ID='abc')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual((response['Cache-Control'], response['X-Accel-Buffering']), ('no-cache', 'no'))
+        self.assertEqual(response['X-Request-ID'], 'abc')
+        events = _sse_events(response)
+        names = [name for name, _ in events]
+        self.assertEqual(names, ['token'] * 5 + ['done'])
+        done = events[-1][1]
+        self.assertEqual(done['response'], ''.join(data['text'] for _, data in events[:-1]))
+        self.assertEqual(self.saved, ['Hello'])
+
+    def test_form_posts_stream_too(self):
+        response = self.client.post('/generate/stream/', {'prompt': 'Hello', 'max_tokens': '2'})
+        self.assertEqual([name for name, _ in _sse_events(response)], ['token', 'token', 'done'])
+
+    def test_a_missing_prompt_is_rejected_before_streaming(self):
+        response = self._stream({'prompt': '  '})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.streaming)
+
+    def test_closing_the_stream_cancels_generation(self):
+        response = self._stream({'prompt': 'Hello', 'max_tokens': 1000}, HTTP_X_REQUEST_ID='gone')
+        chunks = iter(response.streaming_content)
+        self.assertTrue(next(chunks).startswith(b'event: token'))
+        response.close()
+        deadline = time.monotonic() + WAIT
+        while scheduler.cancel('gone') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(scheduler.cancel('gone'))
+        # The partial answer is not saved
+        self.assertEqual(self.saved, [])
+
+
+class _DictStateCache(dict):
+    # Stands in for LlamaRAMCache, whose lookup returns the state of the longest cached prefix
+    def __getitem__(self, key):
+        matches = [cached for cached in self if tuple(key[:len(cached)]) == cached]
+        if not matches:
+            raise KeyError(key)
+        return super().__getitem__(max(matches, key=len))
+
+
+class PrefixCacheTests(SimpleTestCase):
+    def setUp(self):
+        patch = mock.patch.object(kv_cache, 'stats', kv_cache.PrefixCacheStats())
+        self.stats = patch.start()
+        self.addCleanup(patch.stop)
+        self.cache = type('CountingDictCache', (kv_cache._CountingCacheMixin, _DictStateCache), {})()
+
+    def _store(self, tokens):
+        self.cache[tuple(tokens)] = mock.Mock(input_ids=np.array(tokens))
+
+    def test_hits_count_the_reused_prefix(self):
+        self._store([1, 2, 3, 4])
+        self.assertIsNotNone(self.cache[(1, 2, 3, 4, 5, 6)])
+        self.assertEqual(self.stats.snapshot(), {'hits': 1, 'misses': 0, 'hit_rate': 1.0,
+                                                 'reused_tokens': 4, 'lookup_tokens': 6})
+
+    def test_misses_are_counted_and_still_raise(self):
+        self._store([1, 2])
+        with self.assertRaises(KeyError):
+            self.cache[(7, 8, 9)]
+        self.cache[(1, 2, 3)]
+        snapshot = self.stats.snapshot()
+        self.assertEqual((snapshot['hits'], snapshot['misses'], snapshot['hit_rate']), (1, 1, 0.5))
+        self.assertEqual((snapshot['reused_tokens'], snapshot['lookup_tokens']), (2, 6))
+
+    def test_common_prefix_length(self):
+        self.assertEqual(kv_cache._common_prefix_length([1, 2, 3], [1, 2, 4, 5]), 2)
+        self.assertEqual(kv_cache._common_prefix_length([], [1]), 0)
+
+    def test_backend_comes_from_settings(self):
+        with self.settings(TEXTGEN_KV_CACHE=None):
+            self.assertIsNone(kv_cache.build_prefix_cache())
+        with self.settings(TEXTGEN_KV_CACHE='tape'), self.assertRaises(ValueError):
+            kv_cache.build_prefix_cache()
+
+    def test_a_cache_that_cannot_be_built_is_skipped(self):
+        model = stub_backend.StubLlama(load_seconds=0)
+        with self.settings(TEXTGEN_KV_CACHE='tape'), self.assertLogs('textgen.kv_cache', 'ERROR'):
+            kv_cache.attach_prefix_cache(model)
+        self.assertIsNone(model.cache)
+
+    def test_stats_are_served_as_json(self):
+        self.stats.record(10, 4)
+        response = Client(HTTP_HOST='localhost').get('/stats/cache/')
+        self.assertEqual(response.json()['prefix_cache']['reused_tokens'], 4)
+
+
+@override_settings(TEXTGEN_KV_CACHE=None)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.saved = _use_stub_models(self)
+        self.client = AsyncClient()
+
+    async def test_generation_is_awaited_on_a_worker(self):
+        response = await self.client.post('/generate/', {'prompt': 'Hello'}, content_type='application/json',
+                                          headers={'X-Request-ID': 'abc'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['response'])
+        self.assertEqual(response['X-Request-ID'], 'abc')
+        self.assertEqual(self.saved, ['Hello'])
+
+    async def test_streams_asynchronously_under_asgi(self):
+        response = await self.client.post('/generate/stream/', {'prompt': 'Hello', 'max_tokens': 3},
+                                          content_type='application/json')
+        self.assertTrue(response.is_async)
+        frames = [chunk async for chunk in response.streaming_content]
+        self.assertEqual([frame.split(b'\n')[0] for frame in frames], [b'event: token'] * 3 + [b'event: done'])
+
+    async def test_conversations_and_history_use_the_async_orm(self):
+        response = await self.client.post('/conversations/', {'title': 'Trip', 'system_prompt': 'Be brief.'},
+                                          content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        conversation_id = response.json()['id']
+        response = await self.client.get(f'/conversations/{conversation_id}/')
+        self.assertEqual((response.json()['title'], response.json()['messages']), ('Trip', []))
+        self.assertEqual((await self.client.get('/conversations/999999/')).status_code, 404)
+
+        await Chat.objects.acreate(prompt='Earlier', response='Answer')
+        response = await self.client.get('/history/')
+        self.assertEqual([item['preview'] for item in response.json()['items']], ['Earlier'])
+
+    async def test_a_cancelled_request_cancels_its_job(self):
+        pool = GenerationScheduler(num_workers=1, max_queue_size=1, request_timeout=WAIT)
+        started, release = threading.Event(), threading.Event()
+        self.addCleanup(release.set)
+        pool.submit(lambda: started.set() or release.wait(WAIT))
+        self.assertTrue(started.wait(WAIT))
+        task = asyncio.ensure_future(pool.arun(lambda: 'never', request_id='waiting'))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        # The queued job gave up its slot and will never run
+        self.assertEqual(pool.queue_size(), 0)
+        self.assertFalse(pool.cancel('waiting'))
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_histograms_render_cumulative_buckets(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency.', (0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value)
+        self.assertEqual(self.registry.render_prometheus().splitlines(), [
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1.0"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            'latency_seconds_sum 4.25',
+            'latency_seconds_count 4',
+        ])
+
+    def test_counters_and_gauges_render_their_values(self):
+        self.registry.counter('requests_total', 'Requests.').inc(3)
+        # Asking for an existing name returns the same metric
+        self.registry.counter('requests_total', 'Requests.').inc()
+        self.registry.gauge('queue', 'Queued.', lambda: 2)
+        self.registry.gauge('unknown', 'Not available here.', lambda: None)
+        text = self.registry.render_prometheus()
+        self.assertIn('# TYPE requests_total counter\nrequests_total 4\n', text)
+        self.assertIn('# TYPE queue gauge\nqueue 2\n', text)
+        self.assertNotIn('unknown', text)
+        self.assertEqual(self.registry.snapshot(), {'requests_total': 4, 'queue': 2, 'unknown': None})
+
+    def test_summaries_use_recent_samples(self):
+        histogram = self.registry.histogram('rate', 'Rate.', metrics.RATE_BUCKETS)
+        self.assertEqual(histogram.summary(), {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'max': None})
+        for value in range(1, metrics.RECENT_SAMPLES + 101):
+            histogram.observe(value)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], metrics.RECENT_SAMPLES + 100)
+        # The oldest 100 samples left the ring buffer
+        self.assertEqual((summary['p50'], summary['max']), (229, metrics.RECENT_SAMPLES + 100))
+
+    def test_streamed_completions_record_first_token_and_rates(self):
+        before = (metrics.generations.value, metrics.completion_tokens.value, metrics.time_to_first_token.count,
+                  metrics.generation_tokens_per_second.count)
+        timer = metrics.GenerationTimer()
+        for _ in range(3):
+            timer.token()
+            time.sleep(0.001)
+        timer.finish(10)
+        after = (metrics.generations.value, metrics.completion_tokens.value, metrics.time_to_first_token.count,
+                 metrics.generation_tokens_per_second.count)
+        self.assertEqual([b - a for a, b in zip(before, after)], [1, 3, 1, 1])
+        self.assertEqual((timer.prompt_token_count, timer.completion_token_count), (10, 3))
+
+    def test_endpoints_serve_the_process_metrics(self):
+        client = Client(HTTP_HOST='localhost')
+        response = client.get('/metrics')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'# TYPE textgen_generations_total counter', response.content)
+        self.assertEqual(client.get('/stats/').status_code, 200)
+
+
+@override_settings(TEXTGEN_KV_CACHE=None)
+class BenchTests(TransactionTestCase):
+    def test_percentiles_and_summary(self):
+        self.assertIsNone(bench._percentile([], 0.5))
+        self.assertEqual(bench._percentile([3, 1, 2, 4, 5], 0.5), 3)
+        self.assertEqual(bench._percentile([3, 1, 2, 4, 5], 0.99), 5)
+        samples = [{'latency': 1.0, 'ttft': 0.2, 'tokens': 5, 'tokens_per_second': 5.0, 'error': None},
+                   {'latency': 9.0, 'ttft': None, 'tokens': 0, 'tokens_per_second': None, 'error': 'HTTP 503'}]
+        summary = bench._summarize(samples, wall_seconds=2.0)
+        self.assertEqual((summary['requests'], summary['errors']), (2, 1))
+        # Failed requests do not count towards latency or throughput
+        self.assertEqual(summary['latency']['max'], 1.0)
+        self.assertEqual(summary['throughput'], {'requests_per_second': 0.5, 'tokens_per_second': 2.5})
+
+    def test_stub_run_covers_both_targets_and_cleans_up(self):
+        settings_cache.invalidate()
+        self.addCleanup(settings_cache.invalidate)
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        Chat.objects.create(prompt='kept', response='before the run')
+
+        call_command('bench', '--stub', '--stub-token-ms=0', '--stub-prompt-token-ms=0', '--requests=3',
+                     '--max-tokens=4', '--concurrency=2', f'--output={path}', stdout=StringIO())
+        with open(path, encoding='utf-8') as output:
+            report = json.load(output)
+        self.assertEqual(report['run']['backend'], 'stub')
+        for target in ('python', 'http'):
+            result = report['results'][target]
+            self.assertEqual((result['requests'], result['errors']), (3, 0))
+            self.assertIsNotNone(result['cold']['ttft'])
+        # The chats the run created are removed and the real loader is restored
+        self.assertEqual(list(Chat.objects.values_list('prompt', flat=True)), ['kept'])
+        self.assertIsNone(model_registry.registry._loader)
+
+
+def _gguf_string(text: str) -> bytes:
+    data = text.encode('utf-8')
+    return struct.pack('<Q', len(data)) + data
+
+
+def _write_gguf(test, metadata: list[tuple[str, int, bytes]]) -> str:
+    """Writes a GGUF header with no tensors; ``metadata`` holds (key, value type, encoded value)."""
+    handle, path = tempfile.mkstemp(suffix='.gguf')
+    with os.fdopen(handle, 'wb') as f:
+        f.write(gguf.GGUF_MAGIC + struct.pack('<IQQ', 3, 0, len(metadata)))
+        for key, value_type, value in metadata:
+            f.write(_gguf_string(key) + struct.pack('<I', value_type) + value)
+    test.addCleanup(os.remove, path)
+    return path
+
+
+# A 2-layer llama with grouped-query attention and a three-token vocabulary
+LLAMA_METADATA = [
+    ('general.architecture', 8, _gguf_string('llama')),
+    ('general.file_type', 4, struct.pack('<I', 15)),
+    ('llama.context_length', 4, struct.pack('<I', 2048)),
+    ('llama.block_count', 4, struct.pack('<I', 2)),
+    ('llama.embedding_length', 4, struct.pack('<I', 64)),
+    ('llama.attention.head_count', 4, struct.pack('<I', 8)),
+    ('llama.attention.head_count_kv', 4, struct.pack('<I', 2)),
+    ('llama.rope.freq_base', 6, struct.pack('<f', 10000.0)),
+    ('tokenizer.ggml.tokens', 9, struct.pack('<IQ', 8, 3) + b''.join(_gguf_string(t) for t in ('<s>', 'a', 'b'))),
+]
+
+
+class GGUFTests(SimpleTestCase):
+    def test_reads_metadata_and_counts_arrays(self):
+        metadata = gguf.read_metadata(_write_gguf(self, LLAMA_METADATA))
+        self.assertEqual(metadata['gguf.version'], 3)
+        self.assertEqual(gguf.architecture_value(metadata, 'context_length'), 2048)
+        self.assertEqual(metadata['llama.rope.freq_base'], 10000.0)
+        self.assertEqual(metadata['tokenizer.ggml.tokens'], 3)
+        self.assertEqual(gguf.quantization(metadata), 'Q4_K_M')
+
+    def test_arrays_can_be_kept(self):
+        metadata = gguf.read_metadata(_write_gguf(self, LLAMA_METADATA), keep_arrays=True)
+        self.assertEqual(metadata['tokenizer.ggml.tokens'], ['<s>', 'a', 'b'])
+
+    def test_rejects_other_and_truncated_files(self):
+        handle, path = tempfile.mkstemp()
+        with os.fdopen(handle, 'wb') as f:
+            f.write(b'not a model')
+        self.addCleanup(os.remove, path)
+        with self.assertRaises(gguf.GGUFError):
+            gguf.read_metadata(path)
+
+        complete = _write_gguf(self, LLAMA_METADATA)
+        with open(complete, 'rb') as f:
+            header = f.read()
+        with open(path, 'wb') as f:
+            f.write(header[:40])
+        with self.assertRaises(gguf.GGUFError):
+            gguf.read_metadata(path)
+
+    def test_unknown_quantizations_are_reported_by_number(self):
+        self.assertEqual(gguf.quantization({'general.file_type': 99}), '99')
+        self.assertIsNone(gguf.quantization({}))
+
+
+@mock.patch.object(autotune, '_supports_gpu_offload', lambda: False)
+class AutotuneTests(TestCase):
+    def setUp(self):
+        self.cpu = autotune.CpuTopology(cpu_count=8, performance_cores=4, clusters=((2800000, 4), (1800000, 4)))
+        self.metadata = gguf.read_metadata(_write_gguf(self, LLAMA_METADATA))
+        autotune.invalidate()
+        self.addCleanup(autotune.invalidate)
+
+    def test_kv_cache_size_follows_the_attention_shape(self):
+        # K and V, 2 layers, 8-dim heads, 2 KV heads, 2 bytes each
+        self.assertEqual(autotune.kv_cache_bytes_per_token(self.metadata), 2 * 2 * 8 * 2 * 2)
+
+    def test_threads_follow_the_cpu_and_context_the_memory(self):
+        with self.settings(TEXTGEN_AUTOTUNE_RESERVED_MB=0):
+            roomy = autotune.choose_parameters(0, self.metadata, self.cpu, memory_bytes=4 * 1024 ** 3)
+            tight = autotune.choose_parameters(0, {}, self.cpu, memory_bytes=700 * 1024 ** 2)
+        self.assertEqual(roomy, {'n_threads': 4, 'n_threads_batch': 8, 'n_batch': 512, 'n_ctx': 2048,
+                                 'n_gpu_layers': 0})
+        # The fallback 7B shape needs 512 KiB per token, so only a short context fits
+        self.assertEqual((tight['n_batch'], tight['n_ctx']), (128, 1024))
+
+    def test_big_little_clusters_exclude_the_slowest_cores(self):
+        frequencies = {f'/cpu{i}/cpuinfo_max_freq': freq for i, freq in enumerate([1800000] * 4 + [2400000] * 3
+                                                                                 + [3000000])}
+        with mock.patch.object(autotune.glob, 'glob', return_value=list(frequencies)), \
+                mock.patch('builtins.open', lambda path: StringIO(str(frequencies[path]))):
+            cpu = autotune.detect_cpu()
+        self.assertEqual(cpu.clusters, ((3000000, 1), (2400000, 3), (1800000, 4)))
+        self.assertEqual(cpu.performance_cores, 4)
+
+    def test_calibration_keeps_the_fastest_thread_count(self):
+        def load(n_threads, **kwargs):
+            # More threads decode faster, up to six
+            return stub_backend.StubLlama(load_seconds=0, prompt_token_seconds=0,
+                                          token_seconds=0.002 * abs(6 - n_threads) + 0.001)
+        params = {'n_threads_batch': 8, 'n_batch': 512, 'n_gpu_layers': 0}
+        best, tokens_per_second = autotune.calibrate('/models/a.gguf', params, [4, 6, 8], loader=load)
+        self.assertEqual(best, 6)
+        self.assertGreater(tokens_per_second, 0)
+
+    def test_profiles_are_stored_and_rebuilt_when_the_file_changes(self):
+        path = _write_gguf(self, LLAMA_METADATA)
+        params = autotune.apply_profile(ResolvedSettings(model_path=path, n_threads=1))
+        profile = ModelProfile.objects.get(model_path=path)
+        self.assertEqual((profile.architecture, profile.quantization, profile.trained_n_ctx), ('llama', 'Q4_K_M', 2048))
+        self.assertEqual((params.n_threads, params.n_ctx), (profile.n_threads, profile.n_ctx))
+        with self.assertNumQueries(0):
+            autotune.get_profile(path)
+
+        with open(path, 'ab') as f:
+            f.write(b'\0' * 16)
+        autotune.invalidate()
+        self.assertEqual(autotune.get_profile(path).file_size, os.path.getsize(path))
+
+    def test_missing_models_keep_the_configured_parameters(self):
+        params = ResolvedSettings(model_path='/models/missing.gguf', n_threads=3)
+        self.assertIs(autotune.apply_profile(params), params)
+
+
+def _formatter(render, stop=None):
+    """A llama_cpp-style chat formatter: ``render(messages)`` gives the prompt text."""
+    return lambda messages: mock.Mock(prompt=render(messages), stop=stop)
+
+
+def _chat_markup(messages):
+    return ''.join(f"<{m['role']}>{m['content']}</{m['role']}>" for m in messages) + '<assistant>'
+
+
+class PromptTemplateTests(SimpleTestCase):
+    def setUp(self):
+        self.model = stub_backend.StubLlama(load_seconds=0)
+
+    def _template(self, formatter=None):
+        template = prompt_templates.PromptTemplate(self.model, '')
+        template.formatter = formatter
+        return template
+
+    def _tokens(self, text):
+        return self.model.tokenize(text.encode('utf-8'), add_bos=True, special=True)
+
+    def test_without_llama_cpp_prompts_are_sent_raw(self):
+        with mock.patch.dict(sys.modules, {'llama_cpp': None}):
+            template = prompt_templates.PromptTemplate(self.model, 'chatml')
+        self.assertEqual((template.source, template.formatter), ('raw', None))
+        prepared = template.prepare('Hi there', system_prompt='Be brief.', stop=('###',))
+        self.assertEqual(prepared, prompt_templates.PreparedPrompt(self._tokens('Be brief.\n\nHi there'), ('###',)))
+
+    def test_the_user_message_is_wrapped_by_the_template(self):
+        template = self._template(_formatter(_chat_markup, stop='</assistant>'))
+        prepared = template.prepare('Hello', system_prompt='Be brief.', stop=('</assistant>', '\n\n'))
+        text = '<system>Be brief.</system><user>Hello</user><assistant>'
+        self.assertEqual(prepared.tokens, self._tokens(text))
+        # The template's stop comes first and duplicates are dropped
+        self.assertEqual(prepared.stop, ('</assistant>', '\n\n'))
+
+    def test_prefix_and_suffix_are_tokenized_once_when_separable(self):
+        # Four-byte prefix and no suffix, so the stub's four-byte tokens never straddle the cut
+        template = self._template(_formatter(lambda messages: f"[U] {messages[-1]['content']}"))
+        with mock.patch.object(self.model, 'tokenize', wraps=self.model.tokenize) as tokenize:
+            first = template.prepare('Hello, world')
+            calls = tokenize.call_count
+            self.assertEqual(template.prepare('Hello, world'), first)
+            self.assertEqual(tokenize.call_count, calls)
+            template.prepare('Another question')
+            # Only the new text is tokenized
+            self.assertEqual(tokenize.call_count, calls + 1)
+        self.assertTrue(template._split('').separable)
+        self.assertEqual(first.tokens, self._tokens('[U] Hello, world'))
+
+    def test_tokenizers_that_merge_across_the_cut_tokenize_whole_prompts(self):
+        template = self._template(_formatter(_chat_markup))
+        self.assertFalse(template._split('').separable)
+        self.assertEqual(template.prepare('Hi').tokens, self._tokens('<user>Hi</user><assistant>'))
+
+    def test_a_rejected_system_role_is_merged_into_the_user_turn(self):
+        def no_system(messages):
+            if messages[0]['role'] == 'system':
+                raise ValueError('System role not supported')
+            return _chat_markup(messages)
+        template = self._template(_formatter(no_system))
+        self.assertEqual(template.prepare('Hi', system_prompt='Be brief.').tokens,
+                         self._tokens('<user>Be brief.\n\nHi</user><assistant>'))
+
+    def test_templates_must_place_the_message_once(self):
+        template = self._template(_formatter(lambda messages: messages[-1]['content'] * 2))
+        with self.assertRaises(ValueError):
+            template.prepare('Hi')
+
+    def test_conversations_render_every_turn(self):
+        template = self._template(_formatter(_chat_markup))
+        messages = [{'role': 'user', 'content': 'Hi'}, {'role': 'assistant', 'content': 'Hello'},
+                    {'role': 'user', 'content': 'Bye'}]
+        prepared = template.prepare_messages(messages, system_prompt='Be brief.')
+        self.assertEqual(prepared.tokens, self._tokens(_chat_markup([{'role': 'system', 'content': 'Be brief.'}]
+                                                                    + messages)))
+        # A single turn goes through the cached split
+        single = template.prepare_messages([{'role': 'user', 'content': 'Hi'}])
+        self.assertEqual(single, template.prepare('Hi'))
+
+    def test_templates_are_compiled_once_per_model(self):
+        params = ResolvedSettings(chat_format='', system_prompt='')
+        self.assertIs(prompt_templates.for_model(self.model, ''), prompt_templates.for_model(self.model, 'other'))
+        self.assertEqual(prompt_templates.prepare(self.model, params, 'Hi').tokens, self._tokens('Hi'))
+        self.assertEqual(prompt_templates.prepare_raw(self.model, 'Hi', ('x',)).stop, ('x',))
+
+    def test_chat_completions_switch_to_the_embedded_template(self):
+        self.model.chat_format = 'llama-2'
+        self.model._chat_handlers = {prompt_templates.EMBEDDED_CHAT_FORMAT: object()}
+        prompt_templates.use_embedded_chat_template(self.model)
+        self.assertEqual(self.model.chat_format, prompt_templates.EMBEDDED_CHAT_FORMAT)
+
+
+class StartupTests(SimpleTestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(startup, 'timeline', startup.StartupTimeline()),
+            mock.patch.object(startup, '_started', False),
+            mock.patch.object(startup, '_start_indexer'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.timeline = startup.timeline
+
+    def test_steps_are_timed_from_process_start(self):
+        self.timeline.mark('entry')
+        with self.timeline.step('load'):
+            time.sleep(0.01)
+        self.timeline.set_state(startup.READY)
+        ready_after = self.timeline.ready_after
+        time.sleep(0.01)
+        self.timeline.set_state(startup.READY)
+        snapshot = self.timeline.snapshot()
+        self.assertEqual([event['event'] for event in snapshot['timeline']], ['entry', 'load'])
+        self.assertGreaterEqual(snapshot['timeline'][1]['seconds'], 0.01)
+        # Only the first time the server became ready counts
+        self.assertEqual(snapshot['ready_after'], ready_after)
+        self.assertTrue(snapshot['ready'])
+        self.assertRegex(self.timeline.summary(), r'^entry at [\d.]+s, load [\d.]+s; ready after [\d.]+s$')
+
+    def test_preloading_marks_the_server_ready(self):
+        with mock.patch.dict(sys.modules, {'llama_cpp': mock.Mock()}), \
+                mock.patch.object(generation, 'preload_default_model') as preload:
+            startup._preload()
+        preload.assert_called_once_with()
+        snapshot = self.timeline.snapshot()
+        self.assertEqual(snapshot['state'], startup.READY)
+        self.assertEqual([event['event'] for event in snapshot['timeline']],
+                         ['import llama_cpp', 'load default model'])
+        startup._start_indexer.assert_called_once_with()
+
+    def test_a_failed_preload_is_reported(self):
+        with mock.patch.dict(sys.modules, {'llama_cpp': mock.Mock()}), \
+                mock.patch.object(generation, 'preload_default_model', side_effect=OSError('no such model')), \
+                self.assertLogs('textgen.startup', 'ERROR'):
+            startup._preload()
+        self.assertEqual((self.timeline.state, self.timeline.error), (startup.FAILED, 'no such model'))
+        startup._start_indexer.assert_not_called()
+
+    def test_without_preloading_the_server_is_ready_at_once(self):
+        with self.settings(TEXTGEN_PRELOAD_MODEL=False):
+            startup.start()
+            startup.start()
+        self.assertEqual(self.timeline.state, startup.READY)
+        # Started once, however many entry points call start()
+        self.assertEqual([event['event'] for event in self.timeline.events], ['server entry point'])
+
+    def test_readiness_is_503_until_ready(self):
+        client = Client(HTTP_HOST='localhost')
+        self.timeline.set_state(startup.LOADING)
+        response = client.get('/ready/')
+        self.assertEqual((response.status_code, response.json()['state']), (503, 'loading'))
+        self.timeline.set_state(startup.READY)
+        self.assertEqual(client.get('/ready/').status_code, 200)
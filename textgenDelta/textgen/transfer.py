@@ -0,0 +1,407 @@
+import itertools
+import json
+import logging
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from typing import IO, Iterable, Iterator, Optional
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from . import settings_cache
+from .models import Chat, TextGenerationSettings
+from .persistence import chat_writer
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Import/Export Defaults ---
+DEFAULT_CHUNK_SIZE = 500  # rows per database round trip, and per compressed chunk sent to the client
+DEFAULT_IMPORT_BATCH_SIZE = 500
+READ_CHUNK_BYTES = 64 * 1024
+DEFAULT_IMPORT_MAX_MB = 1024  # decompressed size an import may reach, so a compression bomb cannot fill the disk
+MAX_RECORD_BYTES = 16 * 1024 * 1024  # one JSON line; anything longer is not an exported record
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+FORMAT_NAME = 'textgen-history'
+FORMAT_VERSION = 1
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+PLAIN = 'jsonl'
+CODECS = (GZIP, ZSTD, PLAIN)
+EXTENSIONS = {GZIP: '.jsonl.gz', ZSTD: '.jsonl.zst', PLAIN: '.jsonl'}
+CONTENT_TYPES = {GZIP: 'application/gzip', ZSTD: 'application/zstd', PLAIN: 'application/x-ndjson'}
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_GZIP_MAGIC = b'\x1f\x8b'
+# Everything a settings row holds except its database id
+SETTINGS_FIELDS = tuple(f.name for f in TextGenerationSettings._meta.concrete_fields if f.name != 'id')
+SAMPLING_FIELDS = ('temperature', 'max_tokens', 'top_p', 'top_k', 'seed')
+
+
+class TransferError(ValueError):
+    """Raised for unreadable archives and unavailable codecs."""
+
+
+@dataclass
+class ImportResult:
+    chats_created: int = 0
+    chats_skipped: int = 0
+    settings_created: int = 0
+    settings_updated: int = 0
+    settings_skipped: int = 0
+    # Newest chat timestamp in the archive; export again with ``since`` set to it to continue
+    last_timestamp: Optional[datetime] = None
+    # False when the archive ended without its trailer, e.g. an interrupted download
+    complete: bool = False
+
+    def as_dict(self) -> dict:
+        return {
+            'chats_created': self.chats_created,
+            'chats_skipped': self.chats_skipped,
+            'settings_created': self.settings_created,
+            'settings_updated': self.settings_updated,
+            'settings_skipped': self.settings_skipped,
+            'last_timestamp': self.last_timestamp.isoformat() if self.last_timestamp else None,
+            'complete': self.complete,
+        }
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise TransferError("zstd archives need the optional 'zstandard' package (pip install zstandard)") from e
+    return zstandard
+
+
+def codec_for_filename(filename: str, default: str = GZIP) -> str:
+    for codec, extension in EXTENSIONS.items():
+        if filename.endswith(extension) or (codec == ZSTD and filename.endswith('.zst')) \
+                or (codec == GZIP and filename.endswith('.gz')):
+            return codec
+    return default
+
+
+def parse_since(value: Optional[str]) -> Optional[datetime]:
+    """Parses an ISO date or datetime; naive values are taken in the server's time zone."""
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise TransferError(f"Invalid timestamp: {value!r}")
+        moment = datetime(day.year, day.month, day.day)
+    return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+
+# --- Export ---
+
+def export_records(since: Optional[datetime] = None, include_settings: bool = True,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[dict]:
+    """Yields the archive's records: a header, settings rows, chats oldest first, then a trailer.
+
+    Chats are read with ``iterator(chunk_size=...)`` so memory use does not
+    grow with the history. ``since`` is inclusive so chats sharing the
+    boundary timestamp are not lost; importing deduplicates the overlap.
+    """
+    # Chats still in the write-behind buffer belong in the export too
+    chat_writer.flush()
+    yield {
+        'type': 'header', 'format': FORMAT_NAME, 'version': FORMAT_VERSION,
+        'exported_at': timezone.now().isoformat(), 'since': since.isoformat() if since else None,
+    }
+    if include_settings:
+        for row in TextGenerationSettings.objects.order_by('id').values(*SETTINGS_FIELDS):
+            yield {'type': 'settings', **row}
+
+    chats = Chat.objects.order_by('timestamp', 'id')
+    if since is not None:
+        chats = chats.filter(timestamp__gte=since)
+    count = 0
+    last_timestamp = None
+    for prompt, response, timestamp in chats.values_list('prompt', 'response', 'timestamp') \
+            .iterator(chunk_size=chunk_size):
+        count += 1
+        last_timestamp = timestamp
+        yield {'type': 'chat', 'timestamp': timestamp.isoformat(), 'prompt': prompt, 'response': response}
+    yield {'type': 'end', 'chats': count, 'last_timestamp': last_timestamp.isoformat() if last_timestamp else None}
+
+
+class _Compressor:
+    """Streaming compressor with the zlib ``compress``/``flush`` interface for every codec."""
+
+    def __init__(self, codec: str):
+        if codec == GZIP:
+            # wbits 31 writes a gzip header and trailer around the deflate stream
+            self._inner = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        elif codec == ZSTD:
+            self._inner = _zstandard().ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif codec == PLAIN:
+            self._inner = None
+        else:
+            raise TransferError(f"Unknown format {codec!r}; expected one of {', '.join(CODECS)}")
+
+    def compress(self, data: bytes) -> bytes:
+        return self._inner.compress(data) if self._inner else data
+
+    def flush(self) -> bytes:
+        return self._inner.flush() if self._inner else b''
+
+
+def check_codec(codec: str) -> None:
+    """Raises ``TransferError`` if ``codec`` is unknown or its package is not installed."""
+    _Compressor(codec)
+
+
+def export_stream(codec: str = GZIP, since: Optional[datetime] = None, include_settings: bool = True,
+                  chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yields the compressed archive, one chunk per ``chunk_size`` records."""
+    compressor = _Compressor(codec)
+    lines = []
+    for record in export_records(since, include_settings, chunk_size):
+        lines.append(json.dumps(record, ensure_ascii=False))
+        if len(lines) >= chunk_size:
+            chunk = compressor.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+            lines = []
+            if chunk:
+                yield chunk
+    tail = compressor.compress(('\n'.join(lines) + '\n').encode('utf-8')) if lines else b''
+    yield tail + compressor.flush()
+
+
+def export_to_file(fileobj: IO[bytes], **kwargs) -> int:
+    written = 0
+    for chunk in export_stream(**kwargs):
+        fileobj.write(chunk)
+        written += len(chunk)
+    return written
+
+
+# --- Import ---
+
+def read_chunks(fileobj, size: int = READ_CHUNK_BYTES) -> Iterator[bytes]:
+    return iter(lambda: fileobj.read(size), b'')
+
+
+class _ChunkReader:
+    """File-like view of an iterator of byte chunks, for zstandard's stream reader."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _decompress_zstd(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    zstandard = _zstandard()
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        _ChunkReader(chunks), read_size=READ_CHUNK_BYTES, read_across_frames=True,
+    )
+    try:
+        while data := reader.read(READ_CHUNK_BYTES):
+            yield data
+    except zstandard.ZstdError as e:
+        raise TransferError(f"Corrupt zstd archive: {e}") from e
+
+
+def _decompress_gzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj(31)
+    try:
+        for chunk in chunks:
+            while chunk:
+                # max_length bounds what one call inflates, however well the input compresses
+                yield decompressor.decompress(chunk, READ_CHUNK_BYTES)
+                if not decompressor.eof:
+                    chunk = decompressor.unconsumed_tail
+                    continue
+                chunk = decompressor.unused_data
+                if chunk:
+                    if not chunk.startswith(_GZIP_MAGIC):
+                        raise TransferError("Unexpected data after the end of the compressed archive")
+                    decompressor = zlib.decompressobj(31)
+    except zlib.error as e:
+        raise TransferError(f"Corrupt gzip archive: {e}") from e
+
+
+def _decompress(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Detects the codec from the first bytes and decompresses chunk by chunk.
+
+    Concatenated archives (e.g. incremental exports appended to one file)
+    are read member by member. Output comes in pieces of at most
+    ``READ_CHUNK_BYTES`` and stops with ``TransferError`` past
+    ``TEXTGEN_IMPORT_MAX_MB``.
+    """
+    chunks = iter(chunks)
+    head = next(chunks, b'')
+    chunks = itertools.chain([head], chunks)
+    if head.startswith(_GZIP_MAGIC):
+        output = _decompress_gzip(chunks)
+    elif head.startswith(_ZSTD_MAGIC):
+        output = _decompress_zstd(chunks)
+    else:
+        output = chunks
+    limit = getattr(settings, 'TEXTGEN_IMPORT_MAX_MB', DEFAULT_IMPORT_MAX_MB) * 1024 * 1024
+    total = 0
+    for data in output:
+        total += len(data)
+        if total > limit:
+            raise TransferError(f"Archive is larger than {limit // (1024 * 1024)} MB once decompressed")
+        yield data
+
+
+def _lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    buffer = b''
+    for chunk in _decompress(chunks):
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        yield from lines
+        if len(buffer) > MAX_RECORD_BYTES:
+            raise TransferError(f"A record is longer than {MAX_RECORD_BYTES // (1024 * 1024)} MB")
+    if buffer.strip():
+        # Every exported record ends with a newline, so this is the cut-off end of a truncated archive
+        logger.warning(f"Ignoring {len(buffer)} bytes of an incomplete last record")
+
+
+def _records(chunks: Iterable[bytes]) -> Iterator[dict]:
+    seen_header = False
+    for number, line in enumerate(_lines(chunks), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise TransferError(f"Line {number} is not valid JSON: {e}") from e
+        if not isinstance(record, dict) or 'type' not in record:
+            raise TransferError(f"Line {number} is not an archive record")
+        if record['type'] == 'header':
+            if record.get('format') != FORMAT_NAME:
+                raise TransferError(f"Line {number}: not a {FORMAT_NAME} archive")
+            seen_header = True
+        elif not seen_header:
+            raise TransferError(f"Not a {FORMAT_NAME} archive: it does not start with a header record")
+        yield record
+    if not seen_header:
+        raise TransferError(f"Not a {FORMAT_NAME} archive: no records found")
+
+
+def _chat_from_record(record: dict) -> Chat:
+    timestamp = parse_datetime(record.get('timestamp') or '')
+    if timestamp is None or not isinstance(record.get('prompt'), str) or not isinstance(record.get('response'), str):
+        raise TransferError(f"Malformed chat record: {str(record)[:200]}")
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return Chat(prompt=record['prompt'], response=record['response'], timestamp=timestamp)
+
+
+def _store_chats(batch: list[Chat], result: ImportResult) -> None:
+    # Chats still in the write-behind buffer are not in the table yet, so the duplicate check would miss them
+    chat_writer.flush()
+    # A chat already present has the same timestamp, prompt and response; timestamps narrow the lookup
+    existing = set(Chat.objects.filter(timestamp__in={chat.timestamp for chat in batch})
+                   .values_list('timestamp', 'prompt', 'response'))
+    new = []
+    for chat in batch:
+        key = (chat.timestamp, chat.prompt, chat.response)
+        if key in existing:
+            result.chats_skipped += 1
+            continue
+        existing.add(key)
+        new.append(chat)
+    if new:
+        # Take ids from the write-behind buffer's sequence so its next insert does not collide with ours
+        first_id = chat_writer.reserve_ids(len(new))
+        if first_id is not None:
+            for offset, chat in enumerate(new):
+                chat.id = first_id + offset
+        with transaction.atomic():
+            Chat.objects.bulk_create(new)
+        result.chats_created += len(new)
+
+
+def _valid_settings(row: TextGenerationSettings, values: dict) -> TextGenerationSettings:
+    """Applies an archive's values to ``row``, checked like the model's form fields and request overrides."""
+    for name, value in values.items():
+        setattr(row, name, value)
+    try:
+        row.full_clean(validate_unique=False)
+        # The ranges requests are held to (e.g. top_p within [0, 1]) apply to stored defaults as well
+        settings_cache.validate_overrides(**{name: getattr(row, name) for name in SAMPLING_FIELDS})
+    except (ValidationError, settings_cache.InvalidOverride) as e:
+        raise TransferError(f"Invalid settings record {values['identifier']!r}: {e}") from e
+    return row
+
+
+def _store_settings(records: list[dict], overwrite: bool, result: ImportResult) -> None:
+    rows = {}
+    for record in records:
+        values = {name: record[name] for name in SETTINGS_FIELDS if name in record}
+        if not values.get('identifier'):
+            raise TransferError(f"Settings record without an identifier: {str(record)[:200]}")
+        rows[values['identifier']] = values
+    existing = {row.identifier: row for row in TextGenerationSettings.objects.filter(identifier__in=rows)}
+    new = [_valid_settings(TextGenerationSettings(), values) for identifier, values in rows.items()
+           if identifier not in existing]
+    updated = [_valid_settings(row, rows[identifier]) for identifier, row in existing.items() if overwrite]
+    with transaction.atomic():
+        TextGenerationSettings.objects.bulk_create(new)
+        for row in updated:
+            row.save()
+    result.settings_skipped += len(existing) - len(updated)
+    result.settings_updated += len(updated)
+    result.settings_created += len(new)
+    if new:
+        # bulk_create sends no post_save, so the settings cache is not cleared by the signal
+        settings_cache.invalidate()
+
+
+def import_stream(chunks: Iterable[bytes], batch_size: int = DEFAULT_IMPORT_BATCH_SIZE,
+                  overwrite_settings: bool = False) -> ImportResult:
+    """Imports an archive from raw (gzip, zstd or plain) byte chunks.
+
+    Chats are written in batches of ``batch_size``, each committed on its
+    own, so an interrupted import keeps what it wrote and can simply be run
+    again: chats already present are skipped. Settings rows are matched by
+    identifier and only replaced with ``overwrite_settings``.
+    """
+    result = ImportResult()
+    settings_records = []
+    batch: list[Chat] = []
+    for record in _records(chunks):
+        kind = record['type']
+        if kind == 'chat':
+            chat = _chat_from_record(record)
+            batch.append(chat)
+            if result.last_timestamp is None or chat.timestamp > result.last_timestamp:
+                result.last_timestamp = chat.timestamp
+            if len(batch) >= batch_size:
+                _store_chats(batch, result)
+                batch = []
+        elif kind == 'settings':
+            settings_records.append(record)
+        elif kind == 'end':
+            result.complete = True
+        elif kind == 'header':
+            result.complete = False  # a concatenated archive starts another member
+        else:
+            logger.warning(f"Skipping unknown archive record type {kind!r}")
+    if batch:
+        _store_chats(batch, result)
+    if settings_records:
+        _store_settings(settings_records, overwrite_settings, result)
+    logger.info(f"Imported chat history: {result.as_dict()}")
+    return result
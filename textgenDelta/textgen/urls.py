@@ -6,4 +6,25 @@ urlpatterns = [
     path('', views.index, name='index'),  # Maps main URL / to the index view
     # path('chat/', views.chat_page, name='chat'),
     path('generate/', views.generate_ajax, name='generate'),  # Keep using AJAX
+    path('generate/stream/', views.generate_stream, name='generate_stream'),  # Server-sent events
+    path('generate/batch/', views.generate_batch_view, name='generate_batch'),  # Many prompts, optionally as JSON lines
+    path('generate/<str:request_id>/cancel/', views.cancel_generation, name='cancel_generation'),  # By X-Request-ID
+    path('stats/', views.stats_page, name='stats'),
+    path('stats/cache/', views.cache_stats, name='cache_stats'),
+    path('stats/memory/', views.memory_status, name='memory_status'),
+    path('ready/', views.readiness, name='readiness'),
+    path('metrics', views.metrics_view, name='metrics'),  # Prometheus scrape target
+    path('history/', views.history_api, name='history'),
+    path('history/export/', views.history_export, name='history_export'),  # Compressed JSON lines
+    path('history/import/', views.history_import, name='history_import'),
+    path('history/<int:chat_id>/', views.chat_detail, name='chat_detail'),
+    path('search/', views.search_api, name='search'),  # Full-text search over chats (FTS5)
+    # OpenAI-compatible API on the same models and scheduler
+    path('v1/models', views.openai_models, name='openai_models'),
+    path('v1/completions', views.openai_completions, name='openai_completions'),
+    path('v1/chat/completions', views.openai_chat_completions, name='openai_chat_completions'),
+    path('v1/embeddings', views.openai_embeddings, name='openai_embeddings'),
+    path('conversations/', views.conversation_create, name='conversation_create'),
+    path('conversations/<int:conversation_id>/', views.conversation_detail, name='conversation_detail'),
+    path('conversations/<int:conversation_id>/messages/', views.conversation_message, name='conversation_message'),
 ]
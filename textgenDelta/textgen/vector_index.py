@@ -0,0 +1,241 @@
+import json
+import logging
+import math
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+import numpy as np
+
+# Configure logging for this module
+logger = logging.getLogger(__name__)
+
+
+# --- Vector Index Defaults ---
+# Below this many vectors a query scans them all; above it, only the closest inverted lists are scanned
+ANN_MIN_VECTORS = 4096
+# Inverted lists probed per query; more finds more of the true neighbours at a higher cost
+PROBE_LISTS = 8
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLE = 16384
+MAX_LISTS = 1024
+GROW_ROWS = 1024
+# Rows converted to float32 at a time, so a scan never holds the whole index in RAM
+SCAN_ROWS = 8192
+
+META_FILE = 'meta.json'
+VECTORS_FILE = 'vectors.f16'
+IDS_FILE = 'ids.i64'
+LISTS_FILE = 'lists.i32'
+CENTROIDS_FILE = 'centroids.npy'
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the ``k`` highest scores, best first."""
+    if len(scores) > k:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+class VectorIndex:
+    """Unit-length float16 vectors on disk, searched by cosine similarity.
+
+    Vectors, their ids and their inverted-list numbers live in memory-mapped
+    files that only ever grow, so opening the index costs nothing and the OS
+    pages rows in on demand. Once the index holds ``ANN_MIN_VECTORS`` it is
+    clustered with k-means (an IVF index); a query then scores the vectors of
+    the ``PROBE_LISTS`` clusters nearest to it instead of every vector. The
+    clustering is redone in the background whenever the index has doubled.
+    ``meta.json`` is written last, so rows past its count (a crash mid-add)
+    are simply overwritten by the next ``add``.
+    """
+
+    def __init__(self, directory, model: str = ''):
+        self.directory = Path(directory)
+        self.model = model
+        self._lock = threading.RLock()
+        self._training = False
+        self.dim = 0
+        self.count = 0
+        self.capacity = 0
+        self.last_id = 0
+        self.trained_count = 0
+        self._vectors: Optional[np.memmap] = None
+        self._ids: Optional[np.memmap] = None
+        self._lists: Optional[np.memmap] = None
+        self._centroids: Optional[np.ndarray] = None
+        self._open()
+
+    def __len__(self) -> int:
+        return self.count
+
+    # --- Storage ---
+
+    def _open(self) -> None:
+        try:
+            meta = json.loads((self.directory / META_FILE).read_text())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Vector index in {self.directory} is unreadable, rebuilding it: {e}")
+            return
+        if meta.get('model') != self.model:
+            logger.info(f"Vector index in {self.directory} was built with {meta.get('model')!r}, rebuilding it")
+            return
+        self.dim = int(meta['dim'])
+        self.count = int(meta['count'])
+        self.last_id = int(meta['last_id'])
+        self.capacity = os.path.getsize(self.directory / VECTORS_FILE) // (2 * self.dim)
+        self._map(self.capacity)
+        centroids = self.directory / CENTROIDS_FILE
+        if meta.get('trained_count') and centroids.exists():
+            self._centroids = np.load(centroids)
+            self.trained_count = int(meta['trained_count'])
+        logger.info(f"Opened vector index with {self.count} vectors ({self.dim} dimensions"
+                    f"{f', {len(self._centroids)} lists' if self._centroids is not None else ''})")
+
+    def _map(self, capacity: int) -> None:
+        # Caller must hold self._lock (or be constructing the index)
+        self._flush()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = ((VECTORS_FILE, np.float16, (capacity, self.dim)), (IDS_FILE, np.int64, (capacity,)),
+                 (LISTS_FILE, np.int32, (capacity,)))
+        mapped = []
+        for name, dtype, shape in files:
+            path = self.directory / name
+            with open(path, 'ab') as f:
+                size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                if f.tell() < size:
+                    f.truncate(size)
+            mapped.append(np.memmap(path, dtype=dtype, mode='r+', shape=shape))
+        self._vectors, self._ids, self._lists = mapped
+        self.capacity = capacity
+
+    def _flush(self) -> None:
+        for mapped in (self._vectors, self._ids, self._lists):
+            if mapped is not None:
+                mapped.flush()
+
+    def _write_meta(self) -> None:
+        self._flush()
+        meta = {'model': self.model, 'dim': self.dim, 'count': self.count, 'last_id': self.last_id,
+                'trained_count': self.trained_count}
+        path = self.directory / META_FILE
+        tmp = path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, path)
+
+    # --- Writing ---
+
+    def add(self, ids, vectors: np.ndarray) -> None:
+        """Appends vectors (normalized here) for ``ids``; the ids must be larger than ``last_id``."""
+        vectors = normalize(vectors)
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        with self._lock:
+            if not self.dim:
+                self.dim = vectors.shape[1]
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+            end = self.count + len(ids)
+            if end > self.capacity:
+                self._map(max(end, self.capacity * 2, GROW_ROWS))
+            self._vectors[self.count:end] = vectors
+            self._ids[self.count:end] = ids
+            self._lists[self.count:end] = self._assign(vectors) if self._centroids is not None else -1
+            self.count = end
+            self.last_id = max(self.last_id, int(ids.max()))
+            self._write_meta()
+            retrain = self.count >= ANN_MIN_VECTORS and self.count >= 2 * self.trained_count and not self._training
+            if retrain:
+                self._training = True
+        if retrain:
+            # Clustering reads rows that are never rewritten, so queries keep running meanwhile
+            threading.Thread(target=self._train, name='textgen-vector-index-train', daemon=True).start()
+
+    def _assign(self, vectors: np.ndarray, centroids: Optional[np.ndarray] = None) -> np.ndarray:
+        centroids = self._centroids if centroids is None else centroids
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+    def _train(self) -> None:
+        try:
+            with self._lock:
+                count, vectors = self.count, self._vectors
+            n_lists = min(MAX_LISTS, max(16, int(4 * math.sqrt(count))))
+            rng = np.random.default_rng(count)
+            sample = np.asarray(vectors[np.sort(rng.choice(count, min(count, KMEANS_SAMPLE), replace=False))],
+                                dtype=np.float32)
+            # Spherical k-means: centroids are renormalized so assignment is by cosine similarity
+            centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+            for _ in range(KMEANS_ITERATIONS):
+                assignment = self._assign(sample, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, sample)
+                empty = ~sums.any(axis=1)
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+                centroids = normalize(sums)
+            lists = np.concatenate([
+                self._assign(np.asarray(vectors[start:min(start + SCAN_ROWS, count)], dtype=np.float32), centroids)
+                for start in range(0, count, SCAN_ROWS)
+            ])
+            with self._lock:
+                # Rows added while training are assigned to the new lists too
+                tail = np.asarray(self._vectors[count:self.count], dtype=np.float32)
+                self._lists[:count] = lists
+                self._lists[count:self.count] = self._assign(tail, centroids) if len(tail) else []
+                tmp = self.directory / f'{CENTROIDS_FILE}.tmp'
+                with open(tmp, 'wb') as f:
+                    np.save(f, centroids)
+                os.replace(tmp, self.directory / CENTROIDS_FILE)
+                self._centroids = centroids
+                self.trained_count = count
+                self._write_meta()
+            logger.info(f"Clustered {count} vectors into {n_lists} lists")
+        except Exception as e:
+            logger.error(f"Clustering the vector index failed: {e}")
+        finally:
+            with self._lock:
+                self._training = False
+
+    # --- Searching ---
+
+    def search(self, vector: np.ndarray, k: int) -> list[tuple[int, float]]:
+        """Returns up to ``k`` (id, cosine similarity) pairs, most similar first."""
+        query = normalize(vector).reshape(-1)
+        with self._lock:
+            count = self.count
+            if not count or k <= 0 or query.shape[0] != self.dim:
+                return []
+            vectors, ids, lists, centroids = self._vectors, self._ids, self._lists, self._centroids
+            if centroids is not None:
+                probes = _top(centroids @ query, PROBE_LISTS)
+                # Rows added since the last clustering that have no list yet (-1) are always scanned
+                rows = np.flatnonzero(np.isin(lists[:count], np.append(probes, -1)))
+            else:
+                rows = None
+
+        if rows is None:
+            best_rows, best_scores = [], []
+            for start in range(0, count, SCAN_ROWS):
+                # Rows past count are unused capacity (or left over from before a reset)
+                scores = np.asarray(vectors[start:min(start + SCAN_ROWS, count)], dtype=np.float32) @ query
+                top = _top(scores, k)
+                best_rows.append(top + start)
+                best_scores.append(scores[top])
+            rows, scores = np.concatenate(best_rows), np.concatenate(best_scores)
+        else:
+            scores = np.concatenate([
+                np.asarray(vectors[rows[start:start + SCAN_ROWS]], dtype=np.float32) @ query
+                for start in range(0, len(rows), SCAN_ROWS)
+            ]) if len(rows) else np.empty(0, dtype=np.float32)
+        top = _top(scores, k)
+        return [(int(ids[rows[i]]), float(scores[i])) for i in top]
@@ -1,34 +1,125 @@
 # textgen/views.py
-from django.http import JsonResponse, HttpResponse, HttpRequest
-from django.shortcuts import render, redirect
+from django.http import JsonResponse, HttpResponse, HttpRequest, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.shortcuts import aget_object_or_404, render, redirect
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib import messages
-from .generation import generate_text
-from .models import Chat, TextGenerationSettings
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+from .generation import DEFAULT_ROLE, generate_batch, generate_chat, generate_text, replay_cached, stream_batch, stream_text
+from .models import Chat, Conversation
+from .persistence import chat_writer
+from . import (
+    conversations, governor, history, kv_cache, metrics, openai_api, response_cache, search, settings_cache, startup,
+    transfer,
+)
+from .governor import InsufficientMemory
+from .settings_cache import InvalidOverride
+from .scheduler import DEFAULT_PRIORITY, GenerationCancelled, GenerationTimeout, QueueFull, scheduler
+from typing import Optional
+import hmac
 import json
+import re
+import uuid
 
+# Number of full chats rendered in the main area on page load
+RECENT_CHATS_SHOWN = 10
+# Largest number of prompts accepted by one batch request
+MAX_BATCH_ITEMS = 1000
+# Client-chosen ids sent in X-Request-ID; anything else gets a generated id
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
 
-@require_http_methods(["GET", "POST"])
-def index(request: HttpRequest) -> HttpResponse:
-    # Fetch all chats, ordered by newest first (as defined in Chat.Meta.ordering)
-    chats = Chat.objects.all()
-
-    # Fetch default settings from the database (assuming one 'default' entry)
-    # Use get_or_create to ensure the default settings exist
-    default_settings, created = TextGenerationSettings.objects.get_or_create(
-        identifier='default',
-        defaults={
-            'role': 'user',
-            'temperature': 0.7,
-            'model_path': '/sdcard/fuji/Saiga-7B_LLAMA-model-q2_K.gguf',
-            'max_tokens': 200,
-            'top_p': 1.0,
-            'top_k': 50,
-            'seed': -1
-        }
-    )
 
+def _queue_full_response(exc: QueueFull) -> JsonResponse:
+    """HTTP 429 telling the client how busy the generation queue is."""
+    response = JsonResponse({
+        'error': 'Server is busy, please retry shortly.',
+        'queue_position': exc.queue_size + 1,
+        'retry_after': exc.retry_after,
+    }, status=429)
+    response['Retry-After'] = str(exc.retry_after)
+    return response
+
+
+def _timeout_response() -> JsonResponse:
+    return JsonResponse({'error': 'Generation timed out.'}, status=504)
+
+
+def _cancelled_response() -> JsonResponse:
+    return JsonResponse({'error': 'Generation was cancelled.'}, status=409)
+
+
+def _request_id(request: HttpRequest) -> str:
+    """The id a generation is queued under, for ``cancel_generation``; echoed back in ``X-Request-ID``."""
+    supplied = request.headers.get('X-Request-ID', '')
+    return supplied if REQUEST_ID_PATTERN.fullmatch(supplied) else uuid.uuid4().hex
+
+
+def _with_request_id(response: HttpResponse, request_id: str) -> HttpResponse:
+    response['X-Request-ID'] = request_id
+    return response
+
+
+def _invalid_override_response(exc: InvalidOverride) -> JsonResponse:
+    return JsonResponse({'error': str(exc), 'param': exc.name}, status=400)
+
+
+def _insufficient_memory_response(exc: InsufficientMemory) -> JsonResponse:
+    """HTTP 503 explaining that the device is too low on memory for this request."""
+    return JsonResponse({'error': str(exc), 'memory': governor.status()}, status=503)
+
+
+def _json_body(request: HttpRequest) -> dict:
+    data = json.loads(request.body) if request.body else {}
+    # Every endpoint reads named fields; a list or string body is as unusable as malformed JSON
+    if not isinstance(data, dict):
+        raise json.JSONDecodeError('Expected a JSON object', request.body.decode('utf-8', 'replace'), 0)
+    return data
+
+
+def _with_cache_status(response: HttpResponse, cache_status: str) -> HttpResponse:
+    # HIT, MISS, or BYPASS when the response cache is off or the request is not deterministic
+    response['X-Cache'] = cache_status
+    return response
+
+
+def _generation_kwargs(data: dict) -> dict:
+    """Generation parameters from a request body; raises ``InvalidOverride`` before anything is queued."""
+    # 0 is a valid temperature (and top_k); only missing or blank values fall back to the settings
+    kwargs = {
+        'model_path': data.get('model_path') or None,
+        'role': data.get('role') or DEFAULT_ROLE,
+        'temperature': data.get('temperature'),
+        'max_tokens': data.get('max_tokens'),
+        'top_p': data.get('top_p'),
+        'top_k': data.get('top_k'),
+    }
+    settings_cache.validate_overrides(**kwargs)
+    return kwargs
+
+
+def _render_index(request: HttpRequest) -> HttpResponse:
+    # Only the newest chats are rendered; older history is paged in by the sidebar
+    chats = Chat.objects.all()[:RECENT_CHATS_SHOWN]
+    history_items, history_cursor = history.chat_page()
+
+    # Resolved default settings; the 'default' row is created once and then served from memory
+    default_settings = settings_cache.ensure_default_settings()
+
+    # Pass the default settings to the template context if needed for initial JS values
+    context = {
+        'chats': chats,
+        'history_items': history_items,
+        'history_cursor': history_cursor,
+        'default_settings': default_settings,
+        'memory': governor.status(),
+    }
+    return render(request, 'textgen/index.html', context)
+
+
+@require_http_methods(["GET", "POST"])
+async def index(request: HttpRequest) -> HttpResponse:
     if request.method == 'POST':
         if request.content_type == 'application/x-www-form-urlencoded':
             # Handle standard form submission (e.g., if JavaScript is disabled)
@@ -36,11 +127,21 @@ def index(request: HttpRequest) -> HttpResponse:
             data = request.POST
             if prompt:
                 try:
-                    response_text = generate_text(prompt=prompt, model_path=data.get('model_path', None), role=data.get('role', None), temperature=data.get('temperature', None), max_tokens=data.get('max_tokens', None), top_p=data.get('top_p', None), top_k=data.get('top_k', None))
+                    # Awaited, so a long generation does not hold the thread every sync view shares
+                    response_text = await scheduler.arun(generate_text, request_id=_request_id(request),
+                                                         prompt=prompt, **_generation_kwargs(data))
                     if response_text:
                         pass  # Chat is saved automatically in generate_text
                     else:
                         messages.error(request, 'Failed to generate response.')
+                except QueueFull:
+                    messages.error(request, 'Server is busy, please retry shortly.')
+                except (InsufficientMemory, InvalidOverride) as e:
+                    messages.error(request, str(e))
+                except GenerationTimeout:
+                    messages.error(request, 'Generation timed out.')
+                except GenerationCancelled:
+                    messages.error(request, 'Generation was cancelled.')
                 except Exception as e:
                     import logging
                     logging.exception("Error generating text in view")
@@ -49,27 +150,45 @@ def index(request: HttpRequest) -> HttpResponse:
 
         elif request.content_type.startswith('application/json'):
             # Handle AJAX/JSON request from JavaScript fetch
-            import json
             try:
-                data = json.loads(request.body)
+                data = _json_body(request)
                 prompt = data.get('prompt', '').strip()
             except json.JSONDecodeError:
                 return JsonResponse({'error': 'Invalid JSON'}, status=400)
 
             if prompt:
                 try:
-                    response_text = generate_text(prompt=prompt, model_path=data.get('model_path', None), role=data.get('role', None), temperature=data.get('temperature', None), max_tokens=data.get('max_tokens', None), top_p=data.get('top_p', None), top_k=data.get('top_k', None))
-                    if response_text:
-                        # Fetch the newly created chat object to return its details
-                        latest_chat = Chat.objects.latest('id')  # Or filter by prompt/response if not latest
-                        return JsonResponse({
+                    kwargs = _generation_kwargs(data)
+                    cache_status, cached_chat = await sync_to_async(replay_cached)(prompt, **kwargs)
+                    if cached_chat is not None:
+                        return _with_cache_status(JsonResponse({
+                            'success': True,
+                            'prompt': cached_chat.prompt,
+                            'response': cached_chat.response,
+                            'timestamp': cached_chat.timestamp.isoformat()
+                        }), cache_status)
+                    request_id = _request_id(request)
+                    chat = await scheduler.arun(generate_chat, request_id=request_id, prompt=prompt, **kwargs)
+                    if chat and chat.response:
+                        return _with_request_id(_with_cache_status(JsonResponse({
                             'success': True,
-                            'prompt': latest_chat.prompt,
-                            'response': latest_chat.response,
-                            'timestamp': latest_chat.timestamp.isoformat()  # Format timestamp for JS
-                        })
+                            'chat_id': chat.id,
+                            'prompt': chat.prompt,
+                            'response': chat.response,
+                            'timestamp': chat.timestamp.isoformat()  # Format timestamp for JS
+                        }), cache_status), request_id)
                     else:
                         return JsonResponse({'error': 'Failed to generate response.'}, status=500)
+                except QueueFull as e:
+                    return _queue_full_response(e)
+                except GenerationTimeout:
+                    return _timeout_response()
+                except GenerationCancelled:
+                    return _cancelled_response()
+                except InvalidOverride as e:
+                    return _invalid_override_response(e)
+                except InsufficientMemory as e:
+                    return _insufficient_memory_response(e)
                 except Exception as e:
                     import logging
                     logging.exception("Error generating text in view for AJAX")
@@ -77,34 +196,531 @@ def index(request: HttpRequest) -> HttpResponse:
             else:
                 return JsonResponse({'error': 'Prompt is required'}, status=400)
 
-    # Pass the default settings to the template context if needed for initial JS values
-    context = {
-        'chats': chats,
-        'default_settings': default_settings
-    }
-    return render(request, 'textgen/index.html', context)
+    # The page queries the database, so it is rendered in a thread
+    return await sync_to_async(_render_index)(request)
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def generate_ajax(request):
+async def generate_ajax(request):
     """Handles the AJAX request for text generation."""
     try:
-        data = json.loads(request.body)
+        data = _json_body(request)
         prompt = data.get('prompt', '')
         if not prompt:
             return JsonResponse({'error': 'Prompt is required'}, status=400)
 
-        # Call your generation function
-        response_text = generate_text(prompt=prompt)  # Use your updated function
+        cache_status, cached_chat = await sync_to_async(replay_cached)(prompt)
+        if cached_chat is not None:
+            return _with_cache_status(JsonResponse({'response': cached_chat.response}), cache_status)
+
+        # Awaits the inference worker without holding a server thread
+        request_id = _request_id(request)
+        response_text = await scheduler.arun(generate_text, request_id=request_id, prompt=prompt)
 
         # Optionally return the new chat ID or just the response
         # If returning the full chat list, you might need to refetch it
         # Or handle updating the list on the frontend side
-        return JsonResponse({'response': response_text})
+        return _with_request_id(_with_cache_status(JsonResponse({'response': response_text}), cache_status),
+                                request_id)
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    except QueueFull as e:
+        return _queue_full_response(e)
+    except GenerationTimeout:
+        return _timeout_response()
+    except GenerationCancelled:
+        return _cancelled_response()
+    except InsufficientMemory as e:
+        return _insufficient_memory_response(e)
     except Exception as e:
         import logging
         logging.exception("Error generating text")
         return JsonResponse({'error': 'Internal server error'}, status=500)
+
+
+def _sse_frame(event: dict) -> str:
+    payload = {k: v for k, v in event.items() if k != 'event'}
+    return f"event: {event['event']}\ndata: {json.dumps(payload)}\n\n"
+
+
+def _jsonl_frame(event: dict) -> str:
+    return json.dumps(event) + "\n"
+
+
+_TIMEOUT_EVENT = {'event': 'error', 'error': 'Generation timed out.'}
+_CANCELLED_EVENT = {'event': 'error', 'error': 'Generation was cancelled.'}
+
+
+def _sse_stream(events, frame=_sse_frame):
+    """Formats generation events as server-sent event frames (or JSON lines)."""
+    try:
+        for event in events:
+            yield frame(event)
+    except GenerationTimeout:
+        yield frame(_TIMEOUT_EVENT)
+    except GenerationCancelled:
+        yield frame(_CANCELLED_EVENT)
+    finally:
+        # Django closes this iterator when the client disconnects, which cancels generation
+        events.close()
+
+
+async def _sse_astream(events, frame=_sse_frame):
+    """Async variant of ``_sse_stream`` used when serving over ASGI."""
+    try:
+        async for event in events:
+            yield frame(event)
+    except GenerationTimeout:
+        yield frame(_TIMEOUT_EVENT)
+    except GenerationCancelled:
+        yield frame(_CANCELLED_EVENT)
+    finally:
+        await events.aclose()
+
+
+def _event_stream_response(request: HttpRequest, gen_func, *args, frame=_sse_frame,
+                           content_type='text/event-stream', **kwargs) -> StreamingHttpResponse:
+    """Queues a streaming generation and relays its events as SSE; raises ``QueueFull``.
+
+    A client that disconnects closes the body iterator, which cancels the
+    generation at its next token.
+    """
+    request_id = _request_id(request)
+    if isinstance(request, ASGIRequest):
+        body = _sse_astream(scheduler.astream(gen_func, *args, request_id=request_id, **kwargs), frame)
+    else:
+        # WSGI servers buffer async iterators completely, so stay synchronous there
+        body = _sse_stream(scheduler.stream(gen_func, *args, request_id=request_id, **kwargs), frame)
+    response = StreamingHttpResponse(body, content_type=content_type)
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return _with_request_id(response, request_id)
+
+
+@require_http_methods(["POST"])
+async def generate_stream(request: HttpRequest) -> HttpResponse:
+    """Streams generated tokens to the client as server-sent events."""
+    if request.content_type.startswith('application/json'):
+        try:
+            data = _json_body(request)
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    else:
+        data = request.POST
+
+    prompt = (data.get('prompt') or '').strip()
+    if not prompt:
+        return JsonResponse({'error': 'Prompt is required'}, status=400)
+
+    try:
+        kwargs = _generation_kwargs(data)
+    except InvalidOverride as e:
+        return _invalid_override_response(e)
+    try:
+        cache_status, cached_chat = await sync_to_async(replay_cached)(prompt, **kwargs)
+    except InsufficientMemory as e:
+        return _insufficient_memory_response(e)
+    if cached_chat is not None:
+        # The whole answer is known, so send it as one token followed by done
+        body = _sse_frame({'event': 'token', 'text': cached_chat.response}) + _sse_frame({
+            'event': 'done',
+            'chat_id': cached_chat.id,
+            'response': cached_chat.response,
+            'timestamp': cached_chat.timestamp.isoformat(),
+        })
+        return _with_cache_status(HttpResponse(body, content_type='text/event-stream'), cache_status)
+
+    try:
+        response = _event_stream_response(request, stream_text, prompt=prompt, **kwargs)
+    except QueueFull as e:
+        return _queue_full_response(e)
+    return _with_cache_status(response, cache_status)
+
+
+def _is_batch_item(item) -> bool:
+    # A prompt string, or an object whose prompt (if any) is a string
+    return isinstance(item, str) or (isinstance(item, dict) and isinstance(item.get('prompt') or '', str))
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def generate_batch_view(request: HttpRequest) -> HttpResponse:
+    """Generates a list of prompts in one request.
+
+    Body: ``{"prompts": [...]}`` or ``{"items": [{"prompt": ..., "temperature": ...}, ...]}``
+    plus shared generation parameters. Results come back in order as one JSON
+    document, or as JSON lines while they are produced when ``"stream": true``.
+    """
+    try:
+        data = _json_body(request)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    items = data.get('items') or data.get('prompts') or []
+    if not isinstance(items, list) or not items or not all(_is_batch_item(item) for item in items):
+        return JsonResponse({'error': 'A non-empty list of prompts is required'}, status=400)
+    if len(items) > MAX_BATCH_ITEMS:
+        return JsonResponse({'error': f'At most {MAX_BATCH_ITEMS} prompts per batch'}, status=400)
+
+    try:
+        # Per-item values are checked per item; an unusable shared value would fail every item
+        kwargs = _generation_kwargs(data)
+    except InvalidOverride as e:
+        return _invalid_override_response(e)
+
+    # Batches yield to interactive requests and get a deadline that grows with their size
+    options = {'priority': DEFAULT_PRIORITY, 'timeout': scheduler.request_timeout * len(items)}
+    try:
+        if data.get('stream'):
+            return _event_stream_response(request, stream_batch, items, frame=_jsonl_frame,
+                                          content_type='application/x-ndjson', **options, **kwargs)
+        request_id = _request_id(request)
+        results = await scheduler.arun(generate_batch, items, request_id=request_id, **options, **kwargs)
+    except QueueFull as e:
+        return _queue_full_response(e)
+    except GenerationTimeout:
+        return _timeout_response()
+    except GenerationCancelled:
+        return _cancelled_response()
+    except InsufficientMemory as e:
+        return _insufficient_memory_response(e)
+    return _with_request_id(JsonResponse({'results': results}), request_id)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def cancel_generation(request: HttpRequest, request_id: str) -> JsonResponse:
+    """Cancels a queued or running generation by the id it was sent with (or given) in ``X-Request-ID``.
+
+    Not CSRF-protected so a page can cancel from a ``pagehide`` beacon; only
+    a client that knows the id can cancel the request.
+    """
+    if not scheduler.cancel(request_id):
+        return JsonResponse({'error': 'No unfinished generation has this id.'}, status=404)
+    return JsonResponse({'cancelled': True, 'request_id': request_id})
+
+
+@require_http_methods(["GET"])
+def cache_stats(request: HttpRequest) -> JsonResponse:
+    """Reports how often follow-up prompts reused a cached KV prefix or a cached response."""
+    return JsonResponse({
+        'prefix_cache': kv_cache.stats.snapshot(),
+        'response_cache': response_cache.cache.snapshot() if response_cache.cache else None,
+    })
+
+
+@require_http_methods(["GET"])
+def memory_status(request: HttpRequest) -> JsonResponse:
+    """Free memory, the loader settings chosen for each model and any degradation, for the UI."""
+    return JsonResponse(governor.status())
+
+
+@require_http_methods(["GET"])
+def readiness(request: HttpRequest) -> JsonResponse:
+    """Start-up state and timeline; 503 until the default model is loaded, so probes and scripts can wait."""
+    status = startup.timeline.snapshot()
+    return JsonResponse(status, status=200 if status['ready'] else 503)
+
+
+@require_http_methods(["GET"])
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    """Inference metrics in the Prometheus text exposition format."""
+    return HttpResponse(metrics.registry.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@require_http_methods(["GET"])
+def stats_page(request: HttpRequest) -> HttpResponse:
+    """Human-readable view of the same metrics."""
+    snapshot = metrics.registry.snapshot()
+    context = {
+        'histograms': [(name, value) for name, value in snapshot.items() if isinstance(value, dict)],
+        'values': [(name, value) for name, value in snapshot.items() if not isinstance(value, dict)],
+        'resident_memory_mb': (snapshot.get('process_resident_memory_bytes') or 0) / (1024 * 1024),
+        'memory': governor.status(),
+        'startup': startup.timeline.snapshot(),
+    }
+    return render(request, 'textgen/stats.html', context)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def conversation_create(request: HttpRequest) -> JsonResponse:
+    try:
+        data = _json_body(request)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    conversation = await Conversation.objects.acreate(
+        system_prompt=data.get('system_prompt', ''),
+        title=data.get('title', ''),
+    )
+    return JsonResponse({'id': conversation.id, 'title': conversation.title}, status=201)
+
+
+@require_http_methods(["GET"])
+async def conversation_detail(request: HttpRequest, conversation_id: int) -> JsonResponse:
+    conversation = await aget_object_or_404(Conversation, pk=conversation_id)
+    return JsonResponse({
+        'id': conversation.id,
+        'title': conversation.title,
+        'system_prompt': conversation.system_prompt,
+        'messages': [
+            {'id': m.id, 'role': m.role, 'content': m.content, 'timestamp': m.timestamp.isoformat()}
+            async for m in conversation.messages.all()
+        ],
+    })
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def conversation_message(request: HttpRequest, conversation_id: int) -> HttpResponse:
+    """Adds a user message to a conversation and answers it with the whole (windowed) history."""
+    conversation = await aget_object_or_404(Conversation, pk=conversation_id)
+    try:
+        data = _json_body(request)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    content = (data.get('content') or '').strip()
+    if not content:
+        return JsonResponse({'error': 'Content is required'}, status=400)
+    try:
+        kwargs = _generation_kwargs(data)
+    except InvalidOverride as e:
+        return _invalid_override_response(e)
+
+    try:
+        if data.get('stream'):
+            return _event_stream_response(request, conversations.stream_reply, conversation, content, **kwargs)
+        request_id = _request_id(request)
+        message = await scheduler.arun(conversations.reply, conversation, content, request_id=request_id,
+                                       **kwargs)
+    except QueueFull as e:
+        return _queue_full_response(e)
+    except GenerationTimeout:
+        return _timeout_response()
+    except GenerationCancelled:
+        return _cancelled_response()
+    except InsufficientMemory as e:
+        return _insufficient_memory_response(e)
+    except Exception:
+        import logging
+        logging.exception("Error generating conversation reply")
+        return JsonResponse({'error': 'An error occurred during generation.'}, status=500)
+
+    return _with_request_id(JsonResponse({
+        'id': message.id,
+        'role': message.role,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+    }), request_id)
+
+
+@require_http_methods(["GET"])
+async def history_api(request: HttpRequest) -> JsonResponse:
+    """One page of chat previews for the sidebar; pass ``next_cursor`` back to get the next page."""
+    try:
+        limit = int(request.GET.get('limit', history.DEFAULT_PAGE_SIZE))
+        items, next_cursor = await history.achat_page(request.GET.get('cursor') or None, limit)
+    except (ValueError, history.InvalidCursor):
+        return JsonResponse({'error': 'Invalid cursor or limit'}, status=400)
+    return JsonResponse({
+        'items': [dict(item, timestamp=item['timestamp'].isoformat()) for item in items],
+        'next_cursor': next_cursor,
+    })
+
+
+@require_http_methods(["GET"])
+async def search_api(request: HttpRequest) -> JsonResponse:
+    """Ranked full-text search over chats; snippets are escaped HTML with matches in ``<mark>``."""
+    query = (request.GET.get('q') or '').strip()
+    try:
+        page = int(request.GET.get('page', 1))
+        limit = int(request.GET.get('limit', search.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid page or limit'}, status=400)
+    items, next_page = await sync_to_async(search.search_chats)(query, page, limit)
+    return JsonResponse({
+        'query': query,
+        'items': [dict(item, timestamp=item['timestamp'].isoformat()) for item in items],
+        'next_page': next_page,
+    })
+
+
+@require_http_methods(["GET"])
+async def chat_detail(request: HttpRequest, chat_id: int) -> JsonResponse:
+    # A chat that was just generated may still be waiting in the write-behind buffer
+    chat = chat_writer.pending(chat_id) or await aget_object_or_404(Chat, pk=chat_id)
+    return JsonResponse({
+        'id': chat.id,
+        'prompt': chat.prompt,
+        'response': chat.response,
+        'timestamp': chat.timestamp.isoformat(),
+    })
+
+
+async def _aiterate(iterator):
+    """Drives a blocking iterator (e.g. one reading the database) from an async response."""
+    done = object()
+    while True:
+        chunk = await sync_to_async(next)(iterator, done)
+        if chunk is done:
+            break
+        yield chunk
+
+
+@require_http_methods(["GET"])
+def history_export(request: HttpRequest) -> HttpResponse:
+    """Streams chats (and settings) as compressed JSON lines; ``since`` makes the export incremental."""
+    codec = request.GET.get('format', transfer.GZIP)
+    try:
+        since = transfer.parse_since(request.GET.get('since'))
+        # Fail before the response starts if the codec is unknown or zstandard is missing
+        transfer.check_codec(codec)
+    except transfer.TransferError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    chunks = transfer.export_stream(codec, since=since, include_settings=request.GET.get('settings') != '0')
+    # Under ASGI a synchronous iterator would be read completely before the first byte is sent
+    body = _aiterate(chunks) if isinstance(request, ASGIRequest) else chunks
+    response = StreamingHttpResponse(body, content_type=transfer.CONTENT_TYPES[codec])
+    filename = f"textgen-history-{timezone.now():%Y%m%d-%H%M%S}{transfer.EXTENSIONS[codec]}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@require_http_methods(["POST"])
+async def history_import(request: HttpRequest) -> JsonResponse:
+    """Imports an archive sent as the request body or as the ``file`` field of a form upload.
+
+    CSRF protection stays on, since an import can replace settings rows; scripts
+    use ``manage.py import_history`` instead.
+    """
+    source = request.FILES.get('file') if request.content_type == 'multipart/form-data' else request
+    if source is None:
+        return JsonResponse({'error': 'An archive file is required'}, status=400)
+    try:
+        # A long import runs on its own thread rather than blocking the shared sync thread other views use
+        result = await sync_to_async(transfer.import_stream, thread_sensitive=False)(
+            transfer.read_chunks(source), overwrite_settings=request.GET.get('overwrite_settings') == '1',
+        )
+    except transfer.TransferError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(result.as_dict())
+
+
+# --- OpenAI-Compatible API ---
+
+def _openai_error(message: str, status: int, error_type: str = 'invalid_request_error',
+                  param: Optional[str] = None) -> JsonResponse:
+    return JsonResponse({'error': {'message': message, 'type': error_type, 'param': param, 'code': None}},
+                        status=status)
+
+
+def _openai_frame(event: dict) -> str:
+    """Frames events the way OpenAI streams them: bare ``data:`` lines ending with ``[DONE]``."""
+    kind = event.get('event')
+    if kind == 'queued':
+        return ''
+    if kind == 'done':
+        return "data: [DONE]\n\n"
+    if kind == 'error':
+        event = {'error': {'message': event['error'], 'type': 'server_error', 'param': None, 'code': None}}
+    return f"data: {json.dumps(event)}\n\n"
+
+
+def _openai_unauthorized(request: HttpRequest) -> Optional[JsonResponse]:
+    key = openai_api.api_key()
+    if not key:
+        return None
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if hmac.compare_digest(supplied.encode(), key.encode()):
+        return None
+    return _openai_error('Invalid API key.', 401, error_type='authentication_error')
+
+
+@require_http_methods(["GET"])
+async def openai_models(request: HttpRequest) -> JsonResponse:
+    """``GET /v1/models``: the configured and loaded models."""
+    denied = _openai_unauthorized(request)
+    if denied is not None:
+        return denied
+    return JsonResponse(await sync_to_async(openai_api.model_list)())
+
+
+async def _openai_create(request: HttpRequest, kind: str) -> HttpResponse:
+    denied = _openai_unauthorized(request)
+    if denied is not None:
+        return denied
+    try:
+        data = _json_body(request)
+    except json.JSONDecodeError:
+        return _openai_error('Invalid JSON body.', 400)
+    if not isinstance(data, dict):
+        return _openai_error('The request body must be a JSON object.', 400)
+    try:
+        if kind == openai_api.COMPLETION:
+            prompt = openai_api.parse_prompt(data.get('prompt'))
+        else:
+            prompt = openai_api.parse_messages(data.get('messages'))
+        kwargs = await sync_to_async(openai_api.generation_kwargs)(data)
+    except openai_api.InvalidRequest as e:
+        return _openai_error(str(e), 400, param=e.param)
+
+    try:
+        if data.get('stream'):
+            include_usage = bool((data.get('stream_options') or {}).get('include_usage'))
+            return _event_stream_response(request, openai_api.stream, kind, prompt, include_usage=include_usage,
+                                          frame=_openai_frame, **kwargs)
+        request_id = _request_id(request)
+        result = await scheduler.arun(openai_api.create, kind, prompt, request_id=request_id, **kwargs)
+    except QueueFull as e:
+        response = _openai_error('Server is busy, please retry shortly.', 429, error_type='rate_limit_error')
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    except GenerationTimeout:
+        return _openai_error('Generation timed out.', 504, error_type='server_error')
+    except GenerationCancelled:
+        return _openai_error('Generation was cancelled.', 409, error_type='server_error')
+    except InsufficientMemory as e:
+        return _openai_error(str(e), 503, error_type='server_error')
+    except Exception:
+        import logging
+        logging.exception("Error in OpenAI-compatible request")
+        return _openai_error('An error occurred during generation.', 500, error_type='server_error')
+    return _with_request_id(JsonResponse(result), request_id)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def openai_completions(request: HttpRequest) -> HttpResponse:
+    """``POST /v1/completions``: the prompt is sent to the model as is, without a chat template."""
+    return await _openai_create(request, openai_api.COMPLETION)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def openai_chat_completions(request: HttpRequest) -> HttpResponse:
+    """``POST /v1/chat/completions``: messages are rendered with the model's chat template."""
+    return await _openai_create(request, openai_api.CHAT)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def openai_embeddings(request: HttpRequest) -> JsonResponse:
+    """``POST /v1/embeddings``: vectors from the retrieval embedding model (``TEXTGEN_EMBEDDING_MODEL_PATH``)."""
+    denied = _openai_unauthorized(request)
+    if denied is not None:
+        return denied
+    try:
+        data = _json_body(request)
+    except json.JSONDecodeError:
+        return _openai_error('Invalid JSON body.', 400)
+    if not isinstance(data, dict):
+        return _openai_error('The request body must be a JSON object.', 400)
+    try:
+        # The embedding model has its own lock, so this does not wait behind generation in the scheduler
+        return JsonResponse(await sync_to_async(openai_api.embeddings, thread_sensitive=False)(data))
+    except openai_api.InvalidRequest as e:
+        return _openai_error(str(e), 400, param=e.param)
+    except Exception:
+        import logging
+        logging.exception("Error in OpenAI-compatible embeddings request")
+        return _openai_error('An error occurred while embedding.', 500, error_type='server_error')
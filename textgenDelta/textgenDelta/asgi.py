@@ -2,6 +2,10 @@
 ASGI config for textgenDelta project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Generation, streaming and history views are async, so an ASGI server such as
+uvicorn or daphne keeps serving other requests while a generation runs:
+
+    uvicorn textgenDelta.asgi:application --host 0.0.0.0 --port 8000
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -9,8 +13,20 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'textgenDelta.settings')
 
 application = get_asgi_application()
+
+if settings.DEBUG:
+    # runserver serves static files itself; ASGI servers need Django's handler for that
+    from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+
+    application = ASGIStaticFilesHandler(application)
+
+# Preloads the model in the background while the server starts accepting connections
+from textgen import startup  # noqa: E402
+
+startup.start()
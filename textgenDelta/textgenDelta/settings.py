@@ -78,6 +78,18 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # WAL lets the history sidebar read while chats are written; synchronous=NORMAL
+            # skips the fsync on every commit, which is slow on phone flash storage
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA cache_size=-8000;'
+                'PRAGMA busy_timeout=5000;'
+            ),
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
@@ -123,3 +135,92 @@ STATIC_ROOT = BASE_DIR /'textgen/static'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Logging
+# https://docs.djangoproject.com/en/5.1/topics/logging/
+# The app logs to the console; set the 'textgen' level to 'DEBUG' to see per-request details
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '{levelname}:{name}:{message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'textgen': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+
+# Text generation
+# Loaded llama_cpp models are kept in memory between requests (see textgen/model_registry.py)
+
+TEXTGEN_MAX_LOADED_MODELS = 1
+TEXTGEN_MODEL_MEMORY_BUDGET_MB = None
+# Started by wsgi.py/asgi.py; progress is reported at /ready/ (see textgen/startup.py)
+TEXTGEN_PRELOAD_MODEL = True
+
+# Limits for settings rows with auto_tune enabled (see textgen/autotune.py and `manage.py autotune`)
+TEXTGEN_AUTOTUNE_MAX_CTX = 8192
+TEXTGEN_AUTOTUNE_RESERVED_MB = 512
+
+# Saved KV states keyed by prompt-token prefix: 'ram', 'disk' (needs diskcache) or None
+TEXTGEN_KV_CACHE = 'ram'
+TEXTGEN_KV_CACHE_MB = 512
+TEXTGEN_KV_CACHE_DIR = BASE_DIR / '.kv_cache'
+
+# Opt-in cache of finished responses for deterministic requests (temperature 0 or a fixed seed):
+# 'memory', 'sqlite' (memory LRU in front of an SQLite file that survives restarts) or None
+TEXTGEN_RESPONSE_CACHE = None
+TEXTGEN_RESPONSE_CACHE_ENTRIES = 256
+TEXTGEN_RESPONSE_CACHE_TTL = 24 * 60 * 60
+TEXTGEN_RESPONSE_CACHE_DB = BASE_DIR / '.response_cache.sqlite3'
+TEXTGEN_RESPONSE_CACHE_DB_ENTRIES = 10000
+
+# All generation runs on a small pool of inference workers (see textgen/scheduler.py)
+TEXTGEN_SCHEDULER_WORKERS = 1
+TEXTGEN_SCHEDULER_MAX_QUEUE = 8
+TEXTGEN_REQUEST_TIMEOUT = 300
+
+# A completion stops inside the decode loop once it has run this long, or when it decodes slower than the
+# tokens/s floor (see textgen/deadlines.py); 0 disables either limit
+TEXTGEN_MAX_GENERATION_SECONDS = 180
+TEXTGEN_MIN_TOKENS_PER_SECOND = 0.5
+
+# Above 1, concurrent completions on the same model are decoded together in one llama_decode batch
+# (see textgen/batching.py). This allocates a second KV cache of n_ctx tokens shared by the sequences.
+TEXTGEN_PARALLEL_SEQUENCES = 1
+
+# Before a model is loaded, the memory governor (see textgen/governor.py) picks mlock and the KV cache
+# type from free RAM, then shrinks the context or switches to the fallback model if it still does not fit
+TEXTGEN_MEMORY_GUARD = True
+TEXTGEN_MEMORY_RESERVED_MB = 384
+TEXTGEN_LARGE_MAX_TOKENS = 1024  # requests above this are refused while memory is critical
+TEXTGEN_FALLBACK_MODEL_PATH = None  # e.g. "/sdcard/fuji/qwen2.5-1.5b-instruct-q4_k_m.gguf"
+TEXTGEN_FALLBACK_CHAT_FORMAT = None  # e.g. "qwen"; None keeps the requested model's format
+
+# Chats are saved by a background writer that batches inserts (see textgen/persistence.py); its ids are
+# reserved in the database, so the admin, import_history and other server processes can insert alongside it
+TEXTGEN_CHAT_WRITE_BEHIND = True
+TEXTGEN_CHAT_WRITE_BATCH_SIZE = 256
+TEXTGEN_CHAT_WRITE_INTERVAL = 0.2
+
+# History imports (see textgen/transfer.py) stop once an archive decompresses to more than this
+TEXTGEN_IMPORT_MAX_MB = 1024
+
+# OpenAI-compatible API under /v1/ (see textgen/openai_api.py); when set, clients must send
+# "Authorization: Bearer <key>"
+TEXTGEN_API_KEY = None
+
+# Retrieval over chat history (see textgen/retrieval.py): a small embedding GGUF (e.g. bge-small or
+# nomic-embed-text) embeds every chat in the background into a vector index next to the database, and the
+# TEXTGEN_RETRIEVAL_TOP_K most similar earlier turns are added to each prompt. None disables both.
+TEXTGEN_EMBEDDING_MODEL_PATH = None
+TEXTGEN_EMBEDDING_N_CTX = 512
+TEXTGEN_EMBEDDING_THREADS = 2
+TEXTGEN_VECTOR_INDEX_DIR = BASE_DIR / '.vector_index'
+TEXTGEN_RETRIEVAL_TOP_K = 3
+TEXTGEN_RETRIEVAL_MIN_SCORE = 0.5
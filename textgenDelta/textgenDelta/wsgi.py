@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'textgenDelta.settings')
 
 application = get_wsgi_application()
+
+# Preloads the model in the background (also under `manage.py runserver`, which serves this application)
+from textgen import startup  # noqa: E402
+
+startup.start()